@@ -10,14 +10,25 @@ import os
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 
-from publish_999md import router as publish_999md_router, start_auto_publish_999_thread
+from publish_999md import (
+    router as publish_999md_router,
+    run_schema_migrations,
+    start_auto_publish_999_thread,
+    start_iblock_sync_thread,
+    start_options_tree_prewarm_thread,
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # DDL и ожидание лока миграций — в пуле потоков, event loop не блокируем
+    await run_in_threadpool(run_schema_migrations)
     start_auto_publish_999_thread()
+    start_options_tree_prewarm_thread()
+    start_iblock_sync_thread()
     yield
 
 
@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарки publish_999md (локально, без 999.md / Bitrix / PostgreSQL).
+
+  python bench_999md.py http [--images 10] [--publishes 5] [--sync 50] [--handshake-ms 40] [--rtt-ms 5]
+  python bench_999md.py features [--rounds 2000]
+  python bench_999md.py models [--brands 10] [--rounds 20] [--tree 999md_options_tree.json]
+  python bench_999md.py decode [--raws raws.json] [--cars 500] [--rounds 5]
+  python bench_999md.py decode --record raws.json [--cars 500]   (нужен доступ к PostgreSQL)
+
+http — сколько соединений (TCP+TLS рукопожатий) и времени экономит пул keep-alive (PooledHttpClient)
+против голых requests.get/post/patch/put на одну публикацию и на проход синхронизации.
+Стаб-сервер на 127.0.0.1 отвечает как partners-api.999.md; --handshake-ms имитирует стоимость рукопожатия
+(задержка при каждом новом соединении), --rtt-ms — задержку каждого запроса.
+
+features — поиск option id по 999md_features_cars_sell.json: как было (json.load + полный обход на каждый
+вызов), только обход, и FeatureCatalog (индексы, один разбор файла).
+
+models — resolve_model_option_id по всем моделям марок с самым длинным списком моделей: старый линейный
+обход с эвристиками против ModelIndex (триграммы, корзины по длине, кэш на (марка, модель)). Модели берутся
+из дерева прогрева (POST /options-tree/refresh); если файла нет — из синтетического дерева.
+
+decode — car_data_from_raw, машин в секунду: скомпилированный DecodePlan против плана, собираемого заново
+на каждую машину (поиск полей по названию и разбор meta на каждый вызов, как до DecodePlan). --record
+сохраняет из БД meta, enum-кэш, имена iblock и последние raw в файл; без --raws — синтетические данные.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from dataclasses import asdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+os.environ.setdefault("API_999MD_TOKEN", "bench-token")
+
+import publish_999md as p999  # noqa: E402
+
+
+# -----------------------------
+# Стаб partners-api.999.md
+# -----------------------------
+class _Stub999Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+    handshake_sec = 0.0
+    rtt_sec = 0.0
+    connections = 0
+    requests_served = 0
+    lock = threading.Lock()
+
+    def setup(self) -> None:
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with _Stub999Handler.lock:
+            _Stub999Handler.connections += 1
+        if self.handshake_sec:
+            time.sleep(self.handshake_sec)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        pass
+
+    def _reply(self, body: Dict[str, Any]) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        with _Stub999Handler.lock:
+            _Stub999Handler.requests_served += 1
+        if self.rtt_sec:
+            time.sleep(self.rtt_sec)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        self._reply({"features": [{"id": "16", "value": ["37360000000"]}]})
+
+    def do_POST(self) -> None:
+        if self.path.startswith("/images"):
+            self._reply({"image_id": "img-bench"})
+        else:
+            self._reply({"advert": {"id": "1"}})
+
+    def do_PATCH(self) -> None:
+        self._reply({"ok": True})
+
+    def do_PUT(self) -> None:
+        self._reply({"ok": True})
+
+
+def _start_stub(handshake_ms: float, rtt_ms: float) -> Tuple[ThreadingHTTPServer, str]:
+    _Stub999Handler.handshake_sec = handshake_ms / 1000.0
+    _Stub999Handler.rtt_sec = rtt_ms / 1000.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Stub999Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def _reset_stub_counters() -> None:
+    with _Stub999Handler.lock:
+        _Stub999Handler.connections = 0
+        _Stub999Handler.requests_served = 0
+
+
+# -----------------------------
+# Сценарии: те же вызовы, что делает публикация / SYNC_999
+# -----------------------------
+def _publish_calls(send: Callable[..., Any], n_images: int) -> None:
+    img = b"\xff\xd8" + b"0" * 20000
+    for i in range(n_images):
+        send("POST", "/images", files={"file": (f"photo{i}.jpg", img, "image/jpeg")}, timeout=60)
+    send("POST", "/adverts", json={"features": []}, timeout=60)
+    send("PATCH", "/adverts/1", json={"features": [{"id": "16", "value": ["37360000000"]}]}, timeout=60)
+    send("GET", "/adverts/1/features", params={"lang": "ru"}, timeout=30)
+    send("PUT", "/adverts/1/access_policy", json={"access_policy": "public"}, timeout=30)
+
+
+def _sync_calls(send: Callable[..., Any], n_patches: int) -> None:
+    for i in range(n_patches):
+        send("PATCH", f"/adverts/{i}", json={"features": [{"id": "2", "value": 1000 + i, "unit": "eur"}]}, timeout=60)
+
+
+def _bare_sender(base_url: str) -> Callable[..., Any]:
+    """Как было: requests.get/post/patch/put без сессии — новое соединение на каждый вызов."""
+    fns = {"GET": requests.get, "POST": requests.post, "PATCH": requests.patch, "PUT": requests.put}
+
+    def send(method: str, path: str, **kwargs: Any) -> Any:
+        r = fns[method](base_url + path, auth=("bench-token", ""), **kwargs)
+        r.raise_for_status()
+        return r
+
+    return send
+
+
+def _pooled_sender(base_url: str) -> Callable[..., Any]:
+    client = p999.PooledHttpClient(base_url=base_url, pool_size=p999.HTTP_999_POOL_SIZE)
+
+    def send(method: str, path: str, **kwargs: Any) -> Any:
+        r = client.request(method, path, auth=("bench-token", ""), **kwargs)
+        r.raise_for_status()
+        return r
+
+    return send
+
+
+def _measure(label: str, scenario: Callable[[], None]) -> Dict[str, Any]:
+    _reset_stub_counters()
+    t0 = time.perf_counter()
+    scenario()
+    elapsed = time.perf_counter() - t0
+    return {
+        "label": label,
+        "seconds": round(elapsed, 4),
+        "requests": _Stub999Handler.requests_served,
+        "connections": _Stub999Handler.connections,
+    }
+
+
+def bench_http(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    server, base_url = _start_stub(args.handshake_ms, args.rtt_ms)
+    rows: List[Dict[str, Any]] = []
+    try:
+        bare = _bare_sender(base_url)
+        rows.append(_measure(
+            f"publish x{args.publishes} bare requests",
+            lambda: [_publish_calls(bare, args.images) for _ in range(args.publishes)],
+        ))
+        pooled = _pooled_sender(base_url)
+        rows.append(_measure(
+            f"publish x{args.publishes} pooled client",
+            lambda: [_publish_calls(pooled, args.images) for _ in range(args.publishes)],
+        ))
+        rows.append(_measure(f"sync {args.sync} PATCH bare requests", lambda: _sync_calls(bare, args.sync)))
+        pooled = _pooled_sender(base_url)
+        rows.append(_measure(f"sync {args.sync} PATCH pooled client", lambda: _sync_calls(pooled, args.sync)))
+    finally:
+        server.shutdown()
+    _print_rows(rows)
+    for i in range(0, len(rows), 2):
+        bare_row, pooled_row = rows[i], rows[i + 1]
+        saved_conn = bare_row["connections"] - pooled_row["connections"]
+        saved_sec = bare_row["seconds"] - pooled_row["seconds"]
+        n = args.publishes if i == 0 else 1
+        print(
+            f"  {pooled_row['label']}: рукопожатий сэкономлено {saved_conn} "
+            f"({saved_conn / n:.1f} на проход), время {-saved_sec:+.3f} с ({-saved_sec / n * 1000:+.0f} мс на проход)"
+        )
+    return rows
+
+
+# -----------------------------
+# FeatureCatalog против json.load + обхода
+# -----------------------------
+# Запросы как в car_data_from_raw / build_advert_payload: марка, кузов, топливо, двигатель, привод, КПП.
+FEATURE_LOOKUPS: List[Tuple[str, str]] = [
+    ("20", "BMW"), ("20", "Mercedes"), ("20", "Toyota"), ("20", "Volkswagen"), ("20", "Dacia"), ("20", "Skoda"),
+    ("102", "Universal"), ("102", "Sedan"), ("102", "Хетчбэк"),
+    ("151", "Дизель"), ("151", "Бензин"),
+    ("2553", "2.0"), ("2553", "1.6"), ("2553", "1.5"),
+    ("108", "Передний"), ("101", "Автомат"),
+]
+
+
+def _bench_loop(label: str, rounds: int, fn: Callable[[str, str], Any]) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    n = 0
+    for _ in range(rounds):
+        for fid, title in FEATURE_LOOKUPS:
+            fn(fid, title)
+            n += 1
+    elapsed = time.perf_counter() - t0
+    return {"label": label, "lookups": n, "seconds": round(elapsed, 4), "us_per_lookup": round(elapsed / n * 1e6, 2)}
+
+
+def bench_features(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    path = p999.FEATURES_JSON_PATH
+
+    def old_per_call(fid: str, title: str) -> Any:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return p999._scan_feature_option(data, fid, title)
+
+    with open(path, "r", encoding="utf-8") as f:
+        parsed = json.load(f)
+    catalog = p999.get_feature_catalog()
+    mismatches = [
+        (fid, t) for fid, t in FEATURE_LOOKUPS
+        if catalog.find_option(fid, t) != p999._scan_feature_option(parsed, fid, t)
+    ]
+    old_rounds = max(1, args.rounds // 20)
+    rows = [
+        _bench_loop(f"json.load + scan (x{old_rounds})", old_rounds, old_per_call),
+        _bench_loop(f"scan only (x{args.rounds})", args.rounds, lambda fid, t: p999._scan_feature_option(parsed, fid, t)),
+        _bench_loop(f"FeatureCatalog.find_option (x{args.rounds})", args.rounds, catalog.find_option),
+        _bench_loop(
+            f"_find_feature_option via catalog (x{args.rounds})",
+            args.rounds,
+            lambda fid, t: p999._find_feature_option(p999._load_features_json(), fid, t),
+        ),
+    ]
+    _print_rows(rows)
+    if mismatches:
+        print(f"  расхождения с обходом (точное совпадение теперь приоритетнее подстроки): {mismatches}")
+    return rows
+
+
+# -----------------------------
+# ModelIndex против линейного обхода моделей марки
+# -----------------------------
+def _legacy_resolve_model(options: List[Dict], model: str) -> Optional[str]:
+    """resolve_model_option_id до ModelIndex: нормализация всех опций на каждый вызов, первое совпадение."""
+    model_norm = p999._normalize_for_match(model)
+    model_first = model_norm[:4] if len(model_norm) >= 4 else model_norm
+    for opt in options:
+        t_norm = p999._normalize_for_match((opt.get("title") or opt.get("value") or "").strip())
+        if not t_norm:
+            continue
+        if model_norm == t_norm or model_norm in t_norm:
+            return str(opt.get("id"))
+        if t_norm in model_norm:
+            if len(t_norm) >= len(model_norm) - 1:
+                return str(opt.get("id"))
+            continue
+        if model_norm.startswith(t_norm) or t_norm.startswith(model_norm):
+            if len(t_norm) >= 3 and len(model_norm) >= 3 and abs(len(t_norm) - len(model_norm)) <= 2:
+                return str(opt.get("id"))
+        if model_first and len(model_first) >= 4 and t_norm.startswith(model_first):
+            return str(opt.get("id"))
+    return str(options[0].get("id")) if options else None
+
+
+def _synthetic_models_tree(n_brands: int) -> Dict[str, List[Dict]]:
+    """Марки из файла фич, модели — правдоподобные названия (A4, A4 Allroad, Series 3 Gran Turismo, ...)."""
+    rnd = random.Random(999)
+    bases = ["A", "C", "E", "S", "X", "Q", "Series ", "Model ", "GL", "CL", "RS", "Golf", "Passat", "Octavia", "Corolla"]
+    suffixes = ["", " Coupe", " Cabrio", " Allroad", " Gran Turismo", " Sportback", " Variant", " Hybrid", " Class"]
+    out: Dict[str, List[Dict]] = {}
+    for _, brand_id in p999.get_feature_catalog().options(p999.BRAND_FEATURE_ID)[:n_brands]:
+        titles = sorted({f"{rnd.choice(bases)}{rnd.randint(1, 9) * rnd.choice([1, 10])}{rnd.choice(suffixes)}" for _ in range(150)})
+        out[brand_id] = [{"id": f"{brand_id}{i:04d}", "title": t} for i, t in enumerate(titles)]
+    return out
+
+
+def _model_queries(title: str) -> List[str]:
+    """Как модель приходит из Bitrix: как есть, нижний регистр, без пробелов, первое слово, с лишним хвостом."""
+    return [title, title.lower(), title.replace(" ", ""), title.split()[0], f"{title} 4x4"]
+
+
+def bench_models(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    tree_path = Path(args.tree) if args.tree else p999.OPTIONS_TREE_PATH
+    by_brand = {}
+    if tree_path.exists():
+        with open(tree_path, "r", encoding="utf-8") as f:
+            by_brand = json.load(f)["options"].get(p999.BRAND_FEATURE_ID) or {}  # после полного сброса кэша веток нет
+        source = str(tree_path)
+    if not by_brand:
+        by_brand = _synthetic_models_tree(args.brands)
+        source = "синтетическое дерево (файла дерева нет)"
+    top = sorted(by_brand.items(), key=lambda kv: len(kv[1]), reverse=True)[:args.brands]
+    # Модели отдаём из памяти, как после прогрева: меряем только сопоставление
+    by_id = dict(top)
+    p999.get_dependent_options = lambda dep, parent: by_id[str(parent)]
+    queries = [(brand, q) for brand, options in top for opt in options for q in _model_queries(opt.get("title") or "")]
+    print(f"  {source}: марок {len(top)}, моделей {sum(len(o) for _, o in top)}, запросов на раунд {len(queries)}")
+
+    def run(label: str, rounds: int, fn: Callable[[str, str], Any]) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        with contextlib.redirect_stderr(io.StringIO()):  # WARN о слабых совпадениях
+            for _ in range(rounds):
+                for brand, q in queries:
+                    fn(brand, q)
+        elapsed = time.perf_counter() - t0
+        n = rounds * len(queries)
+        return {"label": label, "lookups": n, "seconds": round(elapsed, 4), "us_per_lookup": round(elapsed / n * 1e6, 2)}
+
+    p999._model_indexes.clear()
+    t0 = time.perf_counter()
+    for brand, _ in top:
+        p999._get_model_index(brand)
+    build_ms = (time.perf_counter() - t0) * 1000
+
+    def cold(brand: str, q: str) -> Any:
+        p999._get_model_index(brand)._memo.clear()
+        return p999.resolve_model_option_id(brand, q)
+
+    legacy_rounds = max(1, args.rounds // 10)
+    rows = [
+        run(f"linear scan (x{legacy_rounds})", legacy_rounds, lambda b, q: _legacy_resolve_model(by_id[b], q)),
+        run(f"ModelIndex, no memo (x{legacy_rounds})", legacy_rounds, cold),
+        run(f"ModelIndex + memo (x{args.rounds})", args.rounds, p999.resolve_model_option_id),
+    ]
+    _print_rows(rows)
+    print(f"  построение индексов: {build_ms:.1f} мс на {len(top)} марок")
+    rules: Dict[str, int] = {}
+    changed = []
+    for brand, q in queries:
+        found = p999.match_model_option(brand, q)
+        rules[found.rule] = rules.get(found.rule, 0) + 1
+        old = _legacy_resolve_model(by_id[brand], q)
+        if old != found.option_id:
+            changed.append((q, found.title, found.rule))
+    # Правила обхода (exact/contains/contained/prefix/prefix4) и fallback обязаны совпадать; отличаться может только trigram
+    broken = [c for c in changed if c[2] != "trigram"]
+    print(f"  правила: {rules}")
+    print(f"  другой выбор, чем у линейного обхода: {len(changed)} из {len(queries)} (trigram вместо первой модели); примеры: {changed[:5]}")
+    if broken:
+        print(f"  РАСХОЖДЕНИЕ в правилах обхода: {len(broken)}; примеры: {broken[:5]}")
+    return rows
+
+
+# -----------------------------
+# car_data_from_raw: DecodePlan против разбора meta на каждую машину
+# -----------------------------
+def _synthetic_decode_data(n_cars: int) -> Dict[str, Any]:
+    """meta как у sp:1114 (iblock-поля марки/модели/кузова/двигателя/топлива, списки, ~150 прочих полей) и raw."""
+    rnd = random.Random(1114)
+    brands = [t.title() for t, _ in p999.get_feature_catalog().options(p999.BRAND_FEATURE_ID)[:40]]
+    iblocks = {
+        p999.RAW_FIELDS_MARCA: (30, "Marca", brands),
+        p999.RAW_FIELDS_MODEL: (32, "Model", [f"Model {i}" for i in range(300)]),
+        p999.RAW_FIELDS_BODY: (100, "Caroserie", ["Sedan", "Universal", "Hatchback", "SUV", "Minivan"]),
+        p999.RAW_FIELDS_ENGINE: (42, "Volumul motorului", ["1.4", "1.6", "2.0", "2.5", "3.0"]),
+        p999.RAW_FIELDS_FUEL: (36, "Tipul de combustibil", ["Motorina", "Benzina", "Hybrid"]),
+    }
+    enums = {
+        p999.RAW_FIELDS_YEAR: ("Anul producerii", {str(i): str(2005 + i) for i in range(20)}),
+        p999.RAW_FIELDS_DRIVE: ("Tracțiune", {"1": "Fata", "2": "Spate", "3": "4x4"}),
+        p999.RAW_FIELDS_TRANSMISSION: ("Transmisie", {"1": "Автомат", "2": "Механика", "3": "Робот"}),
+    }
+    meta: Dict[str, Dict[str, Any]] = {}
+    iblock_names: Dict[str, str] = {}
+
+    def add_meta(rk: str, b24_type: str, title: str, iblock_id: Optional[int] = None, enum_map: Optional[Dict] = None) -> None:
+        meta[p999._raw_key_to_column_name(rk).lower()] = {
+            "b24_field": rk, "b24_type": b24_type, "iblock_id": iblock_id, "iblock_type_id": "lists",
+            "b24_title": title, "enum_map": enum_map or {},
+        }
+
+    for i in range(150):
+        add_meta(f"ufCrm34_9{i:05d}", "enumeration" if i % 3 == 0 else "string", f"Поле {i}",
+                 enum_map={str(j): f"Вариант {j}" for j in range(8)} if i % 3 == 0 else None)
+    for rk, (iblock_id, title, names) in iblocks.items():
+        add_meta(rk, "iblock_element", title, iblock_id=iblock_id)
+        for eid, name in enumerate(names, start=1000):
+            iblock_names[f"{iblock_id}:{eid}"] = name
+    for rk, (title, enum_map) in enums.items():
+        add_meta(rk, "enumeration", title, enum_map=enum_map)
+    add_meta(p999.RAW_FIELDS_PRICE, "double", "Pret")
+    add_meta(p999.RAW_FIELDS_MILEAGE, "double", "Parcurs")
+    add_meta(p999.RAW_FIELDS_LINK, "url", "Link")
+    add_meta("ufCrm34_numar", "string", "Numar Auto")
+
+    raws = []
+    for n in range(n_cars):
+        raw: Dict[str, Any] = {"id": 100000 + n, "title": ""}
+        for i in range(150):
+            raw[f"ufCrm34_9{i:05d}"] = str(rnd.randint(0, 7)) if i % 3 == 0 else f"text {rnd.randint(0, 999)}"
+        for rk, (iblock_id, _, names) in iblocks.items():
+            raw[rk] = str(1000 + rnd.randrange(len(names)))
+        for rk, (_, enum_map) in enums.items():
+            raw[rk] = rnd.choice(list(enum_map))
+        raw[p999.RAW_FIELDS_PRICE] = f"{rnd.randint(3, 60) * 500}|EUR"
+        raw[p999.RAW_FIELDS_MILEAGE] = rnd.randint(10, 300) * 1000
+        raw[p999.RAW_FIELDS_LINK] = f"https://example.com/car/{n}"
+        raw["ufCrm34_numar"] = f"ABC {rnd.randint(100, 999)}"
+        raw[p999.PHOTO_RAW_KEY] = [{"urlMachine": f"https://bitrix.example/photo/{n}_{k}.jpg"} for k in range(8)]
+        raws.append(raw)
+    return {"meta": meta, "enum_cache": {}, "iblock_names": iblock_names, "raws": raws}
+
+
+def _record_decode_data(path: str, n_cars: int) -> None:
+    snap = p999.get_meta_snapshot()
+    conn = p999._pg_conn()
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT raw FROM {p999.DATA_TABLE_SP1114} ORDER BY (raw->>'id')::bigint DESC LIMIT %s", (n_cars,))
+        raws = [r[0] for r in cur.fetchall()]
+    conn.close()
+    plan = p999.DecodePlan(snap)
+    pairs: List[Tuple[int, int]] = []
+    types: Dict[int, Optional[str]] = {}
+    for raw in raws:
+        prs, tps = plan.iblock_pairs(raw)
+        pairs.extend(prs)
+        types.update(tps)
+    names = p999.resolve_iblock_names(sorted(set(pairs)), types) if pairs else {}
+    data = {
+        "meta": {k: asdict(mi) for k, mi in snap.meta.items()},
+        "enum_cache": {k: dict(v) for k, v in snap.enum_cache.items()},
+        "iblock_names": {f"{i}:{e}": n for (i, e), n in names.items()},
+        "raws": raws,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    print(f"  записано {len(raws)} raw, {len(data['meta'])} полей meta, {len(names)} имён iblock -> {path}")
+
+
+def bench_decode(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    if args.record:
+        _record_decode_data(args.record, args.cars)
+        return []
+    if args.raws:
+        with open(args.raws, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        source = args.raws
+    else:
+        data = _synthetic_decode_data(args.cars)
+        source = "синтетические raw"
+    # Снимок meta и имена iblock — из файла, без БД; проверка версии снимка отключена
+    snap = p999.MetaSnapshot(
+        meta=p999.MappingProxyType({k: p999.MetaInfo(**v) for k, v in data["meta"].items()}),
+        enum_cache=p999.MappingProxyType({k: p999.MappingProxyType(v) for k, v in data["enum_cache"].items()}),
+        version=("bench",),
+        loaded_at=time.time(),
+    )
+    p999._meta_snapshot = snap
+    p999._meta_snapshot_checked_at = float("inf")
+    iblock_names = {tuple(int(x) for x in k.split(":")): v for k, v in data["iblock_names"].items()}
+    p999.resolve_iblock_names = lambda pairs, types=None, wait_sec=None: {pr: iblock_names[pr] for pr in pairs if pr in iblock_names}
+    raws = data["raws"]
+    print(f"  {source}: машин {len(raws)}, полей meta {len(snap.meta)}")
+
+    def run(label: str, rounds: int, per_car: Callable[[], None]) -> Dict[str, Any]:
+        outs = []
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            outs = []
+            for raw in raws:
+                per_car()
+                outs.append(p999.car_data_from_raw(raw))
+        elapsed = time.perf_counter() - t0
+        n = rounds * len(raws)
+        run.outputs.append(outs)  # type: ignore[attr-defined]
+        return {"label": label, "cars": n, "seconds": round(elapsed, 4), "cars_per_sec": round(n / elapsed, 1)}
+
+    run.outputs = []  # type: ignore[attr-defined]
+
+    def drop_plan() -> None:
+        p999._decode_plan = None
+
+    rows = [
+        run(f"plan rebuilt per car (x{args.rounds})", args.rounds, drop_plan),
+        run(f"compiled DecodePlan (x{args.rounds})", args.rounds, lambda: None),
+    ]
+    _print_rows(rows)
+    same = run.outputs[0] == run.outputs[1]  # type: ignore[attr-defined]
+    print(f"  результаты совпадают: {same}")
+    return rows
+
+
+def _print_rows(rows: List[Dict[str, Any]]) -> None:
+    width = max(len(r["label"]) for r in rows)
+    keys = [k for k in rows[0] if k != "label"]
+    print(" " * width + "  " + "  ".join(f"{k:>12}" for k in keys))
+    for r in rows:
+        print(f"{r['label']:<{width}}  " + "  ".join(f"{r[k]:>12}" for k in keys))
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_http = sub.add_parser("http", help="пул соединений 999.md против голых requests")
+    p_http.add_argument("--images", type=int, default=10)
+    p_http.add_argument("--publishes", type=int, default=5)
+    p_http.add_argument("--sync", type=int, default=50)
+    p_http.add_argument("--handshake-ms", type=float, default=40.0)
+    p_http.add_argument("--rtt-ms", type=float, default=5.0)
+    p_http.set_defaults(func=bench_http)
+
+    p_feat = sub.add_parser("features", help="FeatureCatalog против json.load + обхода")
+    p_feat.add_argument("--rounds", type=int, default=2000)
+    p_feat.set_defaults(func=bench_features)
+
+    p_models = sub.add_parser("models", help="ModelIndex против линейного обхода моделей")
+    p_models.add_argument("--brands", type=int, default=10)
+    p_models.add_argument("--rounds", type=int, default=20)
+    p_models.add_argument("--tree", default="")
+    p_models.set_defaults(func=bench_models)
+
+    p_decode = sub.add_parser("decode", help="car_data_from_raw: машин/сек с DecodePlan")
+    p_decode.add_argument("--raws", default="", help="файл из --record")
+    p_decode.add_argument("--record", default="", help="сохранить meta и raw из БД в файл и выйти")
+    p_decode.add_argument("--cars", type=int, default=500)
+    p_decode.add_argument("--rounds", type=int, default=5)
+    p_decode.set_defaults(func=bench_decode)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -14,22 +14,32 @@ ID (iblock_element) расшифровываются через таблицу/
   API_999MD_TOKEN=... BITRIX_WEBHOOK=... PG_HOST=... PG_USER=... PG_PASS=... python publish_999md.py
 Или подключить router в существующий FastAPI: app.include_router(publish_999md.router).
 """
+import hashlib
 import os
+import random
 import re
+import select
+import socket
 import json
 import sys
 import traceback
 import unicodedata
 import urllib.parse
+from collections import OrderedDict
 from dataclasses import dataclass
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Set, Tuple
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field
@@ -46,7 +56,14 @@ PG_USER = os.getenv("PG_USER", "crm")
 PG_PASS = os.getenv("PG_PASS", "crm")
 
 
-def _pg_conn():
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))                    # соединений на процесс
+PG_POOL_MAX_LIFETIME_SEC = float(os.getenv("PG_POOL_MAX_LIFETIME_SEC", "1800"))  # старше — закрыть и открыть новое
+PG_POOL_HEALTHCHECK_IDLE_SEC = float(os.getenv("PG_POOL_HEALTHCHECK_IDLE_SEC", "30"))  # простаивало дольше — SELECT 1 перед выдачей
+PG_POOL_ACQUIRE_TIMEOUT_SEC = float(os.getenv("PG_POOL_ACQUIRE_TIMEOUT_SEC", "30"))
+
+
+def _pg_connect_direct():
+    """Отдельное соединение мимо пула (для долгоживущих потребителей, например LISTEN)."""
     return psycopg2.connect(
         host=PG_HOST,
         port=PG_PORT,
@@ -57,6 +74,201 @@ def _pg_conn():
     )
 
 
+class PooledPgConnection:
+    """Соединение из PgPool. Всё, кроме close(), уходит в psycopg2-соединение; close() возвращает его в пул.
+    Как контекстный менеджер: with _pg_conn() as conn — вернуть в пул на выходе (незавершённая транзакция откатывается)."""
+
+    __slots__ = ("_pool", "_conn", "_released")
+
+    def __init__(self, pool: "PgPool", conn: Any) -> None:
+        self._pool = pool
+        self._conn = conn
+        self._released = False
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._conn, name)
+
+    def close(self) -> None:
+        if not self._released:
+            self._released = True
+            self._pool.release(self._conn)
+
+    def __enter__(self) -> "PooledPgConnection":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def __del__(self) -> None:
+        # Страховка: соединение забыли вернуть (исключение до close()) — вернём при сборке мусора
+        if getattr(self, "_released", True) is False:
+            self._pool.count("leaked")
+            self.close()
+
+
+class PgPool:
+    """Пул соединений PostgreSQL на процесс: до max_size соединений, ожидание свободного не дольше
+    acquire_timeout_sec; перед выдачей — проверка (SELECT 1), если соединение простаивало дольше
+    healthcheck_idle_sec; соединения старше max_lifetime_sec закрываются и открываются заново. Потокобезопасен."""
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        max_size: int = 10,
+        max_lifetime_sec: float = 1800.0,
+        healthcheck_idle_sec: float = 30.0,
+        acquire_timeout_sec: float = 30.0,
+    ) -> None:
+        self._connect = connect
+        self.max_size = max(1, int(max_size))
+        self.max_lifetime_sec = max_lifetime_sec
+        self.healthcheck_idle_sec = healthcheck_idle_sec
+        self.acquire_timeout_sec = acquire_timeout_sec
+        self._cond = threading.Condition()
+        self._idle: List[Tuple[Any, float, float]] = []  # (conn, created_at, last_used), LIFO
+        self._created_at: Dict[int, float] = {}
+        self._size = 0
+        self._stats: Dict[str, float] = {
+            "acquired": 0, "created": 0, "recycled": 0, "health_failures": 0, "discarded": 0,
+            "timeouts": 0, "waits": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0, "leaked": 0,
+        }
+
+    def count(self, key: str, n: float = 1) -> None:
+        with self._cond:
+            self._stats[key] += n
+
+    def _open(self) -> Any:
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+            self._stats["created"] += 1
+        return conn
+
+    def _discard(self, conn: Any, reason: str) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._created_at.pop(id(conn), None)
+            self._stats[reason] += 1
+
+    def acquire(self) -> PooledPgConnection:
+        t0 = time.monotonic()
+        deadline = t0 + self.acquire_timeout_sec
+        with self._cond:
+            waited = False
+            while not self._idle and self._size >= self.max_size:
+                waited = True
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    self._stats["timeouts"] += 1
+                    raise psycopg2.OperationalError(
+                        f"PG pool: нет свободного соединения за {self.acquire_timeout_sec:.0f} с (max_size={self.max_size})"
+                    )
+                self._cond.wait(left)
+            if self._idle:
+                conn, created, last_used = self._idle.pop()
+            else:
+                conn, created, last_used = None, 0.0, 0.0
+                self._size += 1
+            wait_ms = (time.monotonic() - t0) * 1000
+            self._stats["acquired"] += 1
+            if waited:
+                self._stats["waits"] += 1
+                self._stats["wait_ms_total"] += wait_ms
+                self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+        if conn is not None:
+            now = time.monotonic()
+            if conn.closed or now - created > self.max_lifetime_sec:
+                self._discard(conn, "recycled" if not conn.closed else "discarded")
+                conn = None
+            elif now - last_used > self.healthcheck_idle_sec:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                    conn.rollback()
+                except Exception:
+                    self._discard(conn, "health_failures")
+                    conn = None
+        if conn is None:
+            conn = self._open()
+        return PooledPgConnection(self, conn)
+
+    def release(self, conn: Any) -> None:
+        keep = False
+        try:
+            created = self._created_at.get(id(conn), 0.0)
+            if not conn.closed and time.monotonic() - created <= self.max_lifetime_sec:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    keep = False
+                else:
+                    if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    if conn.autocommit:
+                        conn.autocommit = False
+                    keep = True
+        except Exception:
+            keep = False
+        if not keep:
+            self._discard(conn, "recycled" if not conn.closed else "discarded")
+        with self._cond:
+            if keep:
+                self._idle.append((conn, self._created_at.get(id(conn), 0.0), time.monotonic()))
+            else:
+                self._size -= 1
+            self._cond.notify()
+
+    def close_idle(self) -> int:
+        """Закрыть все простаивающие соединения (например, после смены PG_HOST или для теста)."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            self._discard(conn, "discarded")
+        return len(idle)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            out: Dict[str, Any] = dict(self._stats)
+            out.update(size=self._size, idle=len(self._idle), in_use=self._size - len(self._idle), max_size=self.max_size)
+        out["wait_ms_total"] = round(out["wait_ms_total"], 1)
+        out["wait_ms_max"] = round(out["wait_ms_max"], 1)
+        return out
+
+
+_pg_pool_instance: Optional[PgPool] = None
+_pg_pool_lock = threading.Lock()
+
+
+def _pg_pool() -> PgPool:
+    global _pg_pool_instance
+    if _pg_pool_instance is None:
+        with _pg_pool_lock:
+            if _pg_pool_instance is None:
+                _pg_pool_instance = PgPool(
+                    _pg_connect_direct,
+                    max_size=PG_POOL_MAX_SIZE,
+                    max_lifetime_sec=PG_POOL_MAX_LIFETIME_SEC,
+                    healthcheck_idle_sec=PG_POOL_HEALTHCHECK_IDLE_SEC,
+                    acquire_timeout_sec=PG_POOL_ACQUIRE_TIMEOUT_SEC,
+                )
+    return _pg_pool_instance
+
+
+def _pg_conn() -> PooledPgConnection:
+    """Соединение из пула. conn.close() возвращает его в пул; или with _pg_conn() as conn: ... — вернуть в конце блока."""
+    return _pg_pool().acquire()
+
+
 # Таблица и поля как в auto_send_tg (b24_sp_f_1114)
 DATA_TABLE_SP1114 = "public.b24_sp_f_1114"
 CATEGORY_ID_SP1114 = "111"
@@ -84,12 +296,40 @@ DRAFTS_DIR = Path(__file__).resolve().parent / "999md_drafts"
 
 # Авто-отправка на 999 (как в auto_send_tg): опрос БД раз в 10 мин, одна машина за раз, все поля заполнены, фото 5–10.
 AUTO_PUBLISH_999_ENABLED = True
-POLL_INTERVAL_999 = 600          # секунды (10 мин) — проверка машин раз в 10 минут, одна машина в 10 минут
+POLL_INTERVAL_999 = 600          # секунды (10 мин) — не чаще одной машины в 10 минут (и интервал опроса, если LISTEN недоступен)
+# Событийный запуск: триггер на b24_sp_f_1114 шлёт NOTIFY (миграция 9), петля просыпается сразу; опрос — только страховка.
+AUTO_PUBLISH_LISTEN_ENABLED = os.getenv("AUTO_PUBLISH_LISTEN_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+AUTO_PUBLISH_DEBOUNCE_SEC = float(os.getenv("AUTO_PUBLISH_DEBOUNCE_SEC", "5"))          # пачка NOTIFY от синка Bitrix -> одно пробуждение
+AUTO_PUBLISH_SAFETY_POLL_SEC = int(os.getenv("AUTO_PUBLISH_SAFETY_POLL_SEC", "3600"))  # страховочный опрос, пока LISTEN подключён
+NOTIFY_999_CHANNEL = "b24_999_items"
+AUTO_PUBLISH_BATCH = int(os.getenv("AUTO_PUBLISH_BATCH", "1"))  # сколько машин ставить в очередь за один интервал POLL_INTERVAL_999
+# Шаги публикации выполняет пул воркеров над PUBLISH_JOBS_TABLE (FOR UPDATE SKIP LOCKED), петля только ставит задачи.
+PUBLISH_JOB_WORKERS = int(os.getenv("PUBLISH_JOB_WORKERS", "2"))
+PUBLISH_JOB_LEASE_SEC = int(os.getenv("PUBLISH_JOB_LEASE_SEC", "900"))        # аренда задачи; продлевается на каждом шаге, после истечения задачу упавшего воркера берёт другой
+PUBLISH_JOB_MAX_ATTEMPTS = int(os.getenv("PUBLISH_JOB_MAX_ATTEMPTS", "5"))    # попыток до failed, пока объявления на 999 ещё нет
+PUBLISH_JOB_RETRY_BASE_SEC = 60     # пауза перед повтором: 60, 120, 240 ... с, не больше часа
+PUBLISH_JOB_POLL_SEC = 30           # воркеры без задач: опрос (повторы по next_attempt_at, задачи других реплик)
+PUBLISH_JOB_FAILED_COOLDOWN_SEC = 86400  # машину, у которой задача auto/retro в failed, авто-публикация не берёт сутки (ручные не в счёт)
+# Несколько реплик: задачи авто-публикации ставит только лидер (pg_try_advisory_lock), hide и sync по расписанию делятся
+# между живыми репликами по hash(item_id); машину в работе держит advisory-lock, чтобы её не обработали две реплики сразу.
+REPLICA_COORDINATION_ENABLED = os.getenv("REPLICA_COORDINATION_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+REPLICA_ID = os.getenv("REPLICA_ID", "").strip() or f"{socket.gethostname()}:{os.getpid()}"
+REPLICA_HEARTBEAT_SEC = int(os.getenv("REPLICA_HEARTBEAT_SEC", "15"))
+REPLICA_TTL_SEC = int(os.getenv("REPLICA_TTL_SEC", str(3 * REPLICA_HEARTBEAT_SEC)))  # без heartbeat дольше — реплика мертва, её шард делят живые
+REPLICA_LEADER_LOCK_KEY = 999025
+REPLICA_ITEM_LOCK_BASE = 999 << 32  # pg_advisory_lock(база + item_id) — захват машины; с ключами выше не пересекается
 SEND_WINDOW_START_HOUR = 0       # круглосуточно: с 00:00
 SEND_WINDOW_END_HOUR = 24        # круглосуточно: до 24:00 (не включая)
 # Синхронизация: в фоне подтягиваем данные из БД в объявления на 999 (цена, описание, фото и т.д.). PATCH /adverts/{id}.
 SYNC_999_MAX_PER_RUN = 500       # сколько объявлений обновить за один проход (все на 999, чтобы цена/описание из Битрикс подтягивались)
-SYNC_999_DELAY_BETWEEN_SEC = 2   # пауза между PATCH-запросами, чтобы не перегружать API
+SYNC_999_DELAY_BETWEEN_SEC = 2   # прежняя пауза между PATCH (один поток); от неё считается лимит по умолчанию: 1 / пауза = 0.5 PATCH/с, как было
+SYNC_999_CONCURRENCY = int(os.getenv("SYNC_999_CONCURRENCY", "4"))  # параллельных объявлений в проходе sync (фото, GET, PATCH)
+SYNC_999_RATE_PER_SEC = float(os.getenv("SYNC_999_RATE_PER_SEC", str(1.0 / SYNC_999_DELAY_BETWEEN_SEC)))  # общий лимит PATCH sync
+SYNC_999_RATE_BURST = float(os.getenv("SYNC_999_RATE_BURST", "2"))
+# Обновлять фото при синхронизации (неизменные фото берутся из кэша image_id). По умолчанию выключено, как было:
+# фича 14 уходит только если загрузились все фото, но и полный набор заменяет живые фото на 999.
+SYNC_999_UPDATE_PHOTOS = os.getenv("SYNC_999_UPDATE_PHOTOS", "0").strip().lower() in ("1", "true", "yes")
+SYNC_999_DECODE_BATCH = 50       # raw расшифровываются пачками (cars_data_from_raws): один resolve_iblock_names на пачку
 # eligible-all: скользящее окно — не более N машин за 60 минут (в памяти, разовая махинация).
 ELIGIBLE_ALL_MAX_PER_WINDOW = 2
 ELIGIBLE_ALL_WINDOW_SEC = 3600
@@ -114,6 +354,13 @@ _retro_auto_999_total_sent: int = 0
 _sync_999_last_run_slot: Optional[str] = None
 
 SENT_999_TABLE = "public.b24_999_sent_items"
+# Очередь кандидатов на 999: поддерживается триггерами на b24_sp_f_1114 и b24_999_sent_items (миграция 8).
+CANDIDATES_999_TABLE = "public.b24_999_candidates"
+# Очередь публикаций (миграция 12): одна строка на публикацию, пройденные шаги переживают рестарт процесса.
+PUBLISH_JOBS_TABLE = "public.b24_999_publish_jobs"
+PUBLISH_JOB_ACTIVE_SQL = "state NOT IN ('notified', 'failed')"  # то же условие, что в уникальном индексе миграции 12
+# Живые реплики (миграция 13): heartbeat раз в REPLICA_HEARTBEAT_SEC, по списку считается шард hide/sync.
+REPLICAS_TABLE = "public.b24_999_replicas"
 # Таблица отправленных в TG_AUTO (auto_send_tg). На 999 шлём ТОЛЬКО те машины, что уже есть в TG — одна логика публикации.
 SENT_TG_TABLE = "public.tg_sent_items"
 # === STRICT FILTER EXACTLY LIKE auto_send_tg.py ===
@@ -316,12 +563,17 @@ FUEL_LABEL_TO_RO: Dict[str, str] = {
 META_TABLE = "public.b24_meta_fields"
 ENTITY_KEY_SP1114 = "sp:1114"
 IBLOCK_CACHE_TABLE = "public.b24_iblock_elements"
+IBLOCK_TYPE_TABLE = "public.b24_iblock_types"  # какой IBLOCK_TYPE_ID сработал для iblock (выучено по ответам Bitrix)
+IBLOCK_NEGATIVE_TTL_SEC = int(os.getenv("IBLOCK_NEGATIVE_TTL_SEC", "3600"))  # элемент не найден — не спрашивать Bitrix столько
 ENUM_CACHE_TABLE = "public.b24_field_enum_cache"
 SMART_ENTITY_TYPE_ID = 1114
 IBLOCK_TYPE_ID_FALLBACK = "lists"
 IBLOCK_TYPE_ID_CANDIDATES = ["lists", "lists_socnet", "crm"]
 ENABLE_IBLOCK_API_LOOKUP = True
 ENABLE_ENUM_API_LOOKUP = True
+# Снимок meta + enum на процесс: без чтения БД на каждую машину
+META_SNAPSHOT_TTL_SEC = int(os.getenv("META_SNAPSHOT_TTL_SEC", "600"))         # перечитать целиком не реже
+META_SNAPSHOT_PROBE_SEC = float(os.getenv("META_SNAPSHOT_PROBE_SEC", "30"))    # проверка версии не чаще
 
 # Токен 999.md: env API_999MD_TOKEN или запасной (подставь свой)
 API_999MD_TOKEN_DEFAULT = os.getenv("API_999MD_TOKEN", "TreE0PnGG7MGZJUuxZUwDWN_UZNY")
@@ -344,9 +596,388 @@ def _auth() -> tuple:
     return (_token(), "")
 
 
+# -----------------------------
+# HTTP-клиент 999.md: один пул keep-alive соединений на процесс, таймауты, ретраи 429/5xx с джиттером
+# -----------------------------
+HTTP_999_POOL_SIZE = int(os.getenv("HTTP_999_POOL_SIZE", "10"))            # макс. соединений к partners-api.999.md
+HTTP_999_CONNECT_TIMEOUT = float(os.getenv("HTTP_999_CONNECT_TIMEOUT", "10"))
+HTTP_999_MAX_RETRIES = int(os.getenv("HTTP_999_MAX_RETRIES", "3"))         # повторов сверх первой попытки
+HTTP_999_BACKOFF_BASE_SEC = float(os.getenv("HTTP_999_BACKOFF_BASE_SEC", "0.5"))
+HTTP_999_BACKOFF_MAX_SEC = float(os.getenv("HTTP_999_BACKOFF_MAX_SEC", "10"))
+HTTP_BITRIX_POOL_SIZE = int(os.getenv("HTTP_BITRIX_POOL_SIZE", "4"))       # соединений к Bitrix24 REST (вебхук)
+BITRIX_BATCH_MAX_COMMANDS = 50   # лимит Bitrix24: команд в одном вызове batch
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Повтор при 5xx/обрыве только для идемпотентных методов: повторный POST /adverts создал бы дубль объявления.
+# 429 повторяем для любого метода — запрос отклонён до обработки.
+HTTP_IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "PATCH", "DELETE")
+
+
+class PooledHttpClient:
+    """Обёртка над requests.Session: пул соединений (keep-alive), таймаут (connect, read) на каждый вызов,
+    ретраи на 429/5xx с экспоненциальной паузой и джиттером (учитывает Retry-After). Потокобезопасна."""
+
+    def __init__(
+        self,
+        base_url: str = "",
+        pool_size: int = 10,
+        connect_timeout: float = 10.0,
+        max_retries: int = 3,
+        backoff_base_sec: float = 0.5,
+        backoff_max_sec: float = 10.0,
+        limiter_for: Optional[Callable[[str, str], Optional[str]]] = None,
+    ) -> None:
+        self.base_url = (base_url or "").rstrip("/")
+        # (method, url) -> имя лимита в реестре _upstream_limiter; каждая попытка берёт токен и сообщает статус ответа
+        self.limiter_for = limiter_for
+        self.connect_timeout = connect_timeout
+        self.max_retries = max(0, int(max_retries))
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max(1, int(pool_size)),
+            pool_maxsize=max(1, int(pool_size)),
+            max_retries=0,
+            pool_block=False,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, Any] = {"requests": 0, "retries": 0, "errors": 0, "by_status": {}}
+
+    def _url(self, path_or_url: str) -> str:
+        if path_or_url.startswith("http://") or path_or_url.startswith("https://"):
+            return path_or_url
+        return self.base_url + path_or_url
+
+    def _backoff_sec(self, attempt: int, resp: Optional[requests.Response] = None) -> float:
+        retry_after = _retry_after_sec(resp)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max_sec)
+        cap = min(self.backoff_max_sec, self.backoff_base_sec * (2 ** attempt))
+        # "equal jitter": половина паузы фиксирована, половина случайна — потоки не бьют в API синхронно
+        return cap / 2 + random.uniform(0, cap / 2)
+
+    def _count(self, key: str) -> None:
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _count_status(self, status: int) -> None:
+        with self._stats_lock:
+            by_status = self._stats["by_status"]
+            by_status[str(status)] = by_status.get(str(status), 0) + 1
+
+    def request(
+        self,
+        method: str,
+        path_or_url: str,
+        timeout: float = 30,
+        retry_unsafe: bool = False,
+        **kwargs: Any,
+    ) -> requests.Response:
+        """Выполнить запрос. Ответ с любым статусом возвращается как есть (проверку r.ok делает вызывающий);
+        исключения requests пробрасываются после исчерпания ретраев.
+        retry_unsafe=True — разрешить ретраи 5xx/обрывов и для неидемпотентного метода (например, POST /images)."""
+        method = method.upper()
+        url = self._url(path_or_url)
+        can_retry_5xx = retry_unsafe or method in HTTP_IDEMPOTENT_METHODS
+        limiter_name = self.limiter_for(method, url) if self.limiter_for else None
+        limiter = _upstream_limiter(limiter_name) if limiter_name else None
+        attempt = 0
+        while True:
+            self._count("requests")
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                resp = self.session.request(method, url, timeout=(self.connect_timeout, timeout), **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._count("errors")
+                if limiter is not None:
+                    limiter.record(None)
+                if attempt >= self.max_retries or not can_retry_5xx:
+                    raise
+                time.sleep(self._backoff_sec(attempt))
+                attempt += 1
+                self._count("retries")
+                continue
+            self._count_status(resp.status_code)
+            if limiter is not None:
+                limiter.record(resp.status_code, _retry_after_sec(resp))
+            retryable = resp.status_code == 429 or (resp.status_code in HTTP_RETRY_STATUSES and can_retry_5xx)
+            if not retryable or attempt >= self.max_retries:
+                return resp
+            pause = self._backoff_sec(attempt, resp)
+            print(
+                f"WARN: HTTP {resp.status_code} {method} {url[:120]} — повтор {attempt + 1}/{self.max_retries} через {pause:.1f} с",
+                file=sys.stderr,
+                flush=True,
+            )
+            resp.close()
+            time.sleep(pause)
+            attempt += 1
+            self._count("retries")
+
+    def get(self, path_or_url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", path_or_url, **kwargs)
+
+    def post(self, path_or_url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", path_or_url, **kwargs)
+
+    def patch(self, path_or_url: str, **kwargs: Any) -> requests.Response:
+        return self.request("PATCH", path_or_url, **kwargs)
+
+    def put(self, path_or_url: str, **kwargs: Any) -> requests.Response:
+        return self.request("PUT", path_or_url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            out = dict(self._stats)
+            out["by_status"] = dict(self._stats["by_status"])
+            return out
+
+
+_http_999_client: Optional[PooledHttpClient] = None
+_http_999_client_lock = threading.Lock()
+
+
+def _http_999() -> PooledHttpClient:
+    """Общий клиент 999.md на процесс (ленивое создание)."""
+    global _http_999_client
+    if _http_999_client is None:
+        with _http_999_client_lock:
+            if _http_999_client is None:
+                _http_999_client = PooledHttpClient(
+                    base_url=API_BASE,
+                    pool_size=HTTP_999_POOL_SIZE,
+                    connect_timeout=HTTP_999_CONNECT_TIMEOUT,
+                    max_retries=HTTP_999_MAX_RETRIES,
+                    backoff_base_sec=HTTP_999_BACKOFF_BASE_SEC,
+                    backoff_max_sec=HTTP_999_BACKOFF_MAX_SEC,
+                    limiter_for=_limiter_name_999,
+                )
+    return _http_999_client
+
+
+_http_bitrix_client: Optional[PooledHttpClient] = None
+_http_bitrix_client_lock = threading.Lock()
+
+
+def _http_bitrix() -> PooledHttpClient:
+    """Общий клиент Bitrix24 REST на процесс (пул keep-alive к nobilauto.bitrix24.ru)."""
+    global _http_bitrix_client
+    if _http_bitrix_client is None:
+        with _http_bitrix_client_lock:
+            if _http_bitrix_client is None:
+                _http_bitrix_client = PooledHttpClient(
+                    base_url=_bitrix_webhook(),
+                    pool_size=HTTP_BITRIX_POOL_SIZE,
+                    connect_timeout=HTTP_999_CONNECT_TIMEOUT,
+                    max_retries=HTTP_999_MAX_RETRIES,
+                    backoff_base_sec=HTTP_999_BACKOFF_BASE_SEC,
+                    backoff_max_sec=HTTP_999_BACKOFF_MAX_SEC,
+                    limiter_for=lambda method, url: "bitrix.rest",
+                )
+    return _http_bitrix_client
+
+
+class TokenBucket:
+    """Токен-бакет: rate_per_sec токенов в секунду, в запасе не больше burst. acquire() ждёт токен. Потокобезопасен."""
+
+    def __init__(self, rate_per_sec: float, burst: float = 1.0) -> None:
+        self.rate_per_sec = max(0.001, float(rate_per_sec))
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate_per_sec)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1.0, timeout: Optional[float] = None) -> bool:
+        """Забрать токены; False — если не дождались за timeout секунд."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate_per_sec
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+    def set_rate(self, rate_per_sec: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate_per_sec = max(0.001, float(rate_per_sec))
+
+
+# -----------------------------
+# Лимиты внешних API: один именованный бакет на апстрим / класс эндпоинтов
+# -----------------------------
+# имя -> (запросов в секунду, burst). Переопределение: UPSTREAM_RATE_LIMITS="999.write=1/2,bitrix.rest=1/20"
+UPSTREAM_LIMITS_DEFAULT: Dict[str, Tuple[float, float]] = {
+    "999.read": (5.0, 10.0),       # GET /adverts, /features, dependent options
+    "999.write": (2.0, 4.0),       # POST/PATCH/PUT /adverts...
+    "999.images": (3.0, 6.0),      # POST /images
+    "999.sync": (SYNC_999_RATE_PER_SEC, SYNC_999_RATE_BURST),  # доля PATCH прохода sync внутри 999.write — публикации хватает
+    "bitrix.rest": (2.0, 50.0),    # вебхук Bitrix24: 2 запроса/с, запас 50
+    "bitrix.files": (4.0, 8.0),    # скачивание фото машин с Bitrix
+    "telegram": (1.0, 3.0),        # уведомления в один чат
+}
+UPSTREAM_RATE_LIMITS = os.getenv("UPSTREAM_RATE_LIMITS", "").strip()
+UPSTREAM_MIN_RATE_FRACTION = float(os.getenv("UPSTREAM_MIN_RATE_FRACTION", "0.1"))  # ниже этой доли номинала скорость не снижаем
+UPSTREAM_RECOVER_AFTER = int(os.getenv("UPSTREAM_RECOVER_AFTER", "20"))  # успешных ответов подряд до шага +10% к скорости
+UPSTREAM_RETRY_AFTER_MAX_SEC = 300.0
+
+
+def _retry_after_sec(resp: Optional[requests.Response]) -> Optional[float]:
+    """Retry-After в секундах (число или HTTP-дата); None — заголовка нет или он непонятен."""
+    if resp is None:
+        return None
+    value = (resp.headers.get("Retry-After") or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+class UpstreamLimiter:
+    """Именованный лимит апстрима: токен-бакет + общая пауза по Retry-After + AIMD по ответам:
+    429/5xx/обрыв — скорость ×0.5 (не чаще раза в секунду, не ниже UPSTREAM_MIN_RATE_FRACTION номинала),
+    UPSTREAM_RECOVER_AFTER успешных ответов подряд — +10% номинала. Потокобезопасен."""
+
+    def __init__(self, name: str, rate_per_sec: float, burst: float) -> None:
+        self.name = name
+        self.nominal_rate = max(0.001, float(rate_per_sec))
+        self.min_rate = self.nominal_rate * max(0.01, min(1.0, UPSTREAM_MIN_RATE_FRACTION))
+        self.bucket = TokenBucket(self.nominal_rate, burst)
+        self._lock = threading.Lock()
+        self._blocked_until = 0.0
+        self._ok_streak = 0
+        self._last_decrease = 0.0
+        self._stats: Dict[str, Any] = {
+            "acquired": 0, "timeouts": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+            "throttled": 0, "errors": 0, "rate_decreases": 0, "rate_increases": 0,
+        }
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        t0 = time.monotonic()
+        deadline = None if timeout is None else t0 + timeout
+        while True:
+            with self._lock:
+                pause = self._blocked_until - time.monotonic()
+            if pause <= 0:
+                break
+            if deadline is not None and time.monotonic() + pause > deadline:
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                return False
+            time.sleep(min(pause, 1.0))
+        ok = self.bucket.acquire(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+        waited_ms = (time.monotonic() - t0) * 1000
+        with self._lock:
+            self._stats["acquired" if ok else "timeouts"] += 1
+            self._stats["wait_ms_total"] += waited_ms
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited_ms)
+        return ok
+
+    def record(self, status: Optional[int], retry_after_sec: Optional[float] = None) -> None:
+        """Результат запроса: HTTP-статус или None (обрыв/таймаут)."""
+        now = time.monotonic()
+        with self._lock:
+            if status is None or status == 429 or status >= 500:
+                self._stats["throttled" if status in (429, 503) else "errors"] += 1
+                self._ok_streak = 0
+                if retry_after_sec is not None and status in (429, 503):
+                    self._blocked_until = max(self._blocked_until, now + min(retry_after_sec, UPSTREAM_RETRY_AFTER_MAX_SEC))
+                if now - self._last_decrease >= 1.0 and self.bucket.rate_per_sec > self.min_rate:
+                    self.bucket.set_rate(max(self.min_rate, self.bucket.rate_per_sec * 0.5))
+                    self._last_decrease = now
+                    self._stats["rate_decreases"] += 1
+            elif status < 400:
+                self._ok_streak += 1
+                if self._ok_streak >= UPSTREAM_RECOVER_AFTER and self.bucket.rate_per_sec < self.nominal_rate:
+                    self.bucket.set_rate(min(self.nominal_rate, self.bucket.rate_per_sec + self.nominal_rate * 0.1))
+                    self._ok_streak = 0
+                    self._stats["rate_increases"] += 1
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            out = dict(self._stats)
+            blocked = self._blocked_until - time.monotonic()
+        out["wait_ms_total"] = round(out["wait_ms_total"], 1)
+        out["wait_ms_max"] = round(out["wait_ms_max"], 1)
+        out["nominal_rate"] = self.nominal_rate
+        out["rate"] = round(self.bucket.rate_per_sec, 3)
+        out["burst"] = self.bucket.burst
+        out["blocked_for_sec"] = round(blocked, 1) if blocked > 0 else 0
+        return out
+
+
+def _parse_upstream_overrides(spec: str) -> Dict[str, Tuple[float, float]]:
+    out: Dict[str, Tuple[float, float]] = {}
+    for part in (spec or "").split(","):
+        name, _, value = part.partition("=")
+        rate, _, burst = value.partition("/")
+        try:
+            out[name.strip()] = (float(rate), float(burst) if burst.strip() else max(1.0, float(rate)))
+        except ValueError:
+            if part.strip():
+                print(f"WARN UPSTREAM_RATE_LIMITS: не понял '{part.strip()}'", file=sys.stderr, flush=True)
+    return out
+
+
+_upstream_limits = {**UPSTREAM_LIMITS_DEFAULT, **_parse_upstream_overrides(UPSTREAM_RATE_LIMITS)}
+_upstream_limiters: Dict[str, UpstreamLimiter] = {}
+_upstream_limiters_lock = threading.Lock()
+
+
+def _upstream_limiter(name: str) -> UpstreamLimiter:
+    """Лимит по имени из реестра (создаётся при первом обращении; неизвестное имя — 1 запрос/с)."""
+    lim = _upstream_limiters.get(name)
+    if lim is None:
+        with _upstream_limiters_lock:
+            lim = _upstream_limiters.get(name)
+            if lim is None:
+                rate, burst = _upstream_limits.get(name, (1.0, 1.0))
+                lim = _upstream_limiters[name] = UpstreamLimiter(name, rate, burst)
+    return lim
+
+
+def _limited_request(name: str, send: Callable[[], requests.Response]) -> requests.Response:
+    """Запрос мимо PooledHttpClient (фото с Bitrix, Telegram) через лимит name."""
+    lim = _upstream_limiter(name)
+    lim.acquire()
+    try:
+        resp = send()
+    except (requests.ConnectionError, requests.Timeout):
+        lim.record(None)
+        raise
+    lim.record(resp.status_code, _retry_after_sec(resp))
+    return resp
+
+
+def _limiter_name_999(method: str, url: str) -> str:
+    if urllib.parse.urlparse(url).path.startswith("/images"):
+        return "999.images"
+    return "999.read" if method in ("GET", "HEAD") else "999.write"
+
+
+def get_upstream_limits_status() -> Dict[str, Any]:
+    names = sorted(set(_upstream_limits) | set(_upstream_limiters))
+    return {name: _upstream_limiter(name).status() for name in names}
+
+
 def _get(path: str, params: Optional[Dict] = None) -> Dict[str, Any]:
-    url = API_BASE + path
-    r = requests.get(url, auth=_auth(), params=params or {}, timeout=30)
+    r = _http_999().get(path, auth=_auth(), params=params or {}, timeout=30)
     r.raise_for_status()
     return r.json()
 
@@ -362,51 +993,162 @@ def get_features_from_api(lang: str = "ru") -> Dict[str, Any]:
     })
 
 
+class Api999Error(RuntimeError):
+    """Ответ 999 с ошибкой: код и тело (JSON или начало текста) — чтобы разбирать причину не по строке сообщения."""
+
+    def __init__(self, message: str, status_code: int, body: Any) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
 def _post_json(path: str, data: Dict[str, Any], params: Optional[Dict[str, str]] = None, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
-    url = API_BASE + path
-    r = requests.post(url, auth=_auth(), json=data, params=params or {}, headers=headers or {}, timeout=60)
+    r = _http_999().post(path, auth=_auth(), json=data, params=params or {}, headers=headers or {}, timeout=60)
     if not r.ok:
         try:
             err_body = r.json()
         except Exception:
             err_body = r.text[:1000]
-        raise RuntimeError(
-            f"999.md API {r.status_code}: {err_body}"
-        )
+        raise Api999Error(f"999.md API {r.status_code}: {err_body}", r.status_code, err_body)
     return r.json()
 
 
 def _patch_json(path: str, data: Dict[str, Any]) -> Dict[str, Any]:
-    url = API_BASE + path
-    r = requests.patch(url, auth=_auth(), json=data, timeout=60)
+    r = _http_999().patch(path, auth=_auth(), json=data, timeout=60)
     if not r.ok:
         try:
             err_body = r.json()
         except Exception:
             err_body = r.text[:500]
-        raise RuntimeError(f"999.md API PATCH {r.status_code}: {err_body}")
+        raise Api999Error(f"999.md API PATCH {r.status_code}: {err_body}", r.status_code, err_body)
     return r.json()
 
 
-def _load_features_json() -> Dict[str, Any]:
-    """Фичи для подкатегории 659 (легковые). Сначала из API, если USE_999_FEATURES_API=1 и токен есть."""
-    if os.getenv("USE_999_FEATURES_API", "").strip().lower() in ("1", "true", "yes") and _token():
+FEATURES_JSON_PATH = Path(__file__).resolve().parent / "999md_features_cars_sell.json"
+USE_999_FEATURES_API = os.getenv("USE_999_FEATURES_API", "").strip().lower() in ("1", "true", "yes")
+# При USE_999_FEATURES_API=1 каталог строится из GET /features и перечитывается не чаще, чем раз в N секунд.
+FEATURE_CATALOG_API_TTL_SEC = int(os.getenv("FEATURE_CATALOG_API_TTL_SEC", "3600"))
+FEATURE_CATALOG_MEMO_MAX = 4096
+FEATURE_CATALOG_STAT_INTERVAL_SEC = 2.0   # как часто проверять mtime файла (stat не на каждый вызов)
+
+
+class FeatureCatalog:
+    """Фичи 999 (ответ GET /features) с индексами: feature_id -> фича, (feature_id, title) -> option id,
+    подготовленный список (title, option id) для поиска по подстроке. Строится один раз на версию файла."""
+
+    def __init__(self, data: Dict[str, Any], source: str = "", mtime: Optional[float] = None) -> None:
+        self.data = data
+        self.source = source
+        self.mtime = mtime
+        self.loaded_at = time.time()
+        self.checked_at = self.loaded_at
+        self.features: Dict[str, Dict[str, Any]] = {}
+        self._exact: Dict[Tuple[str, str], str] = {}
+        self._nospace: Dict[Tuple[str, str], str] = {}
+        self._options: Dict[str, List[Tuple[str, str]]] = {}
+        self._memo: Dict[Tuple[str, str], Optional[str]] = {}
+        for grp in data.get("features_groups", []) or []:
+            for feat in grp.get("features", []) or []:
+                fid = str(feat.get("id"))
+                self.features.setdefault(fid, feat)
+                prepared = self._options.setdefault(fid, [])
+                for opt in feat.get("options") or []:
+                    t = (opt.get("title") or "").strip().lower()
+                    if not t:
+                        continue
+                    oid = str(opt.get("id"))
+                    prepared.append((t, oid))
+                    self._exact.setdefault((fid, t), oid)
+                    self._nospace.setdefault((fid, t.replace(" ", "")), oid)
+
+    def feature(self, feature_id: str) -> Optional[Dict[str, Any]]:
+        return self.features.get(str(feature_id))
+
+    def options(self, feature_id: str) -> List[Tuple[str, str]]:
+        """[(title в нижнем регистре, option id)] в порядке API."""
+        return self._options.get(str(feature_id), [])
+
+    def find_option(self, feature_id: str, title_normalize: str) -> Optional[str]:
+        """Option id по title: точное совпадение, совпадение без пробелов, затем подстрока в любую сторону."""
+        title_norm = (title_normalize or "").strip().lower()
+        if not title_norm:
+            return None
+        fid = str(feature_id)
+        key = (fid, title_norm)
+        if key in self._memo:
+            return self._memo[key]
+        found = self._exact.get(key) or self._nospace.get((fid, title_norm.replace(" ", "")))
+        if not found:
+            for t, oid in self._options.get(fid, ()):
+                if title_norm in t or t in title_norm:
+                    found = oid
+                    break
+        if len(self._memo) >= FEATURE_CATALOG_MEMO_MAX:
+            self._memo.clear()
+        self._memo[key] = found
+        return found
+
+
+_feature_catalog: Optional[FeatureCatalog] = None
+_feature_catalog_lock = threading.Lock()
+
+
+def _use_features_api() -> bool:
+    return USE_999_FEATURES_API and bool(_token())
+
+
+def get_feature_catalog() -> FeatureCatalog:
+    """Каталог фич на процесс. Перестраивается, если изменился mtime файла (или истёк TTL при USE_999_FEATURES_API)."""
+    global _feature_catalog
+    cat = _feature_catalog
+    use_api = _use_features_api()
+    if use_api:
+        if cat is not None and cat.source == "api" and time.time() - cat.loaded_at < FEATURE_CATALOG_API_TTL_SEC:
+            return cat
+    else:
+        now = time.time()
+        if cat is not None and cat.source == "file" and now - cat.checked_at < FEATURE_CATALOG_STAT_INTERVAL_SEC:
+            return cat
         try:
-            return get_features_from_api(lang=LANG)
-        except Exception:
-            pass
-    p = Path(__file__).resolve().parent / "999md_features_cars_sell.json"
-    if not p.exists():
-        raise FileNotFoundError(
-            f"999md_features_cars_sell.json not found: {p}. "
-            "Вызови POST /api/publish-999md/features-from-999/save чтобы скачать фичи с 999.md."
-        )
-    with open(p, "r", encoding="utf-8") as f:
-        return json.load(f)
+            mtime = FEATURES_JSON_PATH.stat().st_mtime
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                f"999md_features_cars_sell.json not found: {FEATURES_JSON_PATH}. "
+                "Вызови POST /api/publish-999md/features-from-999/save чтобы скачать фичи с 999.md."
+            )
+        if cat is not None and cat.source == "file" and cat.mtime == mtime:
+            cat.checked_at = now
+            return cat
+    with _feature_catalog_lock:
+        if _feature_catalog is not None and _feature_catalog is not cat:
+            return _feature_catalog  # другой поток уже перестроил
+        if use_api:
+            try:
+                _feature_catalog = FeatureCatalog(get_features_from_api(lang=LANG), source="api")
+                return _feature_catalog
+            except Exception:
+                pass
+        mtime = FEATURES_JSON_PATH.stat().st_mtime
+        with open(FEATURES_JSON_PATH, "r", encoding="utf-8") as f:
+            _feature_catalog = FeatureCatalog(json.load(f), source="file", mtime=mtime)
+        return _feature_catalog
 
 
-def _find_feature_option(features_data: Dict, feature_id: str, title_normalize: str) -> Optional[str]:
-    """Ищем option id по title в фиче (например Марка 20)."""
+def invalidate_feature_catalog() -> None:
+    """Сбросить каталог (после POST /features-from-999/save) — следующий вызов перечитает файл."""
+    global _feature_catalog
+    with _feature_catalog_lock:
+        _feature_catalog = None
+
+
+def _load_features_json() -> Dict[str, Any]:
+    """Фичи для подкатегории 659 (легковые). Сначала из API, если USE_999_FEATURES_API=1 и токен есть.
+    Данные общие для процесса (FeatureCatalog) — не изменять."""
+    return get_feature_catalog().data
+
+
+def _scan_feature_option(features_data: Dict, feature_id: str, title_normalize: str) -> Optional[str]:
+    """Поиск option id полным обходом features_data (для произвольного dict, не из каталога)."""
     title_norm = (title_normalize or "").strip().lower()
     if not title_norm:
         return None
@@ -423,15 +1165,116 @@ def _find_feature_option(features_data: Dict, feature_id: str, title_normalize:
     return None
 
 
-def get_dependent_options(dependency_feature_id: str, parent_option_id: str) -> List[Dict]:
-    """
-    Опции, зависящие от родителя. Для моделей: dependency_feature_id=21 (модель), parent=id марки.
-    """
+def _find_feature_option(features_data: Dict, feature_id: str, title_normalize: str) -> Optional[str]:
+    """Ищем option id по title в фиче (например Марка 20)."""
+    cat = _feature_catalog
+    if cat is not None and features_data is cat.data:
+        return cat.find_option(feature_id, title_normalize)
+    return _scan_feature_option(features_data, feature_id, title_normalize)
+
+
+# -----------------------------
+# Кэш GET /dependent_options (модели марки, поколения модели): LRU в памяти + таблица в PG с TTL
+# -----------------------------
+DEPENDENT_OPTIONS_CACHE_TABLE = "public.b24_999_dependent_options_cache"
+DEPENDENT_OPTIONS_CACHE_TTL_SEC = int(os.getenv("DEPENDENT_OPTIONS_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+DEPENDENT_OPTIONS_LRU_MAX = int(os.getenv("DEPENDENT_OPTIONS_LRU_MAX", "2048"))
+DependentOptionsKey = Tuple[str, str, str, str]  # (subcategory_id, dependency_feature_id, parent_option_id, lang)
+_dep_options_lru: "OrderedDict[DependentOptionsKey, Tuple[float, List[Dict]]]" = OrderedDict()
+_dep_options_lock = threading.Lock()
+_dep_options_stats: Dict[str, int] = {"lru_hits": 0, "tree_hits": 0, "db_hits": 0, "api_fetches": 0}
+
+
+def _dep_options_count(key: str) -> None:
+    with _dep_options_lock:
+        _dep_options_stats[key] += 1
+
+
+def _dep_options_lru_get(key: DependentOptionsKey) -> Optional[List[Dict]]:
+    with _dep_options_lock:
+        hit = _dep_options_lru.get(key)
+        if hit is None:
+            return None
+        fetched_at, options = hit
+        if time.time() - fetched_at >= DEPENDENT_OPTIONS_CACHE_TTL_SEC:
+            del _dep_options_lru[key]
+            return None
+        _dep_options_lru.move_to_end(key)
+        _dep_options_stats["lru_hits"] += 1
+        return options
+
+
+def _dep_options_lru_put(key: DependentOptionsKey, options: List[Dict], fetched_at: Optional[float] = None) -> None:
+    with _dep_options_lock:
+        _dep_options_lru[key] = (fetched_at if fetched_at is not None else time.time(), options)
+        _dep_options_lru.move_to_end(key)
+        while len(_dep_options_lru) > max(1, DEPENDENT_OPTIONS_LRU_MAX):
+            _dep_options_lru.popitem(last=False)
+
+
+def _dep_options_db_get(key: DependentOptionsKey) -> Optional[Tuple[float, List[Dict]]]:
+    conn = None
+    try:
+        conn = _pg_conn()
+        _ensure_schema(conn)
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""SELECT options, extract(epoch FROM fetched_at)
+                    FROM {DEPENDENT_OPTIONS_CACHE_TABLE}
+                    WHERE subcategory_id = %s AND dependency_feature_id = %s AND parent_option_id = %s AND lang = %s
+                      AND fetched_at > now() - make_interval(secs => %s)""",
+                (*key, DEPENDENT_OPTIONS_CACHE_TTL_SEC),
+            )
+            row = cur.fetchone()
+        if row and isinstance(row[0], list) and row[0]:
+            return (float(row[1]), row[0])
+    except Exception as e:
+        print(f"WARN _dep_options_db_get: {e}", file=sys.stderr, flush=True)
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    return None
+
+
+def _dep_options_db_put(rows: List[Tuple[DependentOptionsKey, List[Dict]]]) -> None:
+    if not rows:
+        return
+    conn = None
+    try:
+        conn = _pg_conn()
+        _ensure_schema(conn)
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur,
+                f"""INSERT INTO {DEPENDENT_OPTIONS_CACHE_TABLE}
+                        (subcategory_id, dependency_feature_id, parent_option_id, lang, options)
+                    VALUES %s
+                    ON CONFLICT (subcategory_id, dependency_feature_id, parent_option_id, lang)
+                    DO UPDATE SET options = EXCLUDED.options, fetched_at = now()""",
+                [(*key, psycopg2.extras.Json(options)) for key, options in rows],
+            )
+        conn.commit()
+    except Exception as e:
+        print(f"WARN _dep_options_db_put: {e}", file=sys.stderr, flush=True)
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def _fetch_dependent_options(dependency_feature_id: str, parent_option_id: str, lang: str = LANG) -> List[Dict]:
+    """GET /dependent_options без кэша."""
+    _dep_options_count("api_fetches")
     data = _get("/dependent_options", params={
         "subcategory_id": SUBCATEGORY_ID,
         "dependency_feature_id": dependency_feature_id,
         "parent_option_id": parent_option_id,
-        "lang": LANG,
+        "lang": lang,
     })
     options = data.get("options") or data.get("Options") or data.get("dependent_options") or data.get("items")
     if isinstance(options, list):
@@ -439,96 +1282,584 @@ def get_dependent_options(dependency_feature_id: str, parent_option_id: str) ->
     return []
 
 
-def resolve_brand_option_id(marca: str, features_data: Optional[Dict] = None) -> Optional[str]:
-    """Марка из нашей БД -> option id 999 (фича 20)."""
-    if not marca or not str(marca).strip():
-        return None
-    data = features_data or _load_features_json()
-    for raw in (marca.strip(), marca.strip().split()[0] if marca.strip() else ""):
-        if not raw:
-            continue
-        opt_id = _find_feature_option(data, "20", raw)
-        if opt_id:
-            return opt_id
-    return _find_feature_option(data, "20", marca)
+def get_dependent_options(dependency_feature_id: str, parent_option_id: str) -> List[Dict]:
+    """
+    Опции, зависящие от родителя. Для моделей: dependency_feature_id=21 (модель), parent=id марки.
+    Сначала LRU в памяти, потом дерево моделей (crawl_options_tree, без сети),
+    потом DEPENDENT_OPTIONS_CACHE_TABLE (TTL DEPENDENT_OPTIONS_CACHE_TTL_SEC), потом API.
+    Пустой список не кэшируется: это и ответ неожиданной формы (_fetch_dependent_options), и его не стоит держать неделю.
+    """
+    key: DependentOptionsKey = (str(SUBCATEGORY_ID), str(dependency_feature_id), str(parent_option_id), LANG)
+    options = _dep_options_lru_get(key)
+    if options is not None:
+        return options
+    options = _options_tree_get(key[1], key[2])
+    if options is not None:
+        _dep_options_count("tree_hits")
+        # Возраст ветки — возраст дерева: TTL в LRU считается от сборки, а не от чтения
+        tree = _load_options_tree() or {}
+        age = _options_tree_branch_age_sec(tree, key[1], key[2]) if tree else None
+        _dep_options_lru_put(key, options, fetched_at=time.time() - (age or 0.0))
+        return options
+    from_db = _dep_options_db_get(key)
+    if from_db is not None:
+        _dep_options_count("db_hits")
+        _dep_options_lru_put(key, from_db[1], fetched_at=from_db[0])
+        return from_db[1]
+    options = _fetch_dependent_options(str(dependency_feature_id), str(parent_option_id))
+    if options:
+        _dep_options_lru_put(key, options)
+        _dep_options_db_put([(key, options)])
+    return options
 
 
-def _normalize_for_match(s: str) -> str:
-    """Нижний регистр, без пробелов, без диакритики (Scénic -> scenic)."""
-    if not s:
-        return ""
-    s = (s or "").strip().lower().replace(" ", "")
-    nfd = unicodedata.normalize("NFD", s)
-    return "".join(c for c in nfd if unicodedata.category(c) != "Mn")
+def invalidate_dependent_options_cache(
+    dependency_feature_id: Optional[str] = None,
+    parent_option_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Сбросить кэш dependent_options (весь или по dependency_feature_id / parent_option_id) в памяти и в PG."""
+    def _match(key: DependentOptionsKey) -> bool:
+        return (
+            (dependency_feature_id is None or key[1] == str(dependency_feature_id))
+            and (parent_option_id is None or key[2] == str(parent_option_id))
+        )
 
+    with _dep_options_lock:
+        lru_keys = [k for k in _dep_options_lru if _match(k)]
+        for k in lru_keys:
+            del _dep_options_lru[k]
+    db_deleted = 0
+    conn = None
+    try:
+        conn = _pg_conn()
+        _ensure_schema(conn)
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""DELETE FROM {DEPENDENT_OPTIONS_CACHE_TABLE}
+                    WHERE (%s::text IS NULL OR dependency_feature_id = %s::text)
+                      AND (%s::text IS NULL OR parent_option_id = %s::text)""",
+                (dependency_feature_id, dependency_feature_id, parent_option_id, parent_option_id),
+            )
+            db_deleted = cur.rowcount
+        conn.commit()
+    except Exception as e:
+        print(f"WARN invalidate_dependent_options_cache: {e}", file=sys.stderr, flush=True)
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    tree_deleted = _options_tree_forget(dependency_feature_id, parent_option_id)
+    return {"lru_deleted": len(lru_keys), "db_deleted": db_deleted, "tree_deleted": tree_deleted}
 
-def resolve_model_option_id(brand_option_id: str, model: str) -> Optional[str]:
-    """Модель из БД -> option id 999. C Class не должен матчиться с CLA (строгое сравнение)."""
-    if not model or not str(model).strip():
-        return None
-    options = get_dependent_options("20", brand_option_id)
-    model_norm = _normalize_for_match(model)
-    model_first = model_norm[:4] if len(model_norm) >= 4 else model_norm
-    for opt in options:
-        raw_t = (opt.get("title") or opt.get("value") or "").strip()
-        t_norm = _normalize_for_match(raw_t)
-        if not t_norm:
-            continue
-        # Точное совпадение — приоритет
-        if model_norm == t_norm:
-            return str(opt.get("id"))
-        # Наша модель — подстрока опции (C Class в C Class Coupe)
-        if model_norm in t_norm:
-            return str(opt.get("id"))
-        # Опция — подстрока нашей модели только если длина близка (не CLA в C Class)
-        if t_norm in model_norm:
-            if len(t_norm) >= len(model_norm) - 1:
-                return str(opt.get("id"))
-            continue
-        if model_norm.startswith(t_norm) or t_norm.startswith(model_norm):
-            if len(t_norm) >= 3 and len(model_norm) >= 3 and abs(len(t_norm) - len(model_norm)) <= 2:
-                return str(opt.get("id"))
-        if model_first and len(model_first) >= 4 and t_norm.startswith(model_first):
-            return str(opt.get("id"))
-    if options:
-        return str(options[0].get("id"))
-    return None
 
+def get_dependent_options_cache_status() -> Dict[str, Any]:
+    with _dep_options_lock:
+        return {
+            "lru_size": len(_dep_options_lru),
+            "lru_max": DEPENDENT_OPTIONS_LRU_MAX,
+            "ttl_sec": DEPENDENT_OPTIONS_CACHE_TTL_SEC,
+            **_dep_options_stats,
+        }
 
-def resolve_generation_option_id(model_option_id: str) -> Optional[str]:
-    """Поколение (2095) зависит от модели (21)."""
-    options = get_dependent_options("21", model_option_id)
-    if options:
-        return str(options[0].get("id"))
-    return None
 
+# -----------------------------
+# Дерево марка -> модели -> поколения 999 целиком (прогрев кэша): фоновый обход, локальный файл с версией
+# -----------------------------
+OPTIONS_TREE_PATH = Path(__file__).resolve().parent / "999md_options_tree.json"
+OPTIONS_TREE_PREWARM_ENABLED = os.getenv("OPTIONS_TREE_PREWARM_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+OPTIONS_TREE_REFRESH_SEC = int(os.getenv("OPTIONS_TREE_REFRESH_SEC", str(24 * 3600)))  # пересобирать раз в сутки
+OPTIONS_TREE_CONCURRENCY = int(os.getenv("OPTIONS_TREE_CONCURRENCY", "4"))            # параллельных запросов
+OPTIONS_TREE_RATE_PER_SEC = float(os.getenv("OPTIONS_TREE_RATE_PER_SEC", "5"))        # не чаще N запросов/сек к 999
+OPTIONS_TREE_MAX_ERROR_RATIO = float(os.getenv("OPTIONS_TREE_MAX_ERROR_RATIO", "0.2"))  # больше ошибок — дерево не пишем, повтор через 10 мин
+OPTIONS_TREE_RETRY_SEC = 600
+BRAND_FEATURE_ID = "20"
+MODEL_FEATURE_ID = "21"
+# Ключ dependency_feature_id в /dependent_options — id родительской фичи (как в resolve_*_option_id).
+# {"version", "built_at", "lang", "options": {"20": {brand: [...]}, "21": {model: [...]}},
+#  "fetched_at": {"20": {brand: unix-время скачивания ветки}, ...}} — ветки, унаследованные от прошлой сборки, сохраняют своё время
+_options_tree: Optional[Dict[str, Any]] = None
+_options_tree_loaded = False
+_options_tree_lock = threading.Lock()
+_options_tree_status: Dict[str, Any] = {"state": "idle"}
+_options_tree_thread: Optional[threading.Thread] = None
+
+
+def _load_options_tree() -> Optional[Dict[str, Any]]:
+    """Дерево из памяти; при первом обращении — из OPTIONS_TREE_PATH (если есть)."""
+    global _options_tree, _options_tree_loaded
+    if _options_tree_loaded:
+        return _options_tree
+    with _options_tree_lock:
+        if not _options_tree_loaded:
+            try:
+                if OPTIONS_TREE_PATH.exists():
+                    with open(OPTIONS_TREE_PATH, "r", encoding="utf-8") as f:
+                        tree = json.load(f)
+                    if isinstance(tree, dict) and tree.get("lang") == LANG and isinstance(tree.get("options"), dict):
+                        _options_tree = tree
+            except Exception as e:
+                print(f"WARN _load_options_tree: {e}", file=sys.stderr, flush=True)
+            _options_tree_loaded = True
+    return _options_tree
 
-def upload_image(file_path: str) -> str:
-    """Загрузить файл на 999, вернуть image_id."""
-    url = API_BASE + "/images"
-    with open(file_path, "rb") as f:
-        files = {"file": (Path(file_path).name, f, "image/jpeg")}
-        r = requests.post(url, auth=_auth(), files=files, timeout=60)
-    r.raise_for_status()
-    data = r.json()
-    image_id = data.get("image_id")
-    if not image_id:
-        raise ValueError("No image_id in response: " + str(data))
-    return image_id
 
+def _options_tree_get(dependency_feature_id: str, parent_option_id: str) -> Optional[List[Dict]]:
+    """Ветка дерева; ветка старше DEPENDENT_OPTIONS_CACHE_TTL_SEC (или без времени скачивания) не используется — как устаревший кэш."""
+    tree = _load_options_tree()
+    if not tree:
+        return None
+    age = _options_tree_branch_age_sec(tree, str(dependency_feature_id), str(parent_option_id))
+    if age is None or age >= DEPENDENT_OPTIONS_CACHE_TTL_SEC:
+        return None
+    by_parent = tree["options"].get(str(dependency_feature_id))
+    if not isinstance(by_parent, dict):
+        return None
+    options = by_parent.get(str(parent_option_id))
+    return options if isinstance(options, list) and options else None
+
+
+def _options_tree_branch_age_sec(tree: Dict[str, Any], dep: str, parent: str) -> Optional[float]:
+    """Возраст ветки: по fetched_at ветки, для файлов без него — по built_at дерева."""
+    fetched = (tree.get("fetched_at") or {}).get(dep, {}).get(parent)
+    if isinstance(fetched, (int, float)):
+        return time.time() - fetched
+    return _options_tree_age_sec()
+
+
+def _write_options_tree_file(tree: Dict[str, Any]) -> None:
+    """Записать дерево в OPTIONS_TREE_PATH атомарно (tmp + os.replace)."""
+    tmp = OPTIONS_TREE_PATH.with_suffix(".json.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(tree, f, ensure_ascii=False)
+    os.replace(tmp, OPTIONS_TREE_PATH)
+
+
+def _options_tree_forget(dependency_feature_id: Optional[str], parent_option_id: Optional[str]) -> int:
+    """Убрать ветки из дерева (при ручном сбросе кэша dependent_options): в памяти и в OPTIONS_TREE_PATH с новой версией,
+    иначе после рестарта файл снова отдал бы сброшенные ветки."""
+    tree = _load_options_tree()
+    if not tree:
+        return 0
+    removed = 0
+    with _options_tree_lock:
+        for dep, by_parent in tree["options"].items():
+            if dependency_feature_id is not None and dep != str(dependency_feature_id):
+                continue
+            for parent in [p for p in by_parent if parent_option_id is None or p == str(parent_option_id)]:
+                del by_parent[parent]
+                (tree.get("fetched_at") or {}).get(dep, {}).pop(parent, None)
+                removed += 1
+        if removed:
+            tree["version"] = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+            tree["invalidated_at"] = datetime.now(timezone.utc).isoformat()
+            snapshot = json.loads(json.dumps(tree))
+    if removed:
+        try:
+            _write_options_tree_file(snapshot)
+        except Exception as e:
+            # Файл со сброшенными ветками нельзя оставлять: при рестарте он вернул бы их
+            print(f"WARN _options_tree_forget: не удалось перезаписать {OPTIONS_TREE_PATH}: {e}; удаляю файл", file=sys.stderr, flush=True)
+            try:
+                OPTIONS_TREE_PATH.unlink()
+            except FileNotFoundError:
+                pass
+    return removed
 
-def upload_image_from_url(image_url: str) -> str:
-    """Скачать по URL и загрузить на 999, вернуть image_id."""
-    resp = requests.get(image_url, timeout=30)
-    resp.raise_for_status()
-    url = API_BASE + "/images"
+
+def _set_options_tree_status(**kwargs: Any) -> None:
+    with _options_tree_lock:
+        _options_tree_status.update(kwargs)
+
+
+def crawl_options_tree() -> Dict[str, Any]:
+    """Обойти все марки фичи 20 из FeatureCatalog: модели каждой марки, затем поколения каждой модели.
+    Параллельно (OPTIONS_TREE_CONCURRENCY) и не чаще OPTIONS_TREE_RATE_PER_SEC запросов/сек.
+    Результат — в память, в OPTIONS_TREE_PATH (с версией) и в кэш dependent_options (LRU + PG).
+    Без токена, без марок или с долей ошибок больше OPTIONS_TREE_MAX_ERROR_RATIO — исключение, дерево не пишется
+    (петля повторит через OPTIONS_TREE_RETRY_SEC, а не через сутки)."""
+    if not _token():
+        raise RuntimeError("нет токена 999 — обход дерева отложен")
+    brands = [oid for _, oid in get_feature_catalog().options(BRAND_FEATURE_ID)]
+    if not brands:
+        raise RuntimeError("в каталоге фич нет марок (фича 20) — обход дерева отложен")
+    bucket = TokenBucket(OPTIONS_TREE_RATE_PER_SEC, burst=max(1, OPTIONS_TREE_CONCURRENCY))
+    started = time.time()
+    _set_options_tree_status(
+        state="running", started_at=datetime.now(timezone.utc).isoformat(), finished_at=None,
+        brands_total=len(brands), brands_done=0, models_total=0, models_done=0,
+        requests=0, errors=0, last_error=None, elapsed_sec=0.0,
+    )
+    options: Dict[str, Dict[str, List[Dict]]] = {BRAND_FEATURE_ID: {}, MODEL_FEATURE_ID: {}}
+
+    def fetch(dep: str, parent: str) -> Tuple[str, str, Optional[List[Dict]]]:
+        bucket.acquire()
+        try:
+            result = _fetch_dependent_options(dep, parent)
+        except Exception as e:
+            with _options_tree_lock:
+                _options_tree_status["errors"] += 1
+                _options_tree_status["last_error"] = f"{dep}:{parent}: {e}"[:300]
+            result = None
+        with _options_tree_lock:
+            _options_tree_status["requests"] += 1
+            _options_tree_status["brands_done" if dep == BRAND_FEATURE_ID else "models_done"] += 1
+            _options_tree_status["elapsed_sec"] = round(time.time() - started, 1)
+        return dep, parent, result
+
+    with ThreadPoolExecutor(max_workers=max(1, OPTIONS_TREE_CONCURRENCY), thread_name_prefix="tree999") as pool:
+        model_ids: List[str] = []
+        for dep, parent, models in pool.map(lambda b: fetch(BRAND_FEATURE_ID, b), brands):
+            if not models:  # ошибка или пустой список — ветку не пишем (пустые не кэшируются, см. get_dependent_options)
+                continue
+            options[dep][parent] = models
+            model_ids.extend(str(m.get("id")) for m in models if m.get("id") is not None)
+        _set_options_tree_status(models_total=len(model_ids))
+        for dep, parent, generations in pool.map(lambda m: fetch(MODEL_FEATURE_ID, m), model_ids):
+            if generations:
+                options[dep][parent] = generations
+
+    with _options_tree_lock:
+        requests_made, errors = _options_tree_status["requests"], _options_tree_status["errors"]
+    if not options[BRAND_FEATURE_ID] or (requests_made and errors / requests_made > OPTIONS_TREE_MAX_ERROR_RATIO):
+        raise RuntimeError(f"обход дерева: ошибок {errors} из {requests_made} запросов — дерево не обновлено")
+
+    now = time.time()
+    fetched_at: Dict[str, Dict[str, float]] = {dep: {parent: now for parent in by_parent} for dep, by_parent in options.items()}
+    fresh = [(dep, parent) for dep, by_parent in options.items() for parent in by_parent]
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    tree = {
+        "version": version,
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "subcategory_id": SUBCATEGORY_ID,
+        "lang": LANG,
+        "options": options,
+        "fetched_at": fetched_at,
+    }
+    previous = _load_options_tree()
+    if previous:
+        # Ветки, которые в этот раз не скачались (ошибка), берём из прошлой версии — со своим временем скачивания,
+        # чтобы они истекали по DEPENDENT_OPTIONS_CACHE_TTL_SEC, а не жили вечно
+        for dep, by_parent in previous.get("options", {}).items():
+            for parent, opts in by_parent.items():
+                if parent in options.setdefault(dep, {}) or not opts:
+                    continue
+                age = _options_tree_branch_age_sec(previous, dep, parent)
+                if age is None or age >= DEPENDENT_OPTIONS_CACHE_TTL_SEC:
+                    continue
+                options[dep][parent] = opts
+                fetched_at.setdefault(dep, {})[parent] = now - age
+    _write_options_tree_file(tree)
+    global _options_tree, _options_tree_loaded
+    with _options_tree_lock:
+        _options_tree = tree
+        _options_tree_loaded = True
+    rows: List[Tuple[DependentOptionsKey, List[Dict]]] = []
+    for dep, parent in fresh:  # унаследованные ветки в LRU/PG не обновляем: их время скачивания старое
+        opts = options[dep][parent]
+        key: DependentOptionsKey = (str(SUBCATEGORY_ID), dep, parent, LANG)
+        _dep_options_lru_put(key, opts)
+        rows.append((key, opts))
+    for i in range(0, len(rows), 500):
+        _dep_options_db_put(rows[i:i + 500])
+    _set_options_tree_status(
+        state="done", finished_at=datetime.now(timezone.utc).isoformat(),
+        elapsed_sec=round(time.time() - started, 1), version=version,
+        brands=len(options[BRAND_FEATURE_ID]), models=len(options[MODEL_FEATURE_ID]),
+    )
+    print(
+        f"TREE_999: дерево моделей собрано version={version}: марок {len(options[BRAND_FEATURE_ID])}, "
+        f"моделей {len(options[MODEL_FEATURE_ID])}, за {time.time() - started:.0f} с",
+        flush=True,
+    )
+    return get_options_tree_status()
+
+
+def get_options_tree_status() -> Dict[str, Any]:
+    tree = _load_options_tree()
+    with _options_tree_lock:
+        out = dict(_options_tree_status)
+    out["running"] = bool(_options_tree_thread and _options_tree_thread.is_alive() and out.get("state") == "running")
+    out["tree_version"] = tree.get("version") if tree else None
+    out["tree_built_at"] = tree.get("built_at") if tree else None
+    return out
+
+
+def _options_tree_age_sec() -> Optional[float]:
+    tree = _load_options_tree()
+    if not tree or not tree.get("built_at"):
+        return None
+    try:
+        return (datetime.now(timezone.utc) - datetime.fromisoformat(tree["built_at"])).total_seconds()
+    except Exception:
+        return None
+
+
+def _options_tree_loop() -> None:
+    """Прогрев при старте (если дерева нет или оно старше OPTIONS_TREE_REFRESH_SEC), затем раз в OPTIONS_TREE_REFRESH_SEC."""
+    while True:
+        try:
+            age = _options_tree_age_sec()
+            if age is None or age >= OPTIONS_TREE_REFRESH_SEC:
+                crawl_options_tree()
+                age = 0.0
+            time.sleep(max(60.0, OPTIONS_TREE_REFRESH_SEC - age))
+        except Exception as e:
+            _set_options_tree_status(state="error", last_error=str(e)[:300])
+            print(f"TREE_999: ошибка обхода дерева моделей: {e}", file=sys.stderr, flush=True)
+            time.sleep(OPTIONS_TREE_RETRY_SEC)
+
+
+def _crawl_options_tree_once() -> None:
+    """Разовый обход из API: ошибка — в статус (иначе он так и остался бы running)."""
+    try:
+        crawl_options_tree()
+    except Exception as e:
+        _set_options_tree_status(state="error", last_error=str(e)[:300])
+        print(f"TREE_999: ошибка обхода дерева моделей: {e}", file=sys.stderr, flush=True)
+
+
+def start_options_tree_prewarm_thread(force: bool = False) -> Dict[str, Any]:
+    """Запустить фоновый прогрев дерева (при старте сервиса) или разовый обход (force=True, из API)."""
+    global _options_tree_thread
+    with _options_tree_lock:
+        if _options_tree_thread and _options_tree_thread.is_alive():
+            if not force or _options_tree_status.get("state") == "running":
+                return {"started": False, "message": "обход уже идёт или запланирован"}
+        if force:
+            _options_tree_thread = threading.Thread(target=_crawl_options_tree_once, daemon=True)
+        else:
+            if not OPTIONS_TREE_PREWARM_ENABLED:
+                return {"started": False, "message": "OPTIONS_TREE_PREWARM_ENABLED=0"}
+            _options_tree_thread = threading.Thread(target=_options_tree_loop, daemon=True)
+        _options_tree_thread.start()
+    return {"started": True}
+
+
+def resolve_brand_option_id(marca: str, features_data: Optional[Dict] = None) -> Optional[str]:
+    """Марка из нашей БД -> option id 999 (фича 20)."""
+    if not marca or not str(marca).strip():
+        return None
+    data = features_data or _load_features_json()
+    for raw in (marca.strip(), marca.strip().split()[0] if marca.strip() else ""):
+        if not raw:
+            continue
+        opt_id = _find_feature_option(data, "20", raw)
+        if opt_id:
+            return opt_id
+    return _find_feature_option(data, "20", marca)
+
+
+def _normalize_for_match(s: str) -> str:
+    """Нижний регистр, без пробелов, без диакритики (Scénic -> scenic)."""
+    if not s:
+        return ""
+    s = (s or "").strip().lower().replace(" ", "")
+    nfd = unicodedata.normalize("NFD", s)
+    return "".join(c for c in nfd if unicodedata.category(c) != "Mn")
+
+
+def _trigrams(s: str) -> Set[str]:
+    return {s[i:i + 3] for i in range(len(s) - 2)} or ({s} if s else set())
+
+
+MODEL_INDEX_CACHE_MAX = 512        # марок в памяти (индексы моделей)
+MODEL_MATCH_MEMO_MAX = 2048        # запомненных строк модели на марку
+# Нечёткий (триграммный) выбор — только если правила линейного обхода ничего не нашли и сходство не ниже порога;
+# иначе как раньше: первая модель марки.
+MODEL_MATCH_MIN_TRIGRAM = float(os.getenv("MODEL_MATCH_MIN_TRIGRAM", "0.6"))
+
+
+@dataclass
+class ModelMatch:
+    """Выбранная опция модели 999: score — уверенность 0..1, rule — каким правилом найдена."""
+    option_id: str
+    title: str
+    score: float
+    rule: str
+
+
+class ModelIndex:
+    """Модели одной марки (ответ dependent_options по фиче 20) с индексами: точное нормализованное название,
+    корзины по длине, триграммы -> позиции. match() выбирает то же, что прежний линейный обход (первая в порядке API
+    опция, подошедшая по точному совпадению, подстроке или префиксу), но проверяет только кандидатов с общими
+    триграммами. Если правила ничего не нашли — самая похожая по триграммам при сходстве от MODEL_MATCH_MIN_TRIGRAM,
+    иначе первая модель марки."""
+
+    def __init__(self, options: List[Dict]) -> None:
+        self.options = options
+        self.entries: List[Tuple[str, str, str, Set[str]]] = []  # (option id, title, norm, trigrams)
+        self._exact: Dict[str, int] = {}
+        self._by_len: Dict[int, List[int]] = {}
+        self._postings: Dict[str, List[int]] = {}
+        self._memo: Dict[str, Optional[ModelMatch]] = {}
+        for opt in options:
+            raw_t = (opt.get("title") or opt.get("value") or "").strip()
+            norm = _normalize_for_match(raw_t)
+            if not norm:
+                continue
+            i = len(self.entries)
+            grams = _trigrams(norm)
+            self.entries.append((str(opt.get("id")), raw_t, norm, grams))
+            self._exact.setdefault(norm, i)
+            self._by_len.setdefault(len(norm), []).append(i)
+            for g in grams:
+                self._postings.setdefault(g, []).append(i)
+
+    def _candidates(self, model_norm: str, grams: Set[str]) -> Set[int]:
+        """Все позиции, которые могут подойти по правилам: подстрока/префикс от 3 символов делит с моделью триграмму."""
+        if len(model_norm) < 3:
+            return set(range(len(self.entries)))
+        found: Set[int] = set()
+        for g in grams:
+            found.update(self._postings.get(g, ()))
+        for n in (1, 2):  # короткие названия не дают триграмм
+            found.update(self._by_len.get(n, ()))
+        return found
+
+    @staticmethod
+    def _rule(model_norm: str, norm: str) -> str:
+        """Правила прежнего линейного обхода, в том же порядке; "" — опция не подходит."""
+        if model_norm == norm:
+            return "exact"
+        # Наша модель — подстрока опции (C Class в C Class Coupe)
+        if model_norm in norm:
+            return "contains"
+        # Опция — подстрока нашей модели только если длина близка (не CLA в C Class)
+        if norm in model_norm:
+            return "contained" if len(norm) >= len(model_norm) - 1 else ""
+        lm, lt = len(model_norm), len(norm)
+        if (model_norm.startswith(norm) or norm.startswith(model_norm)) and lt >= 3 and lm >= 3 and abs(lt - lm) <= 2:
+            return "prefix"
+        if lm >= 4 and norm.startswith(model_norm[:4]):
+            return "prefix4"
+        return ""
+
+    @staticmethod
+    def _rule_score(rule: str, model_norm: str, norm: str) -> float:
+        ratio = min(len(model_norm), len(norm)) / max(len(model_norm), len(norm))
+        if rule == "exact":
+            return 1.0
+        if rule in ("contains", "contained"):
+            return 0.8 + 0.1 * ratio
+        if rule == "prefix":
+            return 0.6 + 0.1 * ratio
+        return 0.5 + 0.1 * ratio
+
+    def _fuzzy(self, grams: Set[str], candidates: Set[int]) -> Optional[Tuple[float, int]]:
+        """Лучшее сходство триграмм (Jaccard) от MODEL_MATCH_MIN_TRIGRAM; при равенстве — первая в порядке API."""
+        best: Optional[Tuple[float, int]] = None
+        for i in sorted(candidates):
+            t_grams = self.entries[i][3]
+            jaccard = len(grams & t_grams) / len(grams | t_grams)
+            if jaccard >= MODEL_MATCH_MIN_TRIGRAM and (best is None or jaccard > best[0]):
+                best = (jaccard, i)
+        return best
+
+    def match(self, model: str) -> Optional[ModelMatch]:
+        model_norm = _normalize_for_match(model)
+        if not model_norm or not self.entries:
+            return None
+        if model_norm in self._memo:
+            return self._memo[model_norm]
+        grams = _trigrams(model_norm)
+        candidates = self._candidates(model_norm, grams)
+        # Точное совпадение не важнее подстроки у опции раньше по списку (как в линейном обходе): дальше него не смотрим
+        exact_at = self._exact.get(model_norm)
+        found: Optional[ModelMatch] = None
+        for i in sorted(candidates):
+            if exact_at is not None and i > exact_at:
+                break
+            oid, title, norm, _ = self.entries[i]
+            rule = self._rule(model_norm, norm)
+            if rule:
+                found = ModelMatch(oid, title, round(self._rule_score(rule, model_norm, norm), 3), rule)
+                break
+        if found is None:
+            fuzzy = self._fuzzy(grams, candidates)
+            if fuzzy is not None:
+                oid, title, _, _ = self.entries[fuzzy[1]]
+                found = ModelMatch(oid, title, round(0.45 * fuzzy[0], 3), "trigram")
+            else:
+                # Как раньше: без совпадений берём первую модель марки, но с нулевой уверенностью
+                first = self.options[0]
+                found = ModelMatch(str(first.get("id")), (first.get("title") or first.get("value") or "").strip(), 0.0, "fallback")
+        if found.score < 0.5:
+            print(
+                f"WARN match_model_option: {model!r} -> {found.title!r} ({found.option_id}) rule={found.rule} score={found.score}",
+                file=sys.stderr,
+                flush=True,
+            )
+        if len(self._memo) >= MODEL_MATCH_MEMO_MAX:
+            self._memo.clear()
+        self._memo[model_norm] = found
+        return found
+
+
+_model_indexes: "OrderedDict[str, ModelIndex]" = OrderedDict()
+_model_indexes_lock = threading.Lock()
+
+
+def _get_model_index(brand_option_id: str) -> ModelIndex:
+    """Индекс моделей марки; пересобирается, когда get_dependent_options отдаёт другой список."""
+    options = get_dependent_options(BRAND_FEATURE_ID, brand_option_id)
+    key = str(brand_option_id)
+    with _model_indexes_lock:
+        index = _model_indexes.get(key)
+        if index is not None and index.options is options:
+            _model_indexes.move_to_end(key)
+            return index
+    index = ModelIndex(options)
+    with _model_indexes_lock:
+        _model_indexes[key] = index
+        _model_indexes.move_to_end(key)
+        while len(_model_indexes) > MODEL_INDEX_CACHE_MAX:
+            _model_indexes.popitem(last=False)
+    return index
+
+
+def match_model_option(brand_option_id: str, model: str) -> Optional[ModelMatch]:
+    """Лучшая модель 999 для строки модели из БД, с уверенностью. Результат кэшируется на (марка, модель)."""
+    if not model or not str(model).strip():
+        return None
+    return _get_model_index(brand_option_id).match(str(model))
+
+
+def resolve_model_option_id(brand_option_id: str, model: str) -> Optional[str]:
+    """Модель из БД -> option id 999. C Class не должен матчиться с CLA (строгое сравнение)."""
+    found = match_model_option(brand_option_id, model)
+    return found.option_id if found else None
+
+
+def resolve_generation_option_id(model_option_id: str) -> Optional[str]:
+    """Поколение (2095) зависит от модели (21)."""
+    options = get_dependent_options("21", model_option_id)
+    if options:
+        return str(options[0].get("id"))
+    return None
+
+
+def upload_image(file_path: str) -> str:
+    """Загрузить файл на 999, вернуть image_id."""
+    with open(file_path, "rb") as f:
+        content = f.read()
+    return _upload_image_content(Path(file_path).name, content)
+
+
+def _image_name_from_url(image_url: str) -> str:
     name = "image.jpg"
     if "?" in image_url:
         name = image_url.split("?")[0].split("/")[-1] or name
     else:
         name = image_url.split("/")[-1] or name
-    files = {"file": (name, resp.content, "image/jpeg")}
-    r = requests.post(url, auth=_auth(), files=files, timeout=60)
+    return name
+
+
+def _upload_image_content(name: str, content: bytes) -> str:
+    """Загрузить байты картинки на 999 (POST /images), вернуть image_id. Ошибки пробрасываются."""
+    with _photo_999_semaphore:
+        r = _http_999().post("/images", auth=_auth(), files={"file": (name, content, "image/jpeg")}, timeout=60, retry_unsafe=True)
     r.raise_for_status()
     data = r.json()
     image_id = data.get("image_id")
@@ -537,13 +1868,28 @@ def upload_image_from_url(image_url: str) -> str:
     return image_id
 
 
+def _download_image_strict(image_url: str) -> bytes:
+    """Скачать картинку по URL (как раньше в upload_image_from_url): любая ошибка — исключение."""
+    with _photo_bitrix_semaphore:
+        resp = _limited_request("bitrix.files", lambda: requests.get(image_url, timeout=30))
+    resp.raise_for_status()
+    return resp.content
+
+
+def upload_image_from_url(image_url: str) -> str:
+    """Скачать по URL и загрузить на 999, вернуть image_id."""
+    content = _download_image_strict(image_url)
+    return _upload_image_content(_image_name_from_url(image_url), content)
+
+
 def _download_image_content(image_url: str) -> Tuple[Optional[bytes], Optional[int]]:
     """
     Скачать картинку по URL. Если URL — Bitrix REST getFile и вернул JSON с result (ссылка) — качаем по ней.
     Возвращает (content, None) при успехе, (None, status_code) при 401/403, (None, None) при иной ошибке.
     """
     try:
-        resp = requests.get(image_url, timeout=30, allow_redirects=True)
+        with _photo_bitrix_semaphore:
+            resp = _limited_request("bitrix.files", lambda: requests.get(image_url, timeout=30, allow_redirects=True))
         if resp.status_code in (401, 403):
             return (None, resp.status_code)
         resp.raise_for_status()
@@ -554,7 +1900,8 @@ def _download_image_content(image_url: str) -> Tuple[Optional[bytes], Optional[i
             if isinstance(data, dict):
                 url = data.get("result") or data.get("url") or (data.get("result", {}).get("url") if isinstance(data.get("result"), dict) else None)
             if isinstance(url, str) and url.startswith("http"):
-                r2 = requests.get(url, timeout=30, allow_redirects=True)
+                with _photo_bitrix_semaphore:
+                    r2 = _limited_request("bitrix.files", lambda: requests.get(url, timeout=30, allow_redirects=True))
                 if r2.status_code in (401, 403):
                     return (None, r2.status_code)
                 r2.raise_for_status()
@@ -565,25 +1912,10 @@ def _download_image_content(image_url: str) -> Tuple[Optional[bytes], Optional[i
         return (None, None)
 
 
-def upload_image_from_url_optional(image_url: str) -> Tuple[Optional[str], Optional[int]]:
-    """Скачать по URL и загрузить на 999. При 401/403 пропустить фото. Возвращает (image_id или None, status_code при 401/403)."""
-    content, failed_code = _download_image_content(image_url)
-    if not content:
-        if failed_code:
-            print(f"WARN: skip photo (Bitrix {failed_code}): {image_url[:100]}...", file=sys.stderr, flush=True)
-        else:
-            print(f"WARN: skip photo (empty or error): {image_url[:80]}...", file=sys.stderr, flush=True)
-        return (None, failed_code)
-    name = "image.jpg"
-    if "?" in image_url:
-        name = image_url.split("?")[0].split("/")[-1] or name
-    else:
-        name = image_url.split("/")[-1] or name
+def _upload_downloaded_image_optional(image_url: str, content: bytes) -> Optional[str]:
+    """Загрузка на 999 уже скачанного фото; при ошибке — WARN в лог и None (фото пропускаем)."""
     try:
-        r = requests.post(API_BASE + "/images", auth=_auth(), files={"file": (name, content, "image/jpeg")}, timeout=60)
-        r.raise_for_status()
-        image_id = r.json().get("image_id")
-        return (image_id if image_id else None, None)
+        return _upload_image_content(_image_name_from_url(image_url), content)
     except Exception as e:
         if isinstance(e, requests.HTTPError) and getattr(e, "response", None) is not None:
             resp = e.response
@@ -597,7 +1929,332 @@ def upload_image_from_url_optional(image_url: str) -> Tuple[Optional[str], Optio
             )
         else:
             print(f"WARN: skip photo (upload to 999 failed): {e}", file=sys.stderr, flush=True)
-        return (None, None)
+        return None
+
+
+def upload_image_from_url_optional(image_url: str) -> Tuple[Optional[str], Optional[int]]:
+    """Скачать по URL и загрузить на 999. При 401/403 пропустить фото. Возвращает (image_id или None, status_code при 401/403)."""
+    content, failed_code = _download_image_content(image_url)
+    if not content:
+        if failed_code:
+            print(f"WARN: skip photo (Bitrix {failed_code}): {image_url[:100]}...", file=sys.stderr, flush=True)
+        else:
+            print(f"WARN: skip photo (empty or error): {image_url[:80]}...", file=sys.stderr, flush=True)
+        return (None, failed_code)
+    return (_upload_downloaded_image_optional(image_url, content), None)
+
+
+# -----------------------------
+# Параллельная загрузка фото: Bitrix (скачать) -> 999 (POST /images), порядок фото сохраняется
+# -----------------------------
+PHOTO_PIPELINE_WORKERS = int(os.getenv("PHOTO_PIPELINE_WORKERS", "6"))            # ширина пула (фото одновременно)
+PHOTO_BITRIX_MAX_CONCURRENCY = int(os.getenv("PHOTO_BITRIX_MAX_CONCURRENCY", "4"))  # одновременных скачиваний с Bitrix
+PHOTO_999_MAX_CONCURRENCY = int(os.getenv("PHOTO_999_MAX_CONCURRENCY", "4"))        # одновременных POST /images на 999
+_photo_bitrix_semaphore = threading.BoundedSemaphore(max(1, PHOTO_BITRIX_MAX_CONCURRENCY))
+_photo_999_semaphore = threading.BoundedSemaphore(max(1, PHOTO_999_MAX_CONCURRENCY))
+_photo_executor: Optional[ThreadPoolExecutor] = None
+_photo_executor_lock = threading.Lock()
+
+
+def _photo_pool() -> ThreadPoolExecutor:
+    global _photo_executor
+    if _photo_executor is None:
+        with _photo_executor_lock:
+            if _photo_executor is None:
+                _photo_executor = ThreadPoolExecutor(
+                    max_workers=max(1, PHOTO_PIPELINE_WORKERS),
+                    thread_name_prefix="photo999",
+                )
+    return _photo_executor
+
+
+@dataclass
+class PhotoUploadResult:
+    index: int
+    url: str
+    image_id: Optional[str] = None
+    failed_code: Optional[int] = None       # 401/403 от Bitrix
+    error: Optional[BaseException] = None
+    download_ms: float = 0.0
+    upload_ms: float = 0.0
+    cached: bool = False                    # image_id взят из IMAGE_CACHE_TABLE, ничего не качали/не грузили
+    file_id: Optional[int] = None
+    content_hash: Optional[str] = None
+
+    def timing(self) -> Dict[str, Any]:
+        return {
+            "index": self.index,
+            "ok": bool(self.image_id),
+            "image_id": self.image_id,
+            "cached": self.cached,
+            "download_ms": round(self.download_ms, 1),
+            "upload_ms": round(self.upload_ms, 1),
+            "error": str(self.error)[:300] if self.error else None,
+        }
+
+
+# -----------------------------
+# Кэш image_id: Bitrix fileId / sha256 содержимого -> image_id на 999 (неизменные фото повторно не грузим)
+# -----------------------------
+IMAGE_CACHE_TABLE = "public.b24_999_image_cache"
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+# Сколько дней считаем image_id живым на 999. Старше — грузим заново (и строку удаляем при очистке).
+IMAGE_CACHE_TTL_DAYS = int(os.getenv("IMAGE_CACHE_TTL_DAYS", "30"))
+
+
+def _photo_file_id_from_url(image_url: str) -> Optional[int]:
+    """fileId из URL Bitrix (crm.controller.item.getFile / ajax.php ...&fileId=123)."""
+    try:
+        qs = urllib.parse.parse_qs(urllib.parse.urlparse(image_url).query)
+        v = (qs.get("fileId") or [""])[0]
+        return int(v) if v.strip().isdigit() else None
+    except Exception:
+        return None
+
+
+def _load_image_cache_by_file_ids(file_ids: List[int]) -> Dict[int, str]:
+    """Живые (моложе IMAGE_CACHE_TTL_DAYS) image_id по fileId — одним запросом на всю машину."""
+    if not file_ids or not IMAGE_CACHE_ENABLED:
+        return {}
+    out: Dict[int, str] = {}
+    conn = None
+    try:
+        conn = _pg_conn()
+        _ensure_schema(conn)
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""SELECT DISTINCT ON (file_id) file_id, image_id
+                    FROM {IMAGE_CACHE_TABLE}
+                    WHERE file_id = ANY(%s) AND uploaded_at > now() - make_interval(days => %s)
+                    ORDER BY file_id, uploaded_at DESC""",
+                (list(file_ids), IMAGE_CACHE_TTL_DAYS),
+            )
+            for file_id, image_id in cur.fetchall():
+                out[int(file_id)] = str(image_id)
+            if out:
+                cur.execute(
+                    f"UPDATE {IMAGE_CACHE_TABLE} SET last_used_at = now() WHERE file_id = ANY(%s)",
+                    (list(out.keys()),),
+                )
+        conn.commit()
+    except Exception as e:
+        print(f"WARN _load_image_cache_by_file_ids: {e}", file=sys.stderr, flush=True)
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    return out
+
+
+def _lookup_image_cache_by_hash(content_hash: str) -> Optional[str]:
+    """Тот же файл под другим fileId (перезалит в карточку) — ищем по хэшу содержимого."""
+    if not IMAGE_CACHE_ENABLED:
+        return None
+    conn = None
+    try:
+        conn = _pg_conn()
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""SELECT image_id FROM {IMAGE_CACHE_TABLE}
+                    WHERE content_hash = %s AND uploaded_at > now() - make_interval(days => %s)""",
+                (content_hash, IMAGE_CACHE_TTL_DAYS),
+            )
+            row = cur.fetchone()
+        return str(row[0]) if row else None
+    except Exception as e:
+        print(f"WARN _lookup_image_cache_by_hash: {e}", file=sys.stderr, flush=True)
+        return None
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def _save_image_cache(results: List[PhotoUploadResult]) -> None:
+    """Запомнить свежие загрузки и новые fileId для уже известных хэшей (один execute_values)."""
+    # Одно и то же фото может прийти из двух файлов Bitrix: ON CONFLICT DO UPDATE не допускает двух строк с одним
+    # content_hash в одном INSERT — оставляем одну (последний image_id, file_id — последний непустой).
+    by_hash: Dict[str, Tuple[str, str, Optional[int]]] = {}
+    for r in results:
+        if not (IMAGE_CACHE_ENABLED and r.image_id and r.content_hash):
+            continue
+        prev = by_hash.get(r.content_hash)
+        file_id = r.file_id if r.file_id is not None else (prev[2] if prev else None)
+        by_hash[r.content_hash] = (r.content_hash, r.image_id, file_id)
+    rows = list(by_hash.values())
+    if not rows:
+        return
+    conn = None
+    try:
+        conn = _pg_conn()
+        _ensure_schema(conn)
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur,
+                f"""INSERT INTO {IMAGE_CACHE_TABLE} (content_hash, image_id, file_id)
+                    VALUES %s
+                    ON CONFLICT (content_hash) DO UPDATE SET
+                        file_id = COALESCE(EXCLUDED.file_id, {IMAGE_CACHE_TABLE}.file_id),
+                        image_id = EXCLUDED.image_id,
+                        uploaded_at = CASE WHEN {IMAGE_CACHE_TABLE}.image_id = EXCLUDED.image_id
+                                           THEN {IMAGE_CACHE_TABLE}.uploaded_at ELSE now() END,
+                        last_used_at = now()""",
+                rows,
+            )
+        conn.commit()
+    except Exception as e:
+        print(f"WARN _save_image_cache: {e}", file=sys.stderr, flush=True)
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def evict_image_cache(image_ids: Optional[List[str]] = None) -> int:
+    """Удалить из кэша image_id, которые 999 отверг (image_ids), или все просроченные по TTL (image_ids=None)."""
+    conn = None
+    try:
+        conn = _pg_conn()
+        _ensure_schema(conn)
+        with conn.cursor() as cur:
+            if image_ids:
+                cur.execute(f"DELETE FROM {IMAGE_CACHE_TABLE} WHERE image_id = ANY(%s)", (list(image_ids),))
+            else:
+                cur.execute(
+                    f"DELETE FROM {IMAGE_CACHE_TABLE} WHERE uploaded_at <= now() - make_interval(days => %s)",
+                    (IMAGE_CACHE_TTL_DAYS,),
+                )
+            n = cur.rowcount
+        conn.commit()
+        return n
+    except Exception as e:
+        print(f"WARN evict_image_cache: {e}", file=sys.stderr, flush=True)
+        return 0
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+_FEATURE_14_PATH_RE = re.compile(r"\bfeatures?\W{0,2}14\b")
+
+
+def _is_image_rejected_error(err: BaseException, image_ids: Optional[List[str]] = None) -> bool:
+    """999 не принял image_id из фичи 14 (истёк/удалён) — признак, что кэш для этих фото устарел.
+    Только 4xx от API 999 (не 429), в теле которого ошибка указывает на фичу 14 или на один из image_ids."""
+    if not isinstance(err, Api999Error) or not 400 <= err.status_code < 500 or err.status_code == 429:
+        return False
+    stale = {str(i) for i in image_ids or [] if i}
+    stack: List[Any] = [err.body]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for k, v in node.items():
+                key = str(k)
+                if key == "14" or _FEATURE_14_PATH_RE.search(key):
+                    return True
+                if key in ("id", "feature_id", "feature", "field") and str(v) == "14":
+                    return True
+                stack.append(v)
+        elif isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, str):
+            if _FEATURE_14_PATH_RE.search(node) or any(i in node for i in stale):
+                return True
+    return False
+
+
+def _upload_one_photo(
+    index: int,
+    url: str,
+    strict: bool,
+    cancelled: threading.Event,
+    cached_by_file_id: Dict[int, str],
+    use_cache: bool,
+) -> PhotoUploadResult:
+    res = PhotoUploadResult(index=index, url=url, file_id=_photo_file_id_from_url(url))
+    if res.file_id is not None and res.file_id in cached_by_file_id:
+        res.image_id = cached_by_file_id[res.file_id]
+        res.cached = True
+        return res
+    if cancelled.is_set():
+        return res
+    t0 = time.perf_counter()
+    try:
+        if strict:
+            content: Optional[bytes] = _download_image_strict(url)
+        else:
+            content, res.failed_code = _download_image_content(url)
+        res.download_ms = (time.perf_counter() - t0) * 1000
+        if not content:
+            if res.failed_code:
+                print(f"WARN: skip photo (Bitrix {res.failed_code}): {url[:100]}...", file=sys.stderr, flush=True)
+            else:
+                print(f"WARN: skip photo (empty or error): {url[:80]}...", file=sys.stderr, flush=True)
+            return res
+        res.content_hash = hashlib.sha256(content).hexdigest()
+        if use_cache:
+            cached_id = _lookup_image_cache_by_hash(res.content_hash)
+            if cached_id:
+                res.image_id = cached_id
+                res.cached = True
+                return res
+        if cancelled.is_set():
+            return res
+        t1 = time.perf_counter()
+        if strict:
+            res.image_id = _upload_image_content(_image_name_from_url(url), content)
+        else:
+            res.image_id = _upload_downloaded_image_optional(url, content)
+        res.upload_ms = (time.perf_counter() - t1) * 1000
+    except Exception as e:
+        res.error = e
+        if res.download_ms == 0.0:
+            res.download_ms = (time.perf_counter() - t0) * 1000
+        if strict:
+            cancelled.set()  # всё-или-ничего: остальные фото уже не нужны
+    return res
+
+
+def upload_photos_from_urls(image_urls: List[str], strict: bool = True, use_cache: bool = True) -> List[PhotoUploadResult]:
+    """Скачать фото и загрузить на 999 параллельно (PHOTO_PIPELINE_WORKERS; лимиты на Bitrix и 999 отдельно).
+    Результаты — в исходном порядке image_urls (порядок фото в фиче 14 не меняется).
+    strict=True — как publish_car_manual: при первой ошибке оставшиеся фото не начинаются, ошибка в result.error.
+    strict=False — как update_advert_from_item: недоступные фото (401/403, ошибки) пропускаются.
+    use_cache — сначала IMAGE_CACHE_TABLE по fileId (без скачивания), после скачивания — по sha256."""
+    urls = list(image_urls or [])
+    if not urls:
+        return []
+    use_cache = use_cache and IMAGE_CACHE_ENABLED
+    cached_by_file_id: Dict[int, str] = {}
+    if use_cache:
+        file_ids = [fid for fid in (_photo_file_id_from_url(u) for u in urls) if fid is not None]
+        cached_by_file_id = _load_image_cache_by_file_ids(file_ids)
+    cancelled = threading.Event()
+    t0 = time.perf_counter()
+    futures = [
+        _photo_pool().submit(_upload_one_photo, i, u, strict, cancelled, cached_by_file_id, use_cache)
+        for i, u in enumerate(urls)
+    ]
+    results = [f.result() for f in futures]
+    total_ms = (time.perf_counter() - t0) * 1000
+    if IMAGE_CACHE_ENABLED:
+        _save_image_cache(results)
+    ok = sum(1 for r in results if r.image_id)
+    print(
+        f"PHOTO_999: {ok}/{len(urls)} фото за {total_ms:.0f} мс, из кэша {sum(1 for r in results if r.cached)} "
+        f"(скачивание Σ{sum(r.download_ms for r in results):.0f} мс, загрузка Σ{sum(r.upload_ms for r in results):.0f} мс)",
+        flush=True,
+    )
+    return results
 
 
 # --- Фото из БД (raw b24_sp_f_1114), как в auto_send_tg: url (ajax) -> machine URL с текущим вебхуком ---
@@ -665,7 +2322,7 @@ def extract_photo_urls_from_raw(raw: Dict[str, Any], bitrix_webhook: str = "") -
 # -----------------------------
 # Raw decode (meta, iblock, enum) — как в auto_send_tg
 # -----------------------------
-@dataclass
+@dataclass(frozen=True)
 class MetaInfo:
     b24_field: Optional[str]
     b24_type: str
@@ -751,120 +2408,94 @@ def _extract_enum_map_from_labels(labels: Any) -> Dict[str, str]:
     return out
 
 
-def load_meta_map() -> Dict[str, MetaInfo]:
+def _read_meta_map(conn) -> Dict[str, MetaInfo]:
     out: Dict[str, MetaInfo] = {}
-    try:
-        conn = _pg_conn()
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(
-                f"""SELECT b24_field, column_name, b24_type, settings, b24_title, b24_labels
-                   FROM {META_TABLE} WHERE entity_key = %s""",
-                (ENTITY_KEY_SP1114,),
-            )
-            rows = cur.fetchall()
-        conn.close()
-        if not rows:
-            return out
-        for r in rows:
-            col = r.get("column_name")
-            if not col:
-                continue
-            col_key = str(col).strip().lower()
-            b24_field = r.get("b24_field")
-            b24_type = (r.get("b24_type") or "")
-            if isinstance(b24_type, bytes):
-                b24_type = b24_type.decode("utf-8", errors="replace")
-            settings = r.get("settings")
-            iblock_id = None
-            iblock_type_id = None
-            if isinstance(settings, dict) and "IBLOCK_ID" in settings:
-                try:
-                    iblock_id = int(settings.get("IBLOCK_ID"))
-                except Exception:
-                    pass
-            if isinstance(settings, dict):
-                for k in ("IBLOCK_TYPE_ID", "IBLOCK_TYPE", "IBLOCK_TYPE_ID_NAME"):
-                    v = settings.get(k)
-                    if isinstance(v, str) and v.strip():
-                        iblock_type_id = v.strip()
-                        break
-            enum_map = _extract_enum_map_from_settings(settings)
-            labels_raw = r.get("b24_labels")
-            if labels_raw:
-                enum_map.update(_extract_enum_map_from_labels(labels_raw))
-            b24_title = (r.get("b24_title") or "").strip()
-            if isinstance(b24_title, bytes):
-                b24_title = b24_title.decode("utf-8", errors="replace")
-            if not b24_title and labels_raw:
-                tt = _extract_title_from_labels(labels_raw)
-                if tt:
-                    b24_title = tt
-            out[col_key] = MetaInfo(
-                b24_field=str(b24_field).strip() if b24_field else None,
-                b24_type=b24_type or "",
-                iblock_id=iblock_id,
-                iblock_type_id=iblock_type_id,
-                b24_title=b24_title or None,
-                enum_map=enum_map,
-            )
-    except Exception as e:
-        print(f"WARN load_meta_map: {e}", file=sys.stderr, flush=True)
-    return out
-
-
-def _get_raw_key_by_title(meta: Dict[str, MetaInfo], titles: List[str]) -> Optional[str]:
-    """Найти b24_field по одному из названий поля (b24_title)."""
-    titles_lower = [t.strip().lower() for t in titles if t]
-    for mi in (meta or {}).values():
-        t = (mi.b24_title or "").strip().lower()
-        if t and t in titles_lower:
-            return mi.b24_field
-    return None
-
-
-def _ensure_iblock_cache_table(conn) -> None:
-    with conn.cursor() as cur:
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
         cur.execute(
-            f"""CREATE TABLE IF NOT EXISTS {IBLOCK_CACHE_TABLE} (
-                iblock_id INTEGER NOT NULL,
-                element_id INTEGER NOT NULL,
-                name TEXT,
-                raw JSONB,
-                updated_at TIMESTAMPTZ DEFAULT now(),
-                PRIMARY KEY (iblock_id, element_id)
-            )"""
+            f"""SELECT b24_field, column_name, b24_type, settings, b24_title, b24_labels
+               FROM {META_TABLE} WHERE entity_key = %s""",
+            (ENTITY_KEY_SP1114,),
         )
-    conn.commit()
+        rows = cur.fetchall()
+    for r in rows:
+        col = r.get("column_name")
+        if not col:
+            continue
+        col_key = str(col).strip().lower()
+        b24_field = r.get("b24_field")
+        b24_type = (r.get("b24_type") or "")
+        if isinstance(b24_type, bytes):
+            b24_type = b24_type.decode("utf-8", errors="replace")
+        settings = r.get("settings")
+        iblock_id = None
+        iblock_type_id = None
+        if isinstance(settings, dict) and "IBLOCK_ID" in settings:
+            try:
+                iblock_id = int(settings.get("IBLOCK_ID"))
+            except Exception:
+                pass
+        if isinstance(settings, dict):
+            for k in ("IBLOCK_TYPE_ID", "IBLOCK_TYPE", "IBLOCK_TYPE_ID_NAME"):
+                v = settings.get(k)
+                if isinstance(v, str) and v.strip():
+                    iblock_type_id = v.strip()
+                    break
+        enum_map = _extract_enum_map_from_settings(settings)
+        labels_raw = r.get("b24_labels")
+        if labels_raw:
+            enum_map.update(_extract_enum_map_from_labels(labels_raw))
+        b24_title = (r.get("b24_title") or "").strip()
+        if isinstance(b24_title, bytes):
+            b24_title = b24_title.decode("utf-8", errors="replace")
+        if not b24_title and labels_raw:
+            tt = _extract_title_from_labels(labels_raw)
+            if tt:
+                b24_title = tt
+        out[col_key] = MetaInfo(
+            b24_field=str(b24_field).strip() if b24_field else None,
+            b24_type=b24_type or "",
+            iblock_id=iblock_id,
+            iblock_type_id=iblock_type_id,
+            b24_title=b24_title or None,
+            enum_map=enum_map,
+        )
+    return out
 
 
 def _load_iblock_cache(conn, pairs: List[Tuple[int, int]]) -> Dict[Tuple[int, int], str]:
+    """Имена из IBLOCK_CACHE_TABLE одним запросом с unnest по двум массивам (текст SQL не зависит от числа пар,
+    план переиспользуется). Для промахов справочника в памяти: имя мог дописать фоновый добор другой реплики."""
     if not pairs:
         return {}
+    keys = list(dict.fromkeys(pairs))
+    found: Dict[Tuple[int, int], str] = {}
     try:
-        ors = []
-        params: List[Any] = []
-        for ib, eid in pairs:
-            ors.append("(iblock_id=%s AND element_id=%s)")
-            params.extend([ib, eid])
-        q = f"SELECT iblock_id, element_id, name FROM {IBLOCK_CACHE_TABLE} WHERE " + " OR ".join(ors)
-        out: Dict[Tuple[int, int], str] = {}
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(q, params)
-            for r in cur.fetchall():
-                try:
-                    out[(int(r["iblock_id"]), int(r["element_id"]))] = str(r["name"])
-                except Exception:
-                    pass
-        return out
-    except Exception:
-        return {}
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""SELECT c.iblock_id, c.element_id, c.name
+                    FROM unnest(%s::int[], %s::int[]) AS q(iblock_id, element_id)
+                    JOIN {IBLOCK_CACHE_TABLE} c ON c.iblock_id = q.iblock_id AND c.element_id = q.element_id
+                    WHERE c.name IS NOT NULL""",
+                ([ib for ib, _ in keys], [eid for _, eid in keys]),
+            )
+            for ib, eid, name in cur.fetchall():
+                found[(int(ib), int(eid))] = str(name)
+        conn.rollback()
+    except Exception as e:
+        # Соединение вызывающего: без отката следующий запрос на нём упадёт с «transaction is aborted»
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        print(f"WARN _load_iblock_cache: {e}", file=sys.stderr, flush=True)
+    return found
 
 
 def _save_iblock_cache(conn, entries: Dict[Tuple[int, int], str]) -> None:
     if not entries:
         return
     try:
-        _ensure_iblock_cache_table(conn)
+        _ensure_schema(conn)
         rows = [(ib, eid, name) for (ib, eid), name in entries.items()]
         with conn.cursor() as cur:
             psycopg2.extras.execute_values(
@@ -878,12 +2509,66 @@ def _save_iblock_cache(conn, entries: Dict[Tuple[int, int], str]) -> None:
         print(f"WARN _save_iblock_cache: {e}", file=sys.stderr, flush=True)
 
 
+_iblock_learned_types: Dict[int, str] = {}
+_iblock_learned_types_loaded = False
+_iblock_types_lock = threading.Lock()
+
+
+def _load_iblock_learned_types() -> Dict[int, str]:
+    global _iblock_learned_types_loaded
+    if _iblock_learned_types_loaded:
+        return _iblock_learned_types
+    try:
+        with _pg_conn() as conn:
+            _ensure_schema(conn)
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT iblock_id, iblock_type_id FROM {IBLOCK_TYPE_TABLE}")
+                rows = cur.fetchall()
+            conn.commit()
+        with _iblock_types_lock:
+            for ib, t in rows:
+                _iblock_learned_types.setdefault(int(ib), str(t))
+        _iblock_learned_types_loaded = True
+    except Exception as e:
+        print(f"WARN _load_iblock_learned_types: {e}", file=sys.stderr, flush=True)
+    return _iblock_learned_types
+
+
+def _learn_iblock_type(iblock_id: int, iblock_type_id: str) -> None:
+    """Запомнить рабочий IBLOCK_TYPE_ID (в памяти и в IBLOCK_TYPE_TABLE), если он новый."""
+    with _iblock_types_lock:
+        if _iblock_learned_types.get(iblock_id) == iblock_type_id:
+            return
+        _iblock_learned_types[iblock_id] = iblock_type_id
+    try:
+        with _pg_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""INSERT INTO {IBLOCK_TYPE_TABLE} (iblock_id, iblock_type_id) VALUES (%s, %s)
+                        ON CONFLICT (iblock_id) DO UPDATE SET iblock_type_id = EXCLUDED.iblock_type_id, learned_at = now()""",
+                    (iblock_id, iblock_type_id),
+                )
+            conn.commit()
+    except Exception as e:
+        print(f"WARN _learn_iblock_type: {e}", file=sys.stderr, flush=True)
+
+
+def _iblock_type_candidates(iblock_id: int, hint: Optional[str]) -> List[str]:
+    """IBLOCK_TYPE_ID по порядку: выученный, из meta, IBLOCK_TYPE_ID_FALLBACK, IBLOCK_TYPE_ID_CANDIDATES."""
+    learned = _load_iblock_learned_types().get(iblock_id)
+    seen: Set[str] = set()
+    return [
+        t for t in [learned, hint, IBLOCK_TYPE_ID_FALLBACK] + IBLOCK_TYPE_ID_CANDIDATES
+        if t and t not in seen and not seen.add(t)
+    ]
+
+
 def _b24_call_get(method: str, params: Dict[str, Any]) -> Dict[str, Any]:
     webhook = _bitrix_webhook()
     if not webhook:
         return {}
     url = f"{webhook.rstrip('/')}/{method}.json"
-    r = requests.get(url, params=params, timeout=30)
+    r = _http_bitrix().get(url, params=params, timeout=30)
     r.raise_for_status()
     data = r.json()
     if isinstance(data, dict) and data.get("error"):
@@ -891,13 +2576,13 @@ def _b24_call_get(method: str, params: Dict[str, Any]) -> Dict[str, Any]:
     return data
 
 
-def _b24_call_post(method: str, data: Dict[str, Any]) -> Dict[str, Any]:
-    """POST-запрос к Bitrix24 REST (для crm.item.update и др.)."""
+def _b24_call_post(method: str, data: Dict[str, Any], retry_unsafe: bool = False) -> Dict[str, Any]:
+    """POST-запрос к Bitrix24 REST (для crm.item.update и др.). retry_unsafe=True — только для чтения (batch из get)."""
     webhook = _bitrix_webhook()
     if not webhook:
         return {}
     url = f"{webhook.rstrip('/')}/{method}.json"
-    r = requests.post(url, json=data, timeout=30)
+    r = _http_bitrix().post(url, json=data, timeout=30, retry_unsafe=retry_unsafe)
     raw_body = (r.text or "")[:1000]
     try:
         result = r.json()
@@ -923,6 +2608,52 @@ def _b24_call_post(method: str, data: Dict[str, Any]) -> Dict[str, Any]:
     return result if isinstance(result, dict) else {}
 
 
+def _b24_query(params: Dict[str, Any], prefix: str = "") -> List[Tuple[str, str]]:
+    """Параметры в виде query string Bitrix (как http_build_query в PHP): FILTER[ID][0]=1&FILTER[ID][1]=2."""
+    out: List[Tuple[str, str]] = []
+    for k, v in params.items():
+        key = f"{prefix}[{k}]" if prefix else str(k)
+        if isinstance(v, dict):
+            out.extend(_b24_query(v, key))
+        elif isinstance(v, (list, tuple)):
+            out.extend(_b24_query({str(i): x for i, x in enumerate(v)}, key))
+        elif v is not None:
+            out.append((key, str(v)))
+    return out
+
+
+def _b24_batch(
+    commands: Dict[str, Tuple[str, Dict[str, Any]]],
+    read_only: bool = False,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Выполнить команды {ключ: (метод, параметры)} через REST batch: до BITRIX_BATCH_MAX_COMMANDS за вызов,
+    halt=0 (ошибка одной команды не останавливает остальные). Возвращает (результаты, ошибки) по ключам;
+    команда без ответа (пачка вернулась без result или ключа нет ни в result, ни в result_error) — тоже в ошибках.
+    read_only=True — в пачке только чтение, её можно повторить при 5xx/обрыве."""
+    results: Dict[str, Any] = {}
+    errors: Dict[str, Any] = {}
+    keys = list(commands)
+    for i in range(0, len(keys), BITRIX_BATCH_MAX_COMMANDS):
+        chunk = keys[i:i + BITRIX_BATCH_MAX_COMMANDS]
+        cmd = {
+            k: f"{commands[k][0]}?{urllib.parse.urlencode(_b24_query(commands[k][1]))}"
+            for k in chunk
+        }
+        data = _b24_call_post("batch", {"halt": 0, "cmd": cmd}, retry_unsafe=read_only)
+        res = data.get("result") if isinstance(data, dict) else None
+        if not isinstance(res, dict):
+            res = {}
+        # PHP отдаёт пустой объект как [] — поэтому проверяем тип
+        if isinstance(res.get("result"), dict):
+            results.update(res["result"])
+        if isinstance(res.get("result_error"), dict):
+            errors.update(res["result_error"])
+        for k in chunk:
+            if k not in results and k not in errors:
+                errors[k] = "batch: нет ответа на команду"
+    return results, errors
+
+
 # Поля смарт-процесса 1114 в Битрикс: ссылка на 999 и дата публикации (заполняем после появления объявления на 999).
 BITRIX_FIELD_999_LINK = "UF_CRM_34_1756926339865"
 BITRIX_FIELD_999_PUBLISHED_AT = "UF_CRM_34_1770816519"
@@ -933,8 +2664,10 @@ def update_bitrix_999_publication_fields(
     item_id: int,
     advert_id: int,
     published_at: Optional[datetime] = None,
+    strict: bool = False,
 ) -> None:
-    """После публикации на 999 обновить в Битрикс у машины (item_id) поле ссылки и дату публикации."""
+    """После публикации на 999 обновить в Битрикс у машины (item_id) поле ссылки и дату публикации.
+    strict=True — ошибку пробросить (очередь публикаций повторит шаг), иначе только WARN."""
     webhook = _bitrix_webhook()
     if not webhook:
         return
@@ -970,6 +2703,8 @@ def update_bitrix_999_publication_fields(
             flush=True,
         )
         traceback.print_exc(file=sys.stderr)
+        if strict:
+            raise
 
 
 def _extract_list_items(data: Any) -> List[Dict[str, Any]]:
@@ -992,99 +2727,533 @@ def _fetch_iblock_names_from_bitrix(
     pairs: List[Tuple[int, int]],
     iblock_type_map: Dict[int, Optional[str]],
 ) -> Dict[Tuple[int, int], str]:
+    """Имена элементов iblock из Bitrix через batch: элементы одного iblock — одной командой
+    lists.element.get с FILTER[ID]=[...] (до 50 id, одна страница ответа). IBLOCK_TYPE_ID перебираем
+    раундами, начиная с выученного (_iblock_type_candidates): в следующий раунд идут только не найденные
+    элементы со следующим кандидатом. Если выученный тип ответил без ошибки — остальных элементов нет,
+    дальше не перебираем. В негативный кэш (IBLOCK_NEGATIVE_TTL_SEC) попадают только элементы, которых нет в успешном
+    ответе команды для их id; ошибки команд (в т.ч. лимиты и пропавшие пачки) ничего не кэшируют."""
     out: Dict[Tuple[int, int], str] = {}
     webhook = _bitrix_webhook()
     if not pairs or not webhook or not ENABLE_IBLOCK_API_LOOKUP:
         return out
-    by_ib: Dict[int, List[int]] = {}
+    pending: Dict[int, Set[int]] = {}
     for ib, eid in pairs:
-        by_ib.setdefault(ib, []).append(eid)
-    for ib, eids in by_ib.items():
-        type_candidates = [iblock_type_map.get(ib), IBLOCK_TYPE_ID_FALLBACK] + IBLOCK_TYPE_ID_CANDIDATES
-        type_candidates = [t for t in type_candidates if t]
-        seen = set()
-        type_candidates = [t for t in type_candidates if t not in seen and not seen.add(t)]
-        for eid in sorted(set(eids)):
-            for iblock_type in type_candidates:
-                try:
-                    params = {
-                        "IBLOCK_TYPE_ID": iblock_type,
+        pending.setdefault(ib, set()).add(eid)
+    type_candidates = {ib: _iblock_type_candidates(ib, iblock_type_map.get(ib)) for ib in pending}
+    learned = dict(_load_iblock_learned_types())
+    round_no = 0
+    confirmed_missing: Set[Tuple[int, int]] = set()
+    while pending:
+        commands: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        command_ids: Dict[str, List[int]] = {}
+        for ib, eids in pending.items():
+            if round_no >= len(type_candidates[ib]):
+                continue
+            ordered = sorted(eids)
+            for j in range(0, len(ordered), BITRIX_BATCH_MAX_COMMANDS):
+                command_ids[f"ib{ib}_{j}"] = ordered[j:j + BITRIX_BATCH_MAX_COMMANDS]
+                commands[f"ib{ib}_{j}"] = (
+                    "lists.element.get",
+                    {
+                        "IBLOCK_TYPE_ID": type_candidates[ib][round_no],
                         "IBLOCK_ID": ib,
-                        "FILTER[ID]": eid,
-                    }
-                    data = _b24_call_get("lists.element.get", params)
-                    items = _extract_list_items(data)
-                    if items:
-                        item = items[0]
-                        name = item.get("NAME") or item.get("TITLE") or item.get("name") or item.get("title")
-                        if name:
-                            out[(ib, eid)] = str(name)
-                            break
+                        "FILTER": {"ID": ordered[j:j + BITRIX_BATCH_MAX_COMMANDS]},
+                    },
+                )
+        if not commands:
+            break
+        try:
+            results, errors = _b24_batch(commands, read_only=True)
+        except Exception as e:
+            print(f"WARN _fetch_iblock_names_from_bitrix: {e}", file=sys.stderr, flush=True)
+            break
+        with _iblock_dict_lock:
+            _iblock_dict_stats["type_hits"] += sum(1 for k in results if round_no == 0 and int(k[2:].split("_")[0]) in learned)
+            _iblock_dict_stats["type_misses"] += len(errors)
+        answered: Set[int] = set()
+        for key, res in results.items():
+            ib = int(key[2:].split("_")[0])
+            iblock_type = type_candidates[ib][round_no]
+            items = _extract_list_items({"result": res})
+            returned_ids: Set[int] = set()
+            if items:
+                _learn_iblock_type(ib, iblock_type)
+            if learned.get(ib) == iblock_type:
+                answered.add(ib)
+            for item in items:
+                name = item.get("NAME") or item.get("TITLE") or item.get("name") or item.get("title")
+                try:
+                    eid = int(item.get("ID") or item.get("id"))
                 except Exception:
                     continue
+                returned_ids.add(eid)
+                if name and eid in pending.get(ib, ()):
+                    out[(ib, eid)] = str(name)
+                    pending[ib].discard(eid)
+            # Команда ответила без ошибки, но этих id в ответе нет — элементов в iblock нет
+            confirmed_missing.update((ib, eid) for eid in command_ids.get(key, ()) if eid not in returned_ids)
+        pending = {ib: eids for ib, eids in pending.items() if eids and ib not in answered}
+        round_no += 1
+    missing = [p for p in pairs if p in confirmed_missing and p not in out]
+    if missing:
+        _iblock_negative_put(missing)
     return out
 
 
 def resolve_iblock_names(
     pairs: List[Tuple[int, int]],
     iblock_type_map: Optional[Dict[int, Optional[str]]] = None,
+    wait_sec: Optional[float] = None,
 ) -> Dict[Tuple[int, int], str]:
+    """Имена элементов iblock из справочника в памяти (IBLOCK_CACHE_TABLE + sync_iblock_dictionaries), в Bitrix не ходит.
+    Промахи ставятся в общий фоновый добор; ждём его не дольше wait_sec (по умолчанию IBLOCK_MISS_WAIT_SEC = 0).
+    Что осталось без имени — см. _iblock_unresolved: публикация и sync такие машины откладывают."""
     if not pairs:
         return {}
     iblock_type_map = iblock_type_map or {}
+    wait = IBLOCK_MISS_WAIT_SEC if wait_sec is None else wait_sec
+    out, missing = _iblock_dict_lookup(pairs)
+    if missing and _iblock_dict_loaded:
+        try:
+            with _pg_conn() as conn:
+                from_db = _load_iblock_cache(conn, missing)
+        except Exception as e:
+            print(f"WARN resolve_iblock_names: {e}", file=sys.stderr, flush=True)
+            from_db = {}
+        if from_db:
+            _iblock_dict_put(from_db)
+            with _iblock_dict_lock:
+                _iblock_dict_stats["db_hits"] += len(from_db)
+            out.update(from_db)
+            missing = [p for p in missing if p not in from_db]
+    missing = _iblock_negative_filter(missing)
+    if not missing:
+        return out
+    if ENABLE_IBLOCK_API_LOOKUP:
+        done = _request_iblock_refresh(missing, iblock_type_map)
+        if wait > 0 and done.wait(wait):
+            out.update(_iblock_dict_lookup(missing)[0])
+    return out
+
+
+def _iblock_unresolved(pairs: List[Tuple[int, int]], names: Dict[Tuple[int, int], str]) -> List[Tuple[int, int]]:
+    """Пары без имени, которое ещё может прийти из фонового добора (не в негативном кэше: Bitrix не сказал «нет такого»).
+    Без ENABLE_IBLOCK_API_LOOKUP имя не придёт никогда — такие не считаем (как раньше: расшифровка без имени)."""
+    if not ENABLE_IBLOCK_API_LOOKUP:
+        return []
+    now = time.time()
+    with _iblock_dict_lock:
+        return [p for p in dict.fromkeys(pairs) if p not in names and _iblock_negative.get(p, 0) <= now]
+
+
+# -----------------------------
+# Справочники iblock целиком (марка, модель, кузов, двигатель, топливо...): периодическая синхронизация
+# -----------------------------
+IBLOCK_SYNC_ENABLED = os.getenv("IBLOCK_SYNC_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+IBLOCK_SYNC_INTERVAL_SEC = int(os.getenv("IBLOCK_SYNC_INTERVAL_SEC", str(6 * 3600)))
+IBLOCK_MISS_WAIT_SEC = float(os.getenv("IBLOCK_MISS_WAIT_SEC", "0"))  # сколько ждать фонового добора промаха; 0 — не ждать
+# Публикация и sync ждут добора дольше: машина с нерасшифрованной моделью/кузовом ушла бы на 999 с чужими опциями.
+# Не дождались — машина откладывается (остаётся в очереди / «грязной»), payload не собирается.
+IBLOCK_PUBLISH_WAIT_SEC = float(os.getenv("IBLOCK_PUBLISH_WAIT_SEC", "10"))
+IBLOCK_PAGE_SIZE = 50  # lists.element.get отдаёт по 50 элементов на страницу
+
+_iblock_dict: Dict[Tuple[int, int], str] = {}
+_iblock_dict_loaded = False
+_iblock_dict_synced: Dict[int, Dict[str, Any]] = {}  # iblock_id -> {"elements", "iblock_type_id", "synced_at"}
+_iblock_dict_lock = threading.Lock()
+_iblock_dict_stats: Dict[str, Any] = {
+    "hits": 0, "misses": 0, "negative_hits": 0, "negative_added": 0,
+    "type_hits": 0, "type_misses": 0,  # команд lists.element.get: выученный IBLOCK_TYPE_ID подошёл сразу / ошибка типа
+    "refreshes": 0, "refreshed_elements": 0, "full_syncs": 0,
+    "db_hits": 0,  # промахи в памяти, найденные в IBLOCK_CACHE_TABLE (дописаны другой репликой)
+}
+_iblock_negative: Dict[Tuple[int, int], float] = {}  # (iblock_id, element_id) -> до какого времени не спрашивать
+_iblock_refresh_pending: Dict[Tuple[int, int], Optional[str]] = {}
+_iblock_refresh_done = threading.Event()
+_iblock_refresh_thread: Optional[threading.Thread] = None
+_iblock_sync_thread: Optional[threading.Thread] = None
+_iblock_sync_status: Dict[str, Any] = {"state": "idle"}
+
+
+def _iblock_dict_put(names: Dict[Tuple[int, int], str]) -> None:
+    if names:
+        with _iblock_dict_lock:
+            _iblock_dict.update(names)
+
+
+def _iblock_negative_put(pairs: List[Tuple[int, int]]) -> None:
+    if not pairs or IBLOCK_NEGATIVE_TTL_SEC <= 0:
+        return
+    expires = time.time() + IBLOCK_NEGATIVE_TTL_SEC
+    with _iblock_dict_lock:
+        for p in pairs:
+            _iblock_negative[p] = expires
+        _iblock_dict_stats["negative_added"] += len(pairs)
+
+
+def _iblock_negative_filter(pairs: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Убрать элементы, которые недавно не нашлись в Bitrix (срок в негативном кэше не истёк)."""
+    now = time.time()
+    out: List[Tuple[int, int]] = []
+    with _iblock_dict_lock:
+        for p in pairs:
+            expires = _iblock_negative.get(p)
+            if expires is None:
+                out.append(p)
+            elif expires > now:
+                _iblock_dict_stats["negative_hits"] += 1
+            else:
+                del _iblock_negative[p]
+                out.append(p)
+    return out
+
+
+def _iblock_dict_lookup(pairs: List[Tuple[int, int]]) -> Tuple[Dict[Tuple[int, int], str], List[Tuple[int, int]]]:
+    """(найденные имена, промахи). При первом обращении справочник поднимается из IBLOCK_CACHE_TABLE."""
+    global _iblock_dict_loaded
+    if not _iblock_dict_loaded:
+        try:
+            with _pg_conn() as conn:
+                _ensure_schema(conn)
+                with conn.cursor() as cur:
+                    cur.execute(f"SELECT iblock_id, element_id, name FROM {IBLOCK_CACHE_TABLE} WHERE name IS NOT NULL")
+                    rows = cur.fetchall()
+            _iblock_dict_put({(int(ib), int(eid)): str(name) for ib, eid, name in rows})
+            _iblock_dict_loaded = True
+        except Exception as e:
+            print(f"WARN _iblock_dict_lookup: {e}", file=sys.stderr, flush=True)
+    out: Dict[Tuple[int, int], str] = {}
+    missing: List[Tuple[int, int]] = []
+    with _iblock_dict_lock:
+        for p in pairs:
+            name = _iblock_dict.get(p)
+            if name is None:
+                missing.append(p)
+            else:
+                out[p] = name
+        _iblock_dict_stats["hits"] += len(out)
+        _iblock_dict_stats["misses"] += len(missing)
+    return out, missing
+
+
+def _request_iblock_refresh(
+    pairs: List[Tuple[int, int]],
+    iblock_type_map: Dict[int, Optional[str]],
+) -> threading.Event:
+    """Поставить элементы в общий фоновый добор (один поток, одна batch-пачка на все накопившиеся промахи).
+    Возвращает событие, которое выставится после ближайшего добора."""
+    global _iblock_refresh_thread
+    with _iblock_dict_lock:
+        for p in pairs:
+            _iblock_refresh_pending.setdefault(p, iblock_type_map.get(p[0]))
+        done = _iblock_refresh_done
+        if _iblock_refresh_thread is None:
+            _iblock_refresh_thread = threading.Thread(target=_iblock_refresh_worker, daemon=True)
+            _iblock_refresh_thread.start()
+    return done
+
+
+def _iblock_refresh_worker() -> None:
+    global _iblock_refresh_done, _iblock_refresh_thread
+    while True:
+        with _iblock_dict_lock:
+            if not _iblock_refresh_pending:
+                _iblock_refresh_thread = None
+                return
+            batch = dict(_iblock_refresh_pending)
+            _iblock_refresh_pending.clear()
+            done = _iblock_refresh_done
+            _iblock_refresh_done = threading.Event()
+        try:
+            type_map = {ib: t for (ib, _), t in batch.items() if t}
+            names = _fetch_iblock_names_from_bitrix(list(batch), type_map)
+            if names:
+                conn = _pg_conn()
+                try:
+                    _save_iblock_cache(conn, names)
+                finally:
+                    conn.close()
+                _iblock_dict_put(names)
+            with _iblock_dict_lock:
+                _iblock_dict_stats["refreshes"] += 1
+                _iblock_dict_stats["refreshed_elements"] += len(names)
+        except Exception as e:
+            print(f"WARN _iblock_refresh_worker: {e}", file=sys.stderr, flush=True)
+        finally:
+            done.set()
+
+
+def _fetch_iblock_all_elements(
+    iblock_id: int,
+    iblock_type_id: Optional[str],
+) -> Tuple[Dict[Tuple[int, int], str], Optional[str]]:
+    """Все элементы iblock: первая страница lists.element.get (узнаём total и рабочий IBLOCK_TYPE_ID),
+    остальные страницы — через batch. Возвращает (имена, IBLOCK_TYPE_ID)."""
+    candidates = _iblock_type_candidates(iblock_id, iblock_type_id)
+
+    def params(iblock_type: str, start: int) -> Dict[str, Any]:
+        return {"IBLOCK_TYPE_ID": iblock_type, "IBLOCK_ID": iblock_id, "ELEMENT_ORDER": {"ID": "ASC"}, "start": start}
+
+    def collect(items: List[Dict[str, Any]], into: Dict[Tuple[int, int], str]) -> None:
+        for item in items:
+            name = item.get("NAME") or item.get("TITLE") or item.get("name") or item.get("title")
+            try:
+                eid = int(item.get("ID") or item.get("id"))
+            except Exception:
+                continue
+            if name:
+                into[(iblock_id, eid)] = str(name)
+
+    for iblock_type in candidates:
+        try:
+            first = _b24_call_get("lists.element.get", dict(_b24_query(params(iblock_type, 0))))
+        except Exception:
+            continue
+        names: Dict[Tuple[int, int], str] = {}
+        collect(_extract_list_items(first), names)
+        total = int(first.get("total") or 0)
+        commands = {
+            f"p{start}": ("lists.element.get", params(iblock_type, start))
+            for start in range(IBLOCK_PAGE_SIZE, total, IBLOCK_PAGE_SIZE)
+        }
+        if commands:
+            results, errors = _b24_batch(commands, read_only=True)
+            if errors:
+                raise RuntimeError(f"iblock {iblock_id}: ошибки страниц {list(errors)[:5]}")
+            for res in results.values():
+                collect(_extract_list_items({"result": res}), names)
+        if names:
+            _learn_iblock_type(iblock_id, iblock_type)
+        return names, iblock_type
+    raise RuntimeError(f"iblock {iblock_id}: ни один IBLOCK_TYPE_ID не подошёл ({', '.join(candidates)})")
+
+
+def sync_iblock_dictionaries() -> Dict[str, Any]:
+    """Скачать целиком справочники всех iblock-полей из b24_meta_fields и записать в IBLOCK_CACHE_TABLE
+    (один execute_values на iblock) и в память. После этого расшифровка не ходит в Bitrix за известными элементами."""
+    iblocks: Dict[int, Optional[str]] = {}
+    for mi in get_meta_snapshot().meta.values():
+        if mi.b24_type == "iblock_element" and mi.iblock_id:
+            iblocks.setdefault(mi.iblock_id, mi.iblock_type_id)
+    started = time.time()
+    with _iblock_dict_lock:
+        _iblock_sync_status.update(state="running", started_at=datetime.now(timezone.utc).isoformat(), errors={})
+    total = 0
+    for iblock_id, iblock_type_id in sorted(iblocks.items()):
+        try:
+            names, used_type = _fetch_iblock_all_elements(iblock_id, iblock_type_id)
+        except Exception as e:
+            with _iblock_dict_lock:
+                _iblock_sync_status["errors"][str(iblock_id)] = str(e)[:300]
+            print(f"WARN sync_iblock_dictionaries: {e}", file=sys.stderr, flush=True)
+            continue
+        if names:
+            conn = _pg_conn()
+            try:
+                _save_iblock_cache(conn, names)
+            finally:
+                conn.close()
+        with _iblock_dict_lock:
+            _iblock_dict.update(names)
+            for p in names:
+                _iblock_negative.pop(p, None)
+            _iblock_dict_synced[iblock_id] = {
+                "elements": len(names),
+                "iblock_type_id": used_type,
+                "synced_at": datetime.now(timezone.utc).isoformat(),
+            }
+        total += len(names)
+    with _iblock_dict_lock:
+        _iblock_dict_stats["full_syncs"] += 1
+        _iblock_sync_status.update(
+            state="done", finished_at=datetime.now(timezone.utc).isoformat(),
+            elapsed_sec=round(time.time() - started, 1), iblocks=len(iblocks), elements=total,
+        )
+    print(f"IBLOCK_SYNC: справочники iblock обновлены: {len(iblocks)} iblock, {total} элементов", flush=True)
+    return get_iblock_dictionaries_status()
+
+
+def get_iblock_dictionaries_status() -> Dict[str, Any]:
+    with _iblock_types_lock:
+        learned_types = {str(ib): t for ib, t in _iblock_learned_types.items()}
+    with _iblock_dict_lock:
+        return {
+            **_iblock_sync_status, "errors": dict(_iblock_sync_status.get("errors") or {}),
+            **_iblock_dict_stats,
+            "in_memory": len(_iblock_dict),
+            "pending_refresh": len(_iblock_refresh_pending),
+            "negative_cached": len(_iblock_negative),
+            "negative_ttl_sec": IBLOCK_NEGATIVE_TTL_SEC,
+            "learned_types": learned_types,
+            "synced_iblocks": {str(ib): dict(v) for ib, v in _iblock_dict_synced.items()},
+            "interval_sec": IBLOCK_SYNC_INTERVAL_SEC,
+        }
+
+
+def _iblock_sync_loop() -> None:
+    while True:
+        try:
+            sync_iblock_dictionaries()
+        except Exception as e:
+            with _iblock_dict_lock:
+                _iblock_sync_status.update(state="error", last_error=str(e)[:300])
+            print(f"WARN IBLOCK_SYNC: {e}", file=sys.stderr, flush=True)
+        time.sleep(max(60, IBLOCK_SYNC_INTERVAL_SEC))
+
+
+def start_iblock_sync_thread(force: bool = False) -> Dict[str, Any]:
+    """Фоновая синхронизация справочников iblock: при старте и раз в IBLOCK_SYNC_INTERVAL_SEC;
+    force=True — разовый прогон сейчас (из API)."""
+    global _iblock_sync_thread
+    with _iblock_dict_lock:
+        running = _iblock_sync_status.get("state") == "running"
+    if running:
+        return {"started": False, "message": "синхронизация уже идёт"}
+    if force:
+        threading.Thread(target=sync_iblock_dictionaries, daemon=True).start()
+        return {"started": True}
+    if not IBLOCK_SYNC_ENABLED:
+        return {"started": False, "message": "IBLOCK_SYNC_ENABLED=0"}
+    if _iblock_sync_thread and _iblock_sync_thread.is_alive():
+        return {"started": False, "message": "уже запущено"}
+    _iblock_sync_thread = threading.Thread(target=_iblock_sync_loop, daemon=True)
+    _iblock_sync_thread.start()
+    return {"started": True}
+
+
+def _read_enum_cache(conn) -> Dict[str, Dict[str, str]]:
+    out: Dict[str, Dict[str, str]] = {}
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute(
+            f"SELECT b24_field, enum_map FROM {ENUM_CACHE_TABLE} WHERE entity_type_id = %s",
+            (SMART_ENTITY_TYPE_ID,),
+        )
+        for r in cur.fetchall():
+            b24_field = str(r.get("b24_field") or "").strip()
+            enum_map = r.get("enum_map") or {}
+            if b24_field:
+                out[b24_field] = {str(k): str(v) for k, v in enum_map.items()}
+    return out
+
+
+@dataclass(frozen=True)
+class MetaSnapshot:
+    """meta (b24_meta_fields sp:1114) и enum-кэш одной версии; только для чтения, общий для всех потоков."""
+    meta: Mapping[str, MetaInfo]
+    enum_cache: Mapping[str, Mapping[str, str]]
+    version: Tuple[Any, ...]
+    loaded_at: float
+
+
+_EMPTY_META_SNAPSHOT = MetaSnapshot(MappingProxyType({}), MappingProxyType({}), (), 0.0)
+_meta_snapshot: Optional[MetaSnapshot] = None
+_meta_snapshot_checked_at = 0.0
+_meta_snapshot_lock = threading.Lock()
+_meta_snapshot_stats: Dict[str, int] = {"reloads": 0, "probes": 0, "errors": 0}
+
+
+def _probe_meta_version(conn) -> Tuple[Any, ...]:
+    """Дешёвая версия meta + enum: число строк и max(xmin). b24_meta_fields наполняет другой сервис,
+    updated_at там не гарантирован; xmin меняется при любом INSERT/UPDATE строки, count — при DELETE."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""SELECT (SELECT count(*) FROM {META_TABLE} WHERE entity_key = %s),
+                       (SELECT max(xmin::text::bigint) FROM {META_TABLE} WHERE entity_key = %s),
+                       (SELECT count(*) FROM {ENUM_CACHE_TABLE} WHERE entity_type_id = %s),
+                       (SELECT max(xmin::text::bigint) FROM {ENUM_CACHE_TABLE} WHERE entity_type_id = %s)""",
+            (ENTITY_KEY_SP1114, ENTITY_KEY_SP1114, SMART_ENTITY_TYPE_ID, SMART_ENTITY_TYPE_ID),
+        )
+        return tuple(cur.fetchone())
+
+
+def _load_meta_snapshot(previous: Optional[MetaSnapshot]) -> MetaSnapshot:
+    """Одно соединение: проверка версии; если изменилась (или истёк TTL) — перечитать meta и enum."""
+    conn = _pg_conn()
     try:
-        conn = _pg_conn()
-        _ensure_iblock_cache_table(conn)
-        out = _load_iblock_cache(conn, pairs)
-        missing = [p for p in pairs if p not in out]
-        if missing and ENABLE_IBLOCK_API_LOOKUP:
-            api_map = _fetch_iblock_names_from_bitrix(missing, iblock_type_map)
-            if api_map:
-                _save_iblock_cache(conn, api_map)
-                out.update(api_map)
+        if previous is None:
+            _ensure_schema(conn)
+        version = _probe_meta_version(conn)
+        _meta_snapshot_stats["probes"] += 1
+        if (
+            previous is not None
+            and version == previous.version
+            and time.time() - previous.loaded_at < META_SNAPSHOT_TTL_SEC
+        ):
+            return previous
+        meta = _read_meta_map(conn)
+        enum_cache = _read_enum_cache(conn)
+    finally:
         conn.close()
-        return out
-    except Exception as e:
-        print(f"WARN resolve_iblock_names: {e}", file=sys.stderr, flush=True)
-        return {}
+    _meta_snapshot_stats["reloads"] += 1
+    return MetaSnapshot(
+        meta=MappingProxyType(meta),
+        enum_cache=MappingProxyType({k: MappingProxyType(v) for k, v in enum_cache.items()}),
+        version=version,
+        loaded_at=time.time(),
+    )
+
+
+def get_meta_snapshot() -> MetaSnapshot:
+    """Текущий снимок meta + enum. Версия в БД проверяется не чаще META_SNAPSHOT_PROBE_SEC
+    (между проверками — ноль запросов); пока один поток проверяет, остальные берут текущий снимок.
+    При ошибке БД остаётся прежний снимок."""
+    global _meta_snapshot, _meta_snapshot_checked_at
+    snap = _meta_snapshot
+    if snap is not None and time.time() - _meta_snapshot_checked_at < META_SNAPSHOT_PROBE_SEC:
+        return snap
+    if not _meta_snapshot_lock.acquire(blocking=snap is None):
+        return snap
+    try:
+        if _meta_snapshot is not snap and _meta_snapshot is not None:
+            return _meta_snapshot
+        try:
+            fresh = _load_meta_snapshot(snap)
+        except Exception as e:
+            _meta_snapshot_stats["errors"] += 1
+            print(f"WARN get_meta_snapshot: {e}", file=sys.stderr, flush=True)
+            if snap is None:
+                return _EMPTY_META_SNAPSHOT
+            fresh = snap
+        _meta_snapshot = fresh
+        _meta_snapshot_checked_at = time.time()
+        return fresh
+    finally:
+        _meta_snapshot_lock.release()
+
 
+def invalidate_meta_snapshot() -> None:
+    """Следующий get_meta_snapshot() перечитает meta и enum из БД."""
+    global _meta_snapshot, _meta_snapshot_checked_at
+    with _meta_snapshot_lock:
+        _meta_snapshot = None
+        _meta_snapshot_checked_at = 0.0
 
-def _ensure_enum_cache_table(conn) -> None:
-    with conn.cursor() as cur:
-        cur.execute(
-            f"""CREATE TABLE IF NOT EXISTS {ENUM_CACHE_TABLE} (
-                entity_type_id INTEGER NOT NULL,
-                b24_field TEXT NOT NULL,
-                enum_map JSONB NOT NULL,
-                updated_at TIMESTAMPTZ DEFAULT now(),
-                PRIMARY KEY (entity_type_id, b24_field)
-            )"""
-        )
-    conn.commit()
 
+def get_meta_snapshot_status() -> Dict[str, Any]:
+    snap = _meta_snapshot
+    return {
+        **_meta_snapshot_stats,
+        "loaded": snap is not None,
+        "fields": len(snap.meta) if snap else 0,
+        "enum_fields": len(snap.enum_cache) if snap else 0,
+        "version": list(snap.version) if snap else None,
+        "age_sec": round(time.time() - snap.loaded_at, 1) if snap else None,
+        "checked_sec_ago": round(time.time() - _meta_snapshot_checked_at, 1) if snap else None,
+        "ttl_sec": META_SNAPSHOT_TTL_SEC,
+        "probe_sec": META_SNAPSHOT_PROBE_SEC,
+    }
 
-def load_enum_cache() -> Dict[str, Dict[str, str]]:
-    out: Dict[str, Dict[str, str]] = {}
-    try:
-        conn = _pg_conn()
-        _ensure_enum_cache_table(conn)
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(
-                f"SELECT b24_field, enum_map FROM {ENUM_CACHE_TABLE} WHERE entity_type_id = %s",
-                (SMART_ENTITY_TYPE_ID,),
-            )
-            for r in cur.fetchall():
-                b24_field = str(r.get("b24_field") or "").strip()
-                enum_map = r.get("enum_map") or {}
-                if b24_field:
-                    out[b24_field] = {str(k): str(v) for k, v in enum_map.items()}
-        conn.close()
-    except Exception as e:
-        print(f"WARN load_enum_cache: {e}", file=sys.stderr, flush=True)
-    return out
+
+def load_meta_map() -> Mapping[str, MetaInfo]:
+    return get_meta_snapshot().meta
 
 
-def _decode_enum_value(val: Any, enum_map: Dict[str, str]) -> str:
+def load_enum_cache() -> Mapping[str, Mapping[str, str]]:
+    return get_meta_snapshot().enum_cache
+
+
+def _decode_enum_value(val: Any, enum_map: Mapping[str, str]) -> str:
     if val is None:
         return ""
     if isinstance(val, list):
@@ -1106,37 +3275,55 @@ def _decode_enum_value(val: Any, enum_map: Dict[str, str]) -> str:
     return s
 
 
+FieldDecoder = Callable[[Any, Dict[Tuple[int, int], str]], str]
+
+
+def _compile_field_decoder(mi: Optional[MetaInfo], enum_cache: Mapping[str, Mapping[str, str]]) -> FieldDecoder:
+    """Расшифровщик одного поля raw: тип поля и enum-карта выбраны заранее, на значение — только ветка своего типа."""
+    if mi and mi.b24_type == "iblock_element" and mi.iblock_id:
+        iblock_id = mi.iblock_id
+
+        def decode_typed(txt: str, raw_value: Any, iblock_names: Dict[Tuple[int, int], str]) -> str:
+            t = txt[:-2] if txt.endswith(".0") else txt
+            try:
+                eid = int(float(t))
+            except Exception:
+                return txt
+            return iblock_names.get((iblock_id, eid), txt)
+    else:
+        enum_map: Mapping[str, str] = (mi.enum_map if mi else None) or {}
+        if mi and not enum_map and mi.b24_field and mi.b24_field in enum_cache:
+            enum_map = enum_cache[mi.b24_field]
+        if enum_map:
+            def decode_typed(txt: str, raw_value: Any, iblock_names: Dict[Tuple[int, int], str]) -> str:
+                return _decode_enum_value(raw_value, enum_map) or txt
+        else:
+            def decode_typed(txt: str, raw_value: Any, iblock_names: Dict[Tuple[int, int], str]) -> str:
+                return txt
+
+    def decode(raw_value: Any, iblock_names: Dict[Tuple[int, int], str]) -> str:
+        if isinstance(raw_value, list) and raw_value:
+            return decode(raw_value[0], iblock_names)
+        if isinstance(raw_value, dict):
+            txt = str(raw_value.get("value") or raw_value.get("id") or raw_value.get("title") or raw_value.get("name") or "")
+        else:
+            txt = str(raw_value).strip() if raw_value is not None else ""
+        if not txt:
+            return ""
+        return decode_typed(txt, raw_value, iblock_names)
+
+    return decode
+
+
 def decode_value_for_raw_key(
     raw_key: str,
     raw_value: Any,
-    meta: Dict[str, MetaInfo],
+    meta: Mapping[str, MetaInfo],
     iblock_names: Dict[Tuple[int, int], str],
-    enum_cache: Dict[str, Dict[str, str]],
+    enum_cache: Mapping[str, Mapping[str, str]],
 ) -> str:
-    txt = str(raw_value).strip() if raw_value is not None else ""
-    if isinstance(raw_value, dict):
-        txt = str(raw_value.get("value") or raw_value.get("id") or raw_value.get("title") or raw_value.get("name") or "")
-    if isinstance(raw_value, list) and raw_value:
-        return decode_value_for_raw_key(raw_key, raw_value[0], meta, iblock_names, enum_cache)
-    if not txt:
-        return ""
-    col = _raw_key_to_column_name(raw_key)
-    mi = meta.get(col.lower())
-    if not mi:
-        return txt
-    if mi.b24_type == "iblock_element" and mi.iblock_id:
-        t = txt[:-2] if txt.endswith(".0") else txt
-        try:
-            eid = int(float(t))
-        except Exception:
-            return txt
-        return iblock_names.get((mi.iblock_id, eid), txt)
-    enum_map = mi.enum_map or {}
-    if not enum_map and mi.b24_field and mi.b24_field in enum_cache:
-        enum_map = enum_cache[mi.b24_field]
-    if enum_map:
-        return _decode_enum_value(raw_value, enum_map) or txt
-    return txt
+    mi = meta.get(_raw_key_to_column_name(raw_key).lower())
+    return _compile_field_decoder(mi, enum_cache)(raw_value, iblock_names)
 
 
 def _raw_str(v: Any) -> str:
@@ -1151,14 +3338,13 @@ def _raw_str(v: Any) -> str:
 
 def fetch_raw_by_item_id(item_id: int) -> Optional[Dict[str, Any]]:
     try:
-        conn = _pg_conn()
-        with conn.cursor() as cur:
-            cur.execute(
-                f"SELECT raw FROM {DATA_TABLE_SP1114} WHERE (raw->>'id')::bigint = %s LIMIT 1",
-                (int(item_id),),
-            )
-            row = cur.fetchone()
-        conn.close()
+        with _pg_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"SELECT t.raw FROM {DATA_TABLE_SP1114} t WHERE {SQL_ITEM_ID} = %s LIMIT 1",
+                    (int(item_id),),
+                )
+                row = cur.fetchone()
         if row and row[0]:
             return row[0] if isinstance(row[0], dict) else None
     except Exception as e:
@@ -1195,24 +3381,8 @@ def _is_stage_allowed_for_999(raw: Dict[str, Any]) -> bool:
     return stage in STAGE_IDS_ALLOWED_999
 
 
-def _ensure_999_sent_table(conn) -> None:
-    with conn.cursor() as cur:
-        cur.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS {SENT_999_TABLE} (
-                item_id BIGINT PRIMARY KEY,
-                sent_at TIMESTAMPTZ DEFAULT now()
-            )
-            """
-        )
-        cur.execute(f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS advert_id BIGINT")
-        cur.execute(f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS last_sync_raw_hash TEXT")
-        cur.execute(f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS last_sync_at TIMESTAMPTZ")
-    conn.commit()
-
-
 def _was_sent_to_999(conn, item_id: int) -> bool:
-    _ensure_999_sent_table(conn)
+    _ensure_schema(conn)
     with conn.cursor() as cur:
         cur.execute(f"SELECT 1 FROM {SENT_999_TABLE} WHERE item_id = %s", (int(item_id),))
         return cur.fetchone() is not None
@@ -1229,13 +3399,14 @@ def _was_sent_to_tg(conn, item_id: int) -> bool:
 
 
 def _get_item_raw_hash_for_999(conn, item_id: int) -> Optional[str]:
+    """Текущий sync_hash машины (хэш полей, влияющих на объявление) — то, с чем сравнивает синхронизация."""
     try:
         with conn.cursor() as cur:
             cur.execute(
                 f"""
-                SELECT md5(COALESCE(t.raw::text, ''))
+                SELECT public.b24_999_sync_hash(t.raw)
                 FROM {DATA_TABLE_SP1114} t
-                WHERE (t.raw->>'id')::bigint = %s
+                WHERE {SQL_ITEM_ID} = %s
                 LIMIT 1
                 """,
                 (int(item_id),),
@@ -1245,11 +3416,12 @@ def _get_item_raw_hash_for_999(conn, item_id: int) -> Optional[str]:
                 return None
             return str(row[0]) if row[0] else None
     except Exception:
+        conn.rollback()
         return None
 
 
 def _mark_999_sync_state(conn, item_id: int, raw_hash: Optional[str]) -> None:
-    _ensure_999_sent_table(conn)
+    _ensure_schema(conn)
     with conn.cursor() as cur:
         cur.execute(
             f"""
@@ -1265,68 +3437,134 @@ def _mark_999_sync_state(conn, item_id: int, raw_hash: Optional[str]) -> None:
 
 def _mark_sent_to_999(conn, item_id: int, advert_id: Optional[int] = None) -> None:
     """Записать item_id (и advert_id при наличии) в b24_999_sent_items."""
-    _ensure_999_sent_table(conn)
+    _ensure_schema(conn)
     raw_hash = _get_item_raw_hash_for_999(conn, item_id)
     with conn.cursor() as cur:
         if advert_id is not None:
             cur.execute(
-                f"""INSERT INTO {SENT_999_TABLE} (item_id, advert_id, last_sync_raw_hash, last_sync_at)
-                    VALUES (%s, %s, %s, now())
-                    ON CONFLICT (item_id) DO UPDATE SET advert_id = EXCLUDED.advert_id, last_sync_raw_hash = EXCLUDED.last_sync_raw_hash, last_sync_at = EXCLUDED.last_sync_at""",
-                (int(item_id), int(advert_id), raw_hash),
+                f"""INSERT INTO {SENT_999_TABLE} (item_id, advert_id, last_sync_raw_hash, sync_hash, last_sync_at)
+                    VALUES (%s, %s, %s, %s, now())
+                    ON CONFLICT (item_id) DO UPDATE SET advert_id = EXCLUDED.advert_id, last_sync_raw_hash = EXCLUDED.last_sync_raw_hash, sync_hash = EXCLUDED.sync_hash, last_sync_at = EXCLUDED.last_sync_at""",
+                (int(item_id), int(advert_id), raw_hash, raw_hash),
             )
         else:
             cur.execute(
-                f"INSERT INTO {SENT_999_TABLE} (item_id) VALUES (%s) ON CONFLICT (item_id) DO NOTHING",
-                (int(item_id),),
+                f"INSERT INTO {SENT_999_TABLE} (item_id, sync_hash) VALUES (%s, %s) ON CONFLICT (item_id) DO NOTHING",
+                (int(item_id), raw_hash),
             )
     conn.commit()
 
 
-def fetch_next_raw_for_999(include_last_14_days_only: bool = True) -> Optional[Dict[str, Any]]:
-    """Следующая машина для 999. Только стадии Nobil 1/2/Arena, ещё не на 999. Без привязки к tg_sent_items."""
-    conn = None
-    try:
-        conn = _pg_conn()
-        _ensure_999_sent_table(conn)
-        created_expr = "COALESCE(NULLIF(t.raw->>'createdTime','')::timestamptz, NULLIF(t.raw->>'createdate','')::timestamptz)"
-        scalar_filters = [f"COALESCE(t.raw->>'{k}', '') <> ''" for k in REQUIRE_ALL_FILLED_SCALAR_FIELDS]
-        scalar_sql = " AND ".join(scalar_filters) if scalar_filters else "TRUE"
-        stage_placeholders = ", ".join(["%s"] * len(STAGE_IDS_ALLOWED_999))
-        params = (
-            *STAGE_IDS_ALLOWED_999,
-            CATEGORY_ID_SP1114,
-            PHOTO_RAW_KEY,
-            PHOTO_RAW_KEY,
-            PHOTO_RAW_KEY,
-            MIN_PHOTOS_999,
-        )
+# Выражения над raw — те же, что в индексах миграции 7 (b24_sp_f_1114): иначе планировщик индекс не возьмёт.
+SQL_ITEM_ID = "public.b24_999_item_id(t.raw)"
+SQL_STAGE = "public.b24_999_stage(t.raw)"
+SQL_CREATED_AT = "public.b24_999_created_at(t.raw)"
+SQL_CATEGORY = "COALESCE(t.categoryid::text, t.raw->>'categoryId')"
+
+
+def _queue_filter_sql() -> Tuple[str, tuple]:
+    """Общий фильтр «машина подходит под 999»: стадия, категория, фото >= MIN_PHOTOS_999, заполненные скаляры."""
+    scalar_filters = [f"COALESCE(t.raw->>'{k}', '') <> ''" for k in REQUIRE_ALL_FILLED_SCALAR_FIELDS]
+    scalar_sql = " AND ".join(scalar_filters) if scalar_filters else "TRUE"
+    stage_placeholders = ", ".join(["%s"] * len(STAGE_IDS_ALLOWED_999))
+    sql = f"""{SQL_STAGE} IN ({stage_placeholders})
+          AND {SQL_CATEGORY} = %s
+          AND public.b24_999_photo_count(t.raw, %s) >= %s
+          AND {scalar_sql}"""
+    return sql, (*STAGE_IDS_ALLOWED_999, CATEGORY_ID_SP1114, PHOTO_RAW_KEY, MIN_PHOTOS_999)
+
+
+def _candidates_ready_sql() -> str:
+    """Кандидат готов: правила пройдены, не на 999, нет задачи в очереди публикаций (и недавно проваленной авто/ретро —
+    ручной запуск с retry=False падает с первой ошибки, и это не повод закрывать машину для авто-публикации на сутки)."""
+    return f"""c.reason IS NULL AND NOT c.sent
+              AND NOT EXISTS (
+                  SELECT 1 FROM {PUBLISH_JOBS_TABLE} j
+                  WHERE j.item_id = c.item_id
+                    AND ({PUBLISH_JOB_ACTIVE_SQL}
+                         OR (j.state = 'failed' AND j.source IN ('auto', 'retro')
+                             AND j.updated_at > now() - interval '{PUBLISH_JOB_FAILED_COOLDOWN_SEC} seconds'))
+              )"""
+
+
+def _next_raw_for_999_query(include_last_14_days_only: bool = True) -> Tuple[str, tuple]:
+    """После миграций — индексный pop из CANDIDATES_999_TABLE; до них — полный фильтр по b24_sp_f_1114."""
+    if _schema_ready:
         created_filter_sql = (
-            f"AND {created_expr} >= (now() AT TIME ZONE 'UTC') - interval '14 days'"
+            "AND c.created_at >= (now() AT TIME ZONE 'UTC') - interval '14 days'"
             if include_last_14_days_only else
             ""
         )
-        order_sql = (
-            f"{created_expr} DESC NULLS LAST"
-            if include_last_14_days_only else
-            f"{created_expr} ASC NULLS LAST"
-        )
+        order_sql = "c.created_at DESC NULLS LAST" if include_last_14_days_only else "c.created_at ASC NULLS LAST"
         q = f"""
             SELECT t.raw
-            FROM {DATA_TABLE_SP1114} t
-            LEFT JOIN {SENT_999_TABLE} s ON s.item_id = NULLIF(t.raw->>'id','')::bigint
-            WHERE s.item_id IS NULL
-              AND t.raw ? 'id'
-              AND COALESCE(TRIM(t.raw->>'stageId'), '') IN ({stage_placeholders})
-              AND COALESCE(t.categoryid::text, t.raw->>'categoryId') = %s
-              AND t.raw ? %s
-              AND jsonb_typeof(t.raw->%s) = 'array'
-              AND jsonb_array_length(t.raw->%s) >= %s
+            FROM {CANDIDATES_999_TABLE} c
+            JOIN {DATA_TABLE_SP1114} t ON {SQL_ITEM_ID} = c.item_id
+            WHERE {_candidates_ready_sql()}
               {created_filter_sql}
-              AND {scalar_sql}
             ORDER BY {order_sql}
             LIMIT 1
         """
+        return q, ()
+    filter_sql, params = _queue_filter_sql()
+    created_filter_sql = (
+        f"AND {SQL_CREATED_AT} >= (now() AT TIME ZONE 'UTC') - interval '14 days'"
+        if include_last_14_days_only else
+        ""
+    )
+    order_sql = (
+        f"{SQL_CREATED_AT} DESC NULLS LAST"
+        if include_last_14_days_only else
+        f"{SQL_CREATED_AT} ASC NULLS LAST"
+    )
+    q = f"""
+        SELECT t.raw
+        FROM {DATA_TABLE_SP1114} t
+        LEFT JOIN {SENT_999_TABLE} s ON s.item_id = {SQL_ITEM_ID}
+        WHERE s.item_id IS NULL
+          AND {SQL_ITEM_ID} IS NOT NULL
+          AND {filter_sql}
+          {created_filter_sql}
+        ORDER BY {order_sql}
+        LIMIT 1
+    """
+    return q, params
+
+
+def _eligible_for_999_query(limit: int = 500) -> Tuple[str, tuple]:
+    if _schema_ready:
+        q = f"""
+            SELECT t.raw, tg.sent_at
+            FROM {CANDIDATES_999_TABLE} c
+            JOIN {DATA_TABLE_SP1114} t ON {SQL_ITEM_ID} = c.item_id
+            LEFT JOIN {SENT_TG_TABLE} tg ON tg.item_id = c.item_id
+            WHERE {_candidates_ready_sql()}
+            ORDER BY tg.sent_at ASC NULLS LAST, c.created_at DESC NULLS LAST
+            LIMIT %s
+        """
+        return q, (limit,)
+    filter_sql, params = _queue_filter_sql()
+    q = f"""
+        SELECT t.raw, tg.sent_at
+        FROM {DATA_TABLE_SP1114} t
+        LEFT JOIN {SENT_TG_TABLE} tg ON tg.item_id = {SQL_ITEM_ID}
+        LEFT JOIN {SENT_999_TABLE} s ON s.item_id = {SQL_ITEM_ID}
+        WHERE s.item_id IS NULL
+          AND {SQL_ITEM_ID} IS NOT NULL
+          AND {filter_sql}
+        ORDER BY tg.sent_at ASC NULLS LAST, {SQL_CREATED_AT} DESC NULLS LAST
+        LIMIT %s
+    """
+    return q, (*params, limit)
+
+
+def fetch_next_raw_for_999(include_last_14_days_only: bool = True) -> Optional[Dict[str, Any]]:
+    """Следующая машина для 999. Только стадии Nobil 1/2/Arena, ещё не на 999. Без привязки к tg_sent_items."""
+    conn = None
+    try:
+        conn = _pg_conn()
+        _ensure_schema(conn)
+        q, params = _next_raw_for_999_query(include_last_14_days_only)
         with conn.cursor() as cur:
             cur.execute(q, params)
             row = cur.fetchone()
@@ -1348,36 +3586,8 @@ def fetch_all_eligible_for_999(limit: int = 500) -> List[Dict[str, Any]]:
     conn = None
     try:
         conn = _pg_conn()
-        _ensure_999_sent_table(conn)
-        created_expr = "COALESCE(NULLIF(t.raw->>'createdTime','')::timestamptz, NULLIF(t.raw->>'createdate','')::timestamptz)"
-        scalar_filters = [f"COALESCE(t.raw->>'{k}', '') <> ''" for k in REQUIRE_ALL_FILLED_SCALAR_FIELDS]
-        scalar_sql = " AND ".join(scalar_filters) if scalar_filters else "TRUE"
-        stage_placeholders = ", ".join(["%s"] * len(STAGE_IDS_ALLOWED_999))
-        params = (
-            *STAGE_IDS_ALLOWED_999,
-            CATEGORY_ID_SP1114,
-            PHOTO_RAW_KEY,
-            PHOTO_RAW_KEY,
-            PHOTO_RAW_KEY,
-            MIN_PHOTOS_999,
-            limit,
-        )
-        q = f"""
-            SELECT t.raw, tg.sent_at
-            FROM {DATA_TABLE_SP1114} t
-            LEFT JOIN {SENT_TG_TABLE} tg ON tg.item_id = NULLIF(t.raw->>'id','')::bigint
-            LEFT JOIN {SENT_999_TABLE} s ON s.item_id = NULLIF(t.raw->>'id','')::bigint
-            WHERE s.item_id IS NULL
-              AND t.raw ? 'id'
-              AND COALESCE(TRIM(t.raw->>'stageId'), '') IN ({stage_placeholders})
-              AND COALESCE(t.categoryid::text, t.raw->>'categoryId') = %s
-              AND t.raw ? %s
-              AND jsonb_typeof(t.raw->%s) = 'array'
-              AND jsonb_array_length(t.raw->%s) >= %s
-              AND {scalar_sql}
-            ORDER BY tg.sent_at ASC NULLS LAST, {created_expr} DESC NULLS LAST
-            LIMIT %s
-        """
+        _ensure_schema(conn)
+        q, params = _eligible_for_999_query(limit)
         with conn.cursor() as cur:
             cur.execute(q, params)
             rows = cur.fetchall()
@@ -1410,26 +3620,23 @@ def fetch_all_eligible_for_999(limit: int = 500) -> List[Dict[str, Any]]:
 def fetch_random_raw_for_999() -> Optional[Dict[str, Any]]:
     """Случайная машина для 999 — только стадии Nobil 1/2/Arena. Без tg_sent_items."""
     try:
-        conn = _pg_conn()
-        stage_placeholders = ", ".join(["%s"] * len(STAGE_IDS_ALLOWED_999))
-        params = (*STAGE_IDS_ALLOWED_999, CATEGORY_ID_SP1114, PHOTO_RAW_KEY, PHOTO_RAW_KEY, PHOTO_RAW_KEY)
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT t.raw
-                FROM {DATA_TABLE_SP1114} t
-                WHERE COALESCE(TRIM(t.raw->>'stageId'), '') IN ({stage_placeholders})
-                  AND COALESCE(t.categoryid::text, t.raw->>'categoryId') = %s
-                  AND t.raw ? %s
-                  AND jsonb_typeof(t.raw->%s) = 'array'
-                  AND jsonb_array_length(t.raw->%s) > 0
-                ORDER BY random()
-                LIMIT 1
-                """,
-                params,
-            )
-            row = cur.fetchone()
-        conn.close()
+        with _pg_conn() as conn:
+            stage_placeholders = ", ".join(["%s"] * len(STAGE_IDS_ALLOWED_999))
+            params = (*STAGE_IDS_ALLOWED_999, CATEGORY_ID_SP1114, PHOTO_RAW_KEY)
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    SELECT t.raw
+                    FROM {DATA_TABLE_SP1114} t
+                    WHERE {SQL_STAGE} IN ({stage_placeholders})
+                      AND {SQL_CATEGORY} = %s
+                      AND public.b24_999_photo_count(t.raw, %s) > 0
+                    ORDER BY random()
+                    LIMIT 1
+                    """,
+                    params,
+                )
+                row = cur.fetchone()
         if row and row[0]:
             return row[0] if isinstance(row[0], dict) else None
     except Exception as e:
@@ -1449,125 +3656,228 @@ def get_item_id_from_raw(raw: Dict[str, Any]) -> Optional[int]:
     return None
 
 
-def car_data_from_raw(raw: Dict[str, Any]) -> Dict[str, Any]:
-    bitrix_webhook = _bitrix_webhook()
-    photo_urls = extract_photo_urls_from_raw(raw, bitrix_webhook)
+# Поля, которые ищутся по названию (b24_title), а не по фиксированному ключу raw
+DECODE_TITLE_GROUPS: Dict[str, List[str]] = {
+    "year": ["Anul producerii", "Год выпуска", "Year"],
+    "numar": ["Numar Auto", "Номер авто", "Car number", "Numar auto"],
+    "body": ["Caroserie", "Тип кузова", "Body type"],
+    "fuel": ["Tipul de combustibil", "Тип топлива", "Fuel type"],
+    "engine": ["Volumul motorului", "Объем двигателя", "Engine volume"],
+    "drive": ["Tracţiune", "Tracțiune", "Привод", "Drive"],
+    "transmission": ["Transmisie", "Cutie", "Кпп", "КПП", "Transmission", "Gearbox"],
+}
+YEAR_TITLE_WORDS = ("anul", "год", "year", "producerii", "выпуска")
+RAW_FIELDS_FOR_IBLOCK = [
+    RAW_FIELDS_MARCA, RAW_FIELDS_MODEL, RAW_FIELDS_YEAR, RAW_FIELDS_BODY,
+    RAW_FIELDS_ENGINE, RAW_FIELDS_FUEL, RAW_FIELDS_DRIVE, RAW_FIELDS_TRANSMISSION,
+]
+YEAR_SCAN_SKIP_KEYS = frozenset({RAW_FIELDS_PRICE, RAW_FIELDS_MILEAGE, RAW_FIELDS_LINK, RAW_FIELDS_MARCA, RAW_FIELDS_MODEL, PHOTO_RAW_KEY})
+
+
+class DecodePlan:
+    """Расшифровка raw, собранная один раз из MetaSnapshot: raw key -> расшифровщик, ключи полей по названию,
+    iblock-поля марки/модели/..., кандидаты для года. car_data_from_raw только исполняет план."""
+
+    def __init__(self, snapshot: MetaSnapshot) -> None:
+        self.snapshot = snapshot
+        self._decoders: Dict[str, FieldDecoder] = {}
+        # iblock-поля, имена элементов которых нужны до расшифровки: (raw key, iblock_id, iblock_type_id)
+        self.iblock_fields: List[Tuple[str, int, Optional[str]]] = []
+        for rk in RAW_FIELDS_FOR_IBLOCK:
+            mi = snapshot.meta.get(_raw_key_to_column_name(rk).lower())
+            if mi and mi.b24_type == "iblock_element" and mi.iblock_id:
+                self.iblock_fields.append((rk, mi.iblock_id, mi.iblock_type_id))
+        # Название поля -> b24_field первого (в порядке meta) поля с таким названием
+        first_by_title: Dict[str, Tuple[int, Optional[str]]] = {}
+        self.year_title_keys: List[str] = []
+        for pos, mi in enumerate(snapshot.meta.values()):
+            t = (mi.b24_title or "").strip().lower()
+            if not t:
+                continue
+            first_by_title.setdefault(t, (pos, mi.b24_field))
+            if mi.b24_field and any(w in t for w in YEAR_TITLE_WORDS):
+                self.year_title_keys.append(mi.b24_field)
+        self.title_keys: Dict[str, Optional[str]] = {}
+        for group, titles in DECODE_TITLE_GROUPS.items():
+            hits = [first_by_title[t.strip().lower()] for t in titles if t and t.strip().lower() in first_by_title]
+            self.title_keys[group] = min(hits)[1] if hits else None
+
+    def decoder(self, raw_key: str) -> FieldDecoder:
+        dec = self._decoders.get(raw_key)
+        if dec is None:
+            mi = self.snapshot.meta.get(_raw_key_to_column_name(raw_key).lower())
+            dec = self._decoders.setdefault(raw_key, _compile_field_decoder(mi, self.snapshot.enum_cache))
+        return dec
+
+    def iblock_pairs(self, raw: Dict[str, Any]) -> Tuple[List[Tuple[int, int]], Dict[int, Optional[str]]]:
+        pairs: List[Tuple[int, int]] = []
+        iblock_type_map: Dict[int, Optional[str]] = {}
+        for rk, iblock_id, iblock_type_id in self.iblock_fields:
+            t = _raw_str(raw.get(rk)).strip()
+            if not t:
+                continue
+            t = t[:-2] if t.endswith(".0") else t
+            try:
+                eid = int(float(t))
+            except Exception:
+                continue
+            pairs.append((iblock_id, eid))
+            iblock_type_map[iblock_id] = iblock_type_id
+        return pairs, iblock_type_map
 
-    meta = load_meta_map()
-    enum_cache = load_enum_cache()
 
-    raw_fields_for_iblock = [RAW_FIELDS_MARCA, RAW_FIELDS_MODEL, RAW_FIELDS_YEAR, RAW_FIELDS_BODY, RAW_FIELDS_ENGINE, RAW_FIELDS_FUEL, RAW_FIELDS_DRIVE, RAW_FIELDS_TRANSMISSION]
-    pairs: List[Tuple[int, int]] = []
-    iblock_type_map: Dict[int, Optional[str]] = {}
-    for rk in raw_fields_for_iblock:
-        col = _raw_key_to_column_name(rk).lower()
-        mi = meta.get(col)
-        if not mi or mi.b24_type != "iblock_element" or not mi.iblock_id:
-            continue
-        v = raw.get(rk)
-        t = _raw_str(v).strip()
-        if not t:
-            continue
-        t = t[:-2] if t.endswith(".0") else t
-        try:
-            eid = int(float(t))
-        except Exception:
-            continue
-        pairs.append((mi.iblock_id, eid))
-        iblock_type_map[mi.iblock_id] = mi.iblock_type_id
+_decode_plan: Optional[DecodePlan] = None
 
-    iblock_names = resolve_iblock_names(pairs, iblock_type_map) if pairs else {}
 
-    def get(rk: str) -> str:
-        return decode_value_for_raw_key(rk, raw.get(rk), meta, iblock_names, enum_cache)
+def get_decode_plan() -> DecodePlan:
+    """План для текущего снимка meta; пересобирается, только когда меняется снимок."""
+    global _decode_plan
+    snap = get_meta_snapshot()
+    plan = _decode_plan
+    if plan is None or plan.snapshot is not snap:
+        plan = DecodePlan(snap)
+        _decode_plan = plan
+    return plan
 
-    def _parse_year_from_value(v: Any) -> Optional[int]:
-        if v is None:
-            return None
-        if isinstance(v, (int, float)):
-            y = int(v)
-            return y if 1900 <= y <= 2030 else None
-        if isinstance(v, dict):
-            n = v.get("value") or v.get("id") or v.get("VALUE") or v.get("ID")
-            if n is not None:
-                return _parse_year_from_value(n)
-            return None
-        s = re.sub(r"[^0-9]", "", str(v))[:4]
-        if not s:
-            return None
-        y = int(s)
+
+def _parse_year_from_value(v: Any) -> Optional[int]:
+    if v is None:
+        return None
+    if isinstance(v, (int, float)):
+        y = int(v)
         return y if 1900 <= y <= 2030 else None
+    if isinstance(v, dict):
+        n = v.get("value") or v.get("id") or v.get("VALUE") or v.get("ID")
+        if n is not None:
+            return _parse_year_from_value(n)
+        return None
+    s = re.sub(r"[^0-9]", "", str(v))[:4]
+    if not s:
+        return None
+    y = int(s)
+    return y if 1900 <= y <= 2030 else None
 
+
+def _extract_year(raw: Dict[str, Any], plan: DecodePlan, get: Callable[[str], str]) -> Optional[int]:
     # Год — одно поле ufCrm34_1748347979. В raw может быть число-год (2019) или id опции списка (56 → расшифровать через enum).
-    year_val = None
-    skip_keys = {RAW_FIELDS_PRICE, RAW_FIELDS_MILEAGE, RAW_FIELDS_LINK, RAW_FIELDS_MARCA, RAW_FIELDS_MODEL, PHOTO_RAW_KEY}
-    try:
-        raw_year = raw.get(RAW_FIELDS_YEAR)
-        year_val = _parse_year_from_value(raw_year)
-        if year_val is None and raw_year is not None:
-            decoded = get(RAW_FIELDS_YEAR)
-            year_val = _parse_year_from_value(decoded)
-        if year_val is None:
-            year_key = _get_raw_key_by_title(meta, ["Anul producerii", "Год выпуска", "Year"])
-            if year_key:
-                year_val = _parse_year_from_value(raw.get(year_key))
-                if year_val is None:
-                    year_val = _parse_year_from_value(get(year_key))
-        if year_val is None:
-            for col_key, mi in (meta or {}).items():
-                t = (mi.b24_title or "").strip().lower()
-                if not t or ("anul" not in t and "год" not in t and "year" not in t and "producerii" not in t and "выпуска" not in t):
-                    continue
-                rk = mi.b24_field
-                if rk:
-                    year_val = _parse_year_from_value(raw.get(rk))
-                    if year_val is None:
-                        year_val = _parse_year_from_value(get(rk))
-                    if year_val is not None:
-                        break
-        if year_val is None:
-            for rk, rv in raw.items():
-                if rk in skip_keys or rv is None:
-                    continue
-                year_val = _parse_year_from_value(rv)
-                if year_val is not None:
-                    break
-    except Exception:
-        pass
+    raw_year = raw.get(RAW_FIELDS_YEAR)
+    year_val = _parse_year_from_value(raw_year)
+    if year_val is None and raw_year is not None:
+        year_val = _parse_year_from_value(get(RAW_FIELDS_YEAR))
+    if year_val is None:
+        year_key = plan.title_keys["year"]
+        if year_key:
+            year_val = _parse_year_from_value(raw.get(year_key))
+            if year_val is None:
+                year_val = _parse_year_from_value(get(year_key))
+    if year_val is None:
+        for rk in plan.year_title_keys:
+            year_val = _parse_year_from_value(raw.get(rk))
+            if year_val is None:
+                year_val = _parse_year_from_value(get(rk))
+            if year_val is not None:
+                break
+    if year_val is None:
+        for rk, rv in raw.items():
+            if rk in YEAR_SCAN_SKIP_KEYS or rv is None:
+                continue
+            year_val = _parse_year_from_value(rv)
+            if year_val is not None:
+                break
+    return year_val
 
+
+def _extract_price(raw: Dict[str, Any], get: Callable[[str], str]) -> Optional[float]:
     price_val = None
+    raw_price = raw.get(RAW_FIELDS_PRICE)
+    if raw_price is not None:
+        if isinstance(raw_price, (int, float)):
+            price_val = float(raw_price)
+        elif isinstance(raw_price, dict):
+            pv = raw_price.get("value") or raw_price.get("id") or raw_price.get("VALUE") or raw_price.get("ID")
+            if pv is not None:
+                price_val = float(pv)
+        if price_val is None or price_val < 0:
+            p = get(RAW_FIELDS_PRICE)
+            if p:
+                price_val = float(re.sub(r"[^0-9.,]", "", str(p)).replace(",", "."))
+    return price_val
+
+
+def _extract_mileage(raw: Dict[str, Any], get: Callable[[str], str]) -> Optional[int]:
+    mileage_val = None
+    raw_mileage = raw.get(RAW_FIELDS_MILEAGE)
+    if raw_mileage is not None:
+        if isinstance(raw_mileage, (int, float)):
+            mileage_val = int(raw_mileage)
+        elif isinstance(raw_mileage, dict):
+            mv = raw_mileage.get("value") or raw_mileage.get("id") or raw_mileage.get("VALUE") or raw_mileage.get("ID")
+            if mv is not None:
+                mileage_val = int(float(mv))
+        if mileage_val is None or mileage_val < 0:
+            m = get(RAW_FIELDS_MILEAGE)
+            if m:
+                mileage_val = int(re.sub(r"[^0-9]", "", str(m)))
+    return mileage_val
+
+
+def car_data_from_raw(raw: Dict[str, Any], iblock_wait_sec: Optional[float] = None) -> Dict[str, Any]:
+    """car["iblock_unresolved"] — пары (iblock_id, element_id), имена которых ещё не подтянуты (см. _iblock_unresolved)."""
+    plan = get_decode_plan()
+    pairs, iblock_type_map = plan.iblock_pairs(raw)
+    iblock_names = resolve_iblock_names(pairs, iblock_type_map, wait_sec=iblock_wait_sec) if pairs else {}
+    car = _car_data_from_raw_planned(raw, plan, iblock_names)
+    car["iblock_unresolved"] = _iblock_unresolved(pairs, iblock_names)
+    return car
+
+
+def cars_data_from_raws(raws: List[Dict[str, Any]], iblock_wait_sec: Optional[float] = None) -> List[Optional[Dict[str, Any]]]:
+    """car_data_from_raw для пачки: пары (iblock_id, element_id) всех raw собираются вместе и резолвятся
+    одним resolve_iblock_names (один запрос к кэшу + один добор из Bitrix). Порядок как у raws;
+    None — если raw не удалось расшифровать (ошибка в лог)."""
+    plan = get_decode_plan()
+    pairs: Set[Tuple[int, int]] = set()
+    iblock_type_map: Dict[int, Optional[str]] = {}
+    for raw in raws:
+        prs, types = plan.iblock_pairs(raw)
+        pairs.update(prs)
+        iblock_type_map.update(types)
+    iblock_names = resolve_iblock_names(sorted(pairs), iblock_type_map, wait_sec=iblock_wait_sec) if pairs else {}
+    out: List[Optional[Dict[str, Any]]] = []
+    for raw in raws:
+        try:
+            car = _car_data_from_raw_planned(raw, plan, iblock_names)
+            car["iblock_unresolved"] = _iblock_unresolved(plan.iblock_pairs(raw)[0], iblock_names)
+            out.append(car)
+        except Exception as e:
+            print(f"WARN cars_data_from_raws: item_id={get_item_id_from_raw(raw)}: {e}", file=sys.stderr, flush=True)
+            out.append(None)
+    return out
+
+
+def _car_data_from_raw_planned(
+    raw: Dict[str, Any],
+    plan: DecodePlan,
+    iblock_names: Dict[Tuple[int, int], str],
+) -> Dict[str, Any]:
+    bitrix_webhook = _bitrix_webhook()
+    photo_urls = extract_photo_urls_from_raw(raw, bitrix_webhook)
+
+    def get(rk: str) -> str:
+        return plan.decoder(rk)(raw.get(rk), iblock_names)
+
     try:
-        raw_price = raw.get(RAW_FIELDS_PRICE)
-        if raw_price is not None:
-            if isinstance(raw_price, (int, float)):
-                price_val = float(raw_price)
-            elif isinstance(raw_price, dict):
-                pv = raw_price.get("value") or raw_price.get("id") or raw_price.get("VALUE") or raw_price.get("ID")
-                if pv is not None:
-                    price_val = float(pv)
-            if price_val is None or price_val < 0:
-                p = get(RAW_FIELDS_PRICE)
-                if p:
-                    price_val = float(re.sub(r"[^0-9.,]", "", str(p)).replace(",", "."))
+        year_val = _extract_year(raw, plan, get)
     except Exception:
-        pass
-
-    mileage_val = None
+        year_val = None
     try:
-        raw_mileage = raw.get(RAW_FIELDS_MILEAGE)
-        if raw_mileage is not None:
-            if isinstance(raw_mileage, (int, float)):
-                mileage_val = int(raw_mileage)
-            elif isinstance(raw_mileage, dict):
-                mv = raw_mileage.get("value") or raw_mileage.get("id") or raw_mileage.get("VALUE") or raw_mileage.get("ID")
-                if mv is not None:
-                    mileage_val = int(float(mv))
-            if mileage_val is None or mileage_val < 0:
-                m = get(RAW_FIELDS_MILEAGE)
-                if m:
-                    mileage_val = int(re.sub(r"[^0-9]", "", str(m)))
+        price_val = _extract_price(raw, get)
     except Exception:
-        pass
+        price_val = None
+    try:
+        mileage_val = _extract_mileage(raw, get)
+    except Exception:
+        mileage_val = None
 
     link = get(RAW_FIELDS_LINK)
     description = (raw.get("title") or "").strip() or ""
@@ -1577,7 +3887,7 @@ def car_data_from_raw(raw: Dict[str, Any]) -> Dict[str, Any]:
     marca = (get(RAW_FIELDS_MARCA) or "").strip()
     model = (get(RAW_FIELDS_MODEL) or "").strip()
     # Номер авто из Bitrix — нигде не показываем (ни в заголовке, ни в описании)
-    numar_key = _get_raw_key_by_title(meta, ["Numar Auto", "Номер авто", "Car number", "Numar auto"])
+    numar_key = plan.title_keys["numar"]
     numar_auto = (get(numar_key) or "").strip() if numar_key else ""
     # Убрать номер из описания
     description = _strip_numar_from_description(description, numar_auto) or description
@@ -1601,11 +3911,11 @@ def car_data_from_raw(raw: Dict[str, Any]) -> Dict[str, Any]:
     engine_option_id: Optional[str] = None
     drive_option_id: Optional[str] = None
     transmission_option_id: Optional[str] = None
-    body_key = _get_raw_key_by_title(meta, ["Caroserie", "Тип кузова", "Body type"])
-    fuel_key = _get_raw_key_by_title(meta, ["Tipul de combustibil", "Тип топлива", "Fuel type"])
-    engine_key = _get_raw_key_by_title(meta, ["Volumul motorului", "Объем двигателя", "Engine volume"])
-    drive_key = _get_raw_key_by_title(meta, ["Tracţiune", "Tracțiune", "Привод", "Drive"])
-    transmission_key = _get_raw_key_by_title(meta, ["Transmisie", "Cutie", "Кпп", "КПП", "Transmission", "Gearbox"])
+    body_key = plan.title_keys["body"]
+    fuel_key = plan.title_keys["fuel"]
+    engine_key = plan.title_keys["engine"]
+    drive_key = plan.title_keys["drive"]
+    transmission_key = plan.title_keys["transmission"]
     body_str = (get(body_key) or "").strip() if body_key else ""
     fuel_str = (get(fuel_key) or "").strip() if fuel_key else ""
     engine_str = (get(engine_key) or "").strip().replace(",", ".") if engine_key else ""
@@ -2088,26 +4398,108 @@ def _preserve_phone_feature_for_patch(advert_id: str, features: List[Dict[str, A
             return [*features, feature]
     return features
 
+def _features_snapshot(features: List[Dict[str, Any]], phone: str = "") -> Dict[str, Any]:
+    """Компактный снимок features: id -> остальные ключи (value, unit). Телефон шлётся отдельно (contacts) — кладём под "_phone"."""
+    snap: Dict[str, Any] = {}
+    for f in features:
+        if isinstance(f, dict) and f.get("id") is not None:
+            snap[str(f["id"])] = {k: v for k, v in f.items() if k != "id"}
+    snap["_phone"] = phone or ""
+    return snap
+
+
+def _features_hash(snapshot: Dict[str, Any]) -> str:
+    canon = json.dumps(snapshot, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha1(canon.encode("utf-8")).hexdigest()
+
+
+def _load_sent_features(item_id: int, advert_id: str) -> Optional[Tuple[Optional[str], Dict[str, Any]]]:
+    """(features_hash, features_snapshot) последнего отправленного payload; None — объявления нет в b24_999_sent_items."""
+    try:
+        with _pg_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"SELECT features_hash, features_snapshot FROM {SENT_999_TABLE} WHERE item_id = %s AND advert_id::text = %s",
+                    (int(item_id), str(advert_id)),
+                )
+                row = cur.fetchone()
+            conn.rollback()
+        if row is None:
+            return None
+        return row[0], row[1] if isinstance(row[1], dict) else {}
+    except Exception as e:
+        print(f"WARN _load_sent_features item_id={item_id}: {e}", file=sys.stderr, flush=True)
+        return None
+
+
+def _save_sent_features(item_id: int, advert_id: str, features_hash: str, snapshot: Dict[str, Any], skipped: bool) -> None:
+    try:
+        with _pg_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    UPDATE {SENT_999_TABLE}
+                    SET features_hash = %s,
+                        features_snapshot = %s,
+                        last_patch_result = %s,
+                        last_patch_at = now(),
+                        patch_count = patch_count + %s,
+                        patch_skips = patch_skips + %s
+                    WHERE item_id = %s AND advert_id::text = %s
+                    """,
+                    (
+                        features_hash,
+                        psycopg2.extras.Json(snapshot),
+                        "skipped" if skipped else "patched",
+                        0 if skipped else 1,
+                        1 if skipped else 0,
+                        int(item_id),
+                        str(advert_id),
+                    ),
+                )
+            conn.commit()
+    except Exception as e:
+        print(f"WARN _save_sent_features item_id={item_id}: {e}", file=sys.stderr, flush=True)
+
+
+def _complete_image_ids(photo_results: List[PhotoUploadResult], image_urls: List[str], advert_id: Any) -> List[str]:
+    """image_id для фичи 14 — только если загрузились все фото: PATCH с неполным списком удалил бы живые фото на 999."""
+    image_ids = [r.image_id for r in photo_results if r.image_id]
+    if len(image_ids) == len(image_urls):
+        return image_ids
+    print(
+        f"WARN: advert_id={advert_id}: загружено {len(image_ids)}/{len(image_urls)} фото — фото на 999 не трогаем",
+        file=sys.stderr,
+        flush=True,
+    )
+    return []
+
+
 def update_advert_from_item(
     advert_id: str,
     item_id: int,
     car: Optional[Dict[str, Any]] = None,
     raw: Optional[Dict[str, Any]] = None,
     update_photos: bool = True,
+    force: bool = False,
+    limiter: Optional[UpstreamLimiter] = None,
 ) -> Dict[str, Any]:
-    """Обновить объявление на 999 по данным из Битрикса (item_id). Загружает фото, собирает payload, PATCH /adverts/{id}. Если фото с Битрикс не загрузились — обновляем только цену/описание/поля, фото на 999 не трогаем."""
+    """Обновить объявление на 999 по данным из Битрикса (item_id). Загружает фото, собирает payload, PATCH /adverts/{id}. Если фото с Битрикс не загрузились — обновляем только цену/описание/поля, фото на 999 не трогаем.
+    Если features совпадают со снимком последнего PATCH (b24_999_sent_items.features_hash) — запрос не шлём, возвращаем {"skipped": True}; force=True — шлём всегда.
+    limiter — дополнительный лимит перед каждым PATCH (sync: "999.sync"), сверх общего "999.write"."""
     if car is None or raw is None:
         raw = raw or fetch_raw_by_item_id(item_id)
         if not raw:
             raise ValueError(f"Item id={item_id} not found")
-        car = car_data_from_raw(raw)
+        car = car_data_from_raw(raw, iblock_wait_sec=IBLOCK_PUBLISH_WAIT_SEC)
+    if car.get("iblock_unresolved"):
+        raise RuntimeError(f"item_id={item_id}: имена iblock ещё не подтянуты из Bitrix {car['iblock_unresolved']}, обновление отложено")
     image_urls = car.get("image_urls") or []
     image_ids: List[str] = []
+    photo_results: List[PhotoUploadResult] = []
     if update_photos and image_urls:
-        for url in image_urls:
-            img_id, _ = upload_image_from_url_optional(url)
-            if img_id:
-                image_ids.append(img_id)
+        photo_results = upload_photos_from_urls(image_urls, strict=False)
+        image_ids = _complete_image_ids(photo_results, image_urls, advert_id)
     payload = build_advert_payload(
         marca=car["marca"],
         model=car["model"],
@@ -2133,10 +4525,52 @@ def update_advert_from_item(
         skip_photos=(not update_photos) or (not image_ids),
     )
     car_phone = car.get("phone") or ""
+    # PATCH заменяет весь набор features (см. _preserve_phone_feature_for_patch), поэтому шлём либо всё, либо ничего.
+    snapshot = _features_snapshot(payload["features"], car_phone)
+    features_hash = _features_hash(snapshot)
+    previous = _load_sent_features(item_id, advert_id)
+    if not image_ids and previous is not None and "14" in (previous[1] or {}):
+        # Фото не шлём — на 999 остаются прежние: в снимке тоже оставляем их, иначе каждый проход видел бы «изменение»
+        snapshot["14"] = previous[1]["14"]
+        features_hash = _features_hash(snapshot)
+    if previous is not None and previous[0] == features_hash and not force:
+        _save_sent_features(item_id, advert_id, features_hash, snapshot, skipped=True)
+        return {"skipped": True, "reason": "features unchanged", "advert_id": str(advert_id)}
+    if previous is not None and previous[1]:
+        old = previous[1]
+        changed = sorted(k for k in set(old) | set(snapshot) if old.get(k) != snapshot.get(k))
+        print(f"SYNC_999: advert_id={advert_id} изменились features: {', '.join(changed)}", flush=True)
     features_for_patch = payload["features"]
     if not car_phone:
         features_for_patch = _preserve_phone_feature_for_patch(str(advert_id), features_for_patch)
-    result = patch_advert_features(str(advert_id), features_for_patch)
+    try:
+        if limiter is not None:
+            limiter.acquire()
+        result = patch_advert_features(str(advert_id), features_for_patch)
+    except RuntimeError as e:
+        stale_ids = [r.image_id for r in photo_results if r.cached and r.image_id]
+        if not stale_ids or not _is_image_rejected_error(e, stale_ids):
+            raise
+        # 999 не принял image_id из кэша (истёк) — выкидываем их из кэша и грузим фото заново
+        print(f"WARN: 999 отверг кэшированные фото advert_id={advert_id}: {e}; перезагружаем", file=sys.stderr, flush=True)
+        evict_image_cache(stale_ids)
+        photo_results = upload_photos_from_urls(image_urls, strict=False, use_cache=False)
+        image_ids = _complete_image_ids(photo_results, image_urls, advert_id)
+        features_for_patch = [f for f in features_for_patch if str(f.get("id")) != "14"]
+        if image_ids:
+            features_for_patch.append({"id": "14", "value": image_ids})
+        if limiter is not None:
+            limiter.acquire()
+        result = patch_advert_features(str(advert_id), features_for_patch)
+        sent_features = [f for f in payload["features"] if str(f.get("id")) != "14"]
+        if image_ids:
+            sent_features.append({"id": "14", "value": image_ids})
+        snapshot = _features_snapshot(sent_features, car_phone)
+        if not image_ids and previous is not None and "14" in (previous[1] or {}):
+            snapshot["14"] = previous[1]["14"]
+        features_hash = _features_hash(snapshot)
+    if previous is not None:
+        _save_sent_features(item_id, advert_id, features_hash, snapshot, skipped=False)
     if car_phone:
         try:
             ensure_advert_phone_contact(str(advert_id), car_phone)
@@ -2155,8 +4589,7 @@ def patch_advert_state(advert_id: str, state: str) -> Optional[Dict[str, Any]]:
 
 
 def set_advert_access_policy(advert_id: str, access_policy: str = "private") -> Dict[str, Any]:
-    url = API_BASE + f"/adverts/{advert_id}/access_policy"
-    r = requests.put(url, auth=_auth(), json={"access_policy": access_policy}, timeout=30)
+    r = _http_999().put(f"/adverts/{advert_id}/access_policy", auth=_auth(), json={"access_policy": access_policy}, timeout=30)
     if not r.ok:
         try:
             err_body = r.json()
@@ -2166,97 +4599,514 @@ def set_advert_access_policy(advert_id: str, access_policy: str = "private") ->
     return r.json()
 
 
+# -----------------------------
+# Несколько реплик (uvicorn --workers, несколько подов): лидер, шарды, захват машин
+# -----------------------------
+_replica_lock = threading.Lock()
+_replica_conn: Any = None
+_replica_thread: Optional[threading.Thread] = None
+_claimed_items: Set[int] = set()
+_lost_claims: Set[int] = set()  # захваты, не восстановленные после переподключения: владелец ещё работает, но должен прерваться
+_replica_state: Dict[str, Any] = {
+    "leader": False,
+    "shard_index": 0,
+    "shard_count": 1,
+    "live_replicas": [],
+    "heartbeats": 0,
+    "connects": 0,
+    "claims": 0,
+    "claims_busy": 0,
+    "claims_no_session": 0,
+    "claims_lost": 0,
+    "last_heartbeat_at": None,
+    "last_error": None,
+}
+
+
+def _replica_session() -> Any:
+    """Своё соединение реплики (не из пула, autocommit): на нём держатся advisory-lock лидера и захваченных машин.
+    Обрыв — PG сам снимает эти блокировки; при переподключении захваты машин, которые ещё в работе, берутся заново.
+    Машины, которые за время обрыва взяла другая реплика, переходят в _lost_claims — владелец видит это через _claim_lost.
+    Вызывать под _replica_lock."""
+    global _replica_conn
+    if _replica_conn is not None and not _replica_conn.closed:
+        return _replica_conn
+    conn = _pg_connect_direct()
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    _replica_conn = conn
+    _replica_state["leader"] = False
+    _replica_state["connects"] += 1
+    lost = []
+    with conn.cursor() as cur:
+        for item_id in sorted(_claimed_items):
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (REPLICA_ITEM_LOCK_BASE + item_id,))
+            if not cur.fetchone()[0]:
+                lost.append(item_id)
+    if lost:
+        _claimed_items.difference_update(lost)
+        _lost_claims.update(lost)
+        _replica_state["claims_lost"] += len(lost)
+        print(
+            f"WARN REPLICA {REPLICA_ID}: после переподключения захват потерян (машины взяла другая реплика): {lost}",
+            file=sys.stderr,
+            flush=True,
+        )
+    return conn
+
+
+def _replica_session_lost(error: Exception) -> None:
+    global _replica_conn
+    _replica_state["last_error"] = str(error)
+    _replica_state["leader"] = False
+    if _replica_conn is not None:
+        try:
+            _replica_conn.close()
+        except Exception:
+            pass
+    _replica_conn = None
+    print(f"WARN REPLICA {REPLICA_ID}: соединение потеряно, лидерство снято: {error}", file=sys.stderr, flush=True)
+
+
+def _replica_heartbeat() -> None:
+    """Продлить heartbeat в REPLICAS_TABLE, попробовать стать лидером, пересчитать свой шард по живым репликам."""
+    with _replica_lock:
+        try:
+            conn = _replica_session()
+            with conn.cursor() as cur:
+                if not _replica_state["leader"]:
+                    cur.execute("SELECT pg_try_advisory_lock(%s)", (REPLICA_LEADER_LOCK_KEY,))
+                    if cur.fetchone()[0]:
+                        _replica_state["leader"] = True
+                        print(f"REPLICA {REPLICA_ID}: лидер — авто-публикация ставит задачи отсюда", flush=True)
+                cur.execute(
+                    f"""
+                    INSERT INTO {REPLICAS_TABLE} (replica_id, host, pid, is_leader)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (replica_id) DO UPDATE SET is_leader = EXCLUDED.is_leader, seen_at = now()
+                    """,
+                    (REPLICA_ID, socket.gethostname(), os.getpid(), _replica_state["leader"]),
+                )
+                cur.execute(
+                    f"SELECT replica_id FROM {REPLICAS_TABLE} WHERE seen_at > now() - make_interval(secs => %s) ORDER BY replica_id",
+                    (REPLICA_TTL_SEC,),
+                )
+                live = [r[0] for r in cur.fetchall()]
+                cur.execute(f"DELETE FROM {REPLICAS_TABLE} WHERE seen_at < now() - interval '1 day'")
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            _replica_session_lost(e)
+            return
+        except Exception as e:
+            _replica_state["last_error"] = str(e)
+            print(f"WARN REPLICA heartbeat: {e}", file=sys.stderr, flush=True)
+            return
+        if REPLICA_ID in live:
+            shard = (live.index(REPLICA_ID), len(live))
+        else:
+            shard = (0, 1)
+        if shard != (_replica_state["shard_index"], _replica_state["shard_count"]):
+            print(f"REPLICA {REPLICA_ID}: шард {shard[0] + 1}/{shard[1]} (живые: {', '.join(live)})", flush=True)
+        _replica_state.update({
+            "shard_index": shard[0],
+            "shard_count": shard[1],
+            "live_replicas": live,
+            "last_heartbeat_at": datetime.now().isoformat(timespec="seconds"),
+            "last_error": None,
+        })
+        _replica_state["heartbeats"] += 1
+
+
+def _replica_heartbeat_loop() -> None:
+    while True:
+        time.sleep(REPLICA_HEARTBEAT_SEC)
+        try:
+            _replica_heartbeat()
+        except Exception as e:
+            print(f"WARN REPLICA heartbeat: {e}", file=sys.stderr, flush=True)
+
+
+def start_replica_coordination() -> None:
+    """Первый heartbeat — синхронно (лидер и шард известны до старта петель), дальше — фоновый поток."""
+    global _replica_thread
+    if not REPLICA_COORDINATION_ENABLED or (_replica_thread and _replica_thread.is_alive()):
+        return
+    _replica_heartbeat()
+    _replica_thread = threading.Thread(target=_replica_heartbeat_loop, name="replica-heartbeat", daemon=True)
+    _replica_thread.start()
+
+
+def _replica_is_leader() -> bool:
+    return not REPLICA_COORDINATION_ENABLED or bool(_replica_state["leader"])
+
+
+def _replica_shard_sql(item_id_sql: str) -> Tuple[str, tuple]:
+    """Условие «машина в шарде этой реплики»: hash(item_id) mod числа живых реплик. Одна реплика — TRUE."""
+    count = int(_replica_state["shard_count"]) if REPLICA_COORDINATION_ENABLED else 1
+    if count <= 1:
+        return "TRUE", ()
+    return (
+        f"mod(hashint8(({item_id_sql})::bigint)::bigint + 2147483648, %s) = %s",
+        (count, int(_replica_state["shard_index"])),
+    )
+
+
+def _claim_item(item_id: int, wait_sec: float = 0.0) -> bool:
+    """Захват машины на время публикации / sync / hide: в процессе — множество _claimed_items, между репликами —
+    pg_try_advisory_lock(REPLICA_ITEM_LOCK_BASE + item_id) на соединении реплики. False — машину держит другой поток
+    или реплика (wait_sec — сколько подождать), либо соединения реплики сейчас нет (переподключает heartbeat, не мы:
+    под _replica_lock connect ждал бы connect_timeout у всех захватов). Освобождать _release_item."""
+    item_id = int(item_id)
+    deadline = time.monotonic() + wait_sec
+    while True:
+        with _replica_lock:
+            if item_id not in _claimed_items and item_id not in _lost_claims:
+                ok = True
+                if REPLICA_COORDINATION_ENABLED:
+                    if _replica_conn is None or _replica_conn.closed:
+                        _replica_state["claims_no_session"] += 1
+                        ok = False
+                    else:
+                        try:
+                            with _replica_conn.cursor() as cur:
+                                cur.execute("SELECT pg_try_advisory_lock(%s)", (REPLICA_ITEM_LOCK_BASE + item_id,))
+                                ok = bool(cur.fetchone()[0])
+                        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                            _replica_session_lost(e)
+                            ok = False
+                if ok:
+                    _claimed_items.add(item_id)
+                    _replica_state["claims"] += 1
+                    return True
+            _replica_state["claims_busy"] += 1
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.2)
+
+
+def _claim_lost(item_id: int) -> bool:
+    """Захват item_id потерян при переподключении (машину держит другая реплика) — владельцу пора прерваться."""
+    with _replica_lock:
+        return int(item_id) in _lost_claims
+
+
+def _release_item(item_id: int) -> None:
+    item_id = int(item_id)
+    with _replica_lock:
+        if item_id in _lost_claims:
+            _lost_claims.discard(item_id)
+            return
+        if item_id not in _claimed_items:
+            return
+        _claimed_items.discard(item_id)
+        if REPLICA_COORDINATION_ENABLED and _replica_conn is not None:
+            try:
+                with _replica_conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (REPLICA_ITEM_LOCK_BASE + item_id,))
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                _replica_session_lost(e)
+
+
+def get_replica_status() -> Dict[str, Any]:
+    with _replica_lock:
+        return {
+            "enabled": REPLICA_COORDINATION_ENABLED,
+            "replica_id": REPLICA_ID,
+            "heartbeat_sec": REPLICA_HEARTBEAT_SEC,
+            "ttl_sec": REPLICA_TTL_SEC,
+            "connected": _replica_conn is not None and not _replica_conn.closed,
+            "running": bool(_replica_thread and _replica_thread.is_alive()),
+            "claimed_items": len(_claimed_items),
+            "lost_claims": sorted(_lost_claims),
+            **_replica_state,
+            "leader": _replica_is_leader(),
+        }
+
+
+def _success_stage_adverts_query() -> Tuple[str, tuple]:
+    shard_sql, shard_params = _replica_shard_sql("s.item_id")
+    q = f"""
+        SELECT s.item_id, s.advert_id
+        FROM {SENT_999_TABLE} s
+        INNER JOIN {DATA_TABLE_SP1114} t ON {SQL_ITEM_ID} = s.item_id
+        WHERE {SQL_STAGE} = %s
+          AND s.advert_id IS NOT NULL
+          AND {shard_sql}
+    """
+    return q, (STAGE_ID_SUCCESS, *shard_params)
+
+
 def _hide_999_adverts_for_success_stage() -> None:
     """Скрыть на 999 объявления, у которых в БД стадия = DT1114_111:SUCCESS (Vandut/продано).
-    Проверяются все машины из b24_999_sent_items с advert_id, без ограничения по дате."""
+    Проверяются все машины из b24_999_sent_items с advert_id, без ограничения по дате (при нескольких репликах — свой шард)."""
     if not _token():
         return
-    conn = None
     try:
-        conn = _pg_conn()
-        _ensure_999_sent_table(conn)
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT s.item_id, s.advert_id
-                FROM {SENT_999_TABLE} s
-                INNER JOIN {DATA_TABLE_SP1114} t ON (t.raw->>'id')::bigint = s.item_id
-                WHERE COALESCE(TRIM(t.raw->>'stageId'), '') = %s
-                  AND s.advert_id IS NOT NULL
-                """,
-                (STAGE_ID_SUCCESS,),
-            )
-            rows = cur.fetchall()
-        conn.close()
+        with _pg_conn() as conn:
+            _ensure_schema(conn)
+            with conn.cursor() as cur:
+                cur.execute(*_success_stage_adverts_query())
+                rows = cur.fetchall()
         for row in rows or []:
             item_id, advert_id = row[0], row[1]
-            if advert_id is None:
+            if advert_id is None or not _claim_item(item_id):
                 continue
             try:
                 set_advert_access_policy(str(advert_id), "private")
                 print(f"AUTO_999: скрыто объявление 999 advert_id={advert_id} (item_id={item_id}, стадия SUCCESS)", flush=True)
             except Exception as e:
                 print(f"WARN: скрыть 999 advert_id={advert_id}: {e}", file=sys.stderr, flush=True)
+            finally:
+                _release_item(item_id)
     except Exception as e:
         print(f"WARN _hide_999_adverts_for_success_stage: {e}", file=sys.stderr, flush=True)
+
+
+# Поля raw, от которых зависит car_data_from_raw, кроме ключей по названию из meta (их добавляет _sync_hash_keys).
+# Полный перебор raw при поиске года (YEAR_SCAN_SKIP_KEYS) — крайний случай без полей года, в хэш не входит.
+SYNC_HASH_STATIC_KEYS: List[str] = [
+    "title", "categoryId", PHOTO_RAW_KEY, RAW_FIELDS_LINK, RAW_FIELDS_PRICE, RAW_FIELDS_MILEAGE, *RAW_FIELDS_FOR_IBLOCK,
+]
+_sync_hash_installed_keys: Optional[Tuple[str, ...]] = None
+_sync_hash_lock = threading.Lock()
+
+
+def _sync_hash_keys(plan: DecodePlan) -> Tuple[str, ...]:
+    keys = set(SYNC_HASH_STATIC_KEYS)
+    keys.update(k for k in plan.title_keys.values() if k)
+    keys.update(plan.year_title_keys)
+    return tuple(sorted(keys))
+
+
+def _sync_hash_function_sql(keys: Tuple[str, ...]) -> str:
+    args = ", ".join(f"raw->{_sql_literal(k)}" for k in keys)
+    return f"""CREATE OR REPLACE FUNCTION public.b24_999_sync_hash(raw jsonb) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$ SELECT md5(jsonb_build_array({args})::text) $$"""
+
+
+def _ensure_sync_hash_rules() -> bool:
+    """Привести b24_999_sync_hash к текущему набору ключей (hash набора — в COMMENT функции) и пересчитать sync_hash.
+    Объявления, которые были синхронны по старому хэшу (или по md5(raw)), остаются синхронными — без волны PATCH.
+    Лок миграций не ждём: занят — проход пропускается (ключи не отмечаются установленными, повтор при следующем sync)."""
+    global _sync_hash_installed_keys
+    keys = _sync_hash_keys(get_decode_plan())
+    if keys == _sync_hash_installed_keys:
+        return False
+    with _sync_hash_lock:
+        if keys == _sync_hash_installed_keys:
+            return False
+        sql = _sync_hash_function_sql(keys)
+        rules_hash = hashlib.md5(sql.encode("utf-8")).hexdigest()
+        changed = False
+        with _pg_conn() as conn:
+            if not _try_schema_lock(conn, 0, xact=True):
+                print("SYNC_999: sync_hash — лок миграций занят, пересчёт отложен до следующего прохода", flush=True)
+                return False
+            with conn.cursor() as cur:
+                cur.execute("SELECT obj_description('public.b24_999_sync_hash(jsonb)'::regprocedure, 'pg_proc')")
+                row = cur.fetchone()
+                if not row or row[0] != f"rules:{rules_hash}":
+                    cur.execute(sql)
+                    cur.execute(f"COMMENT ON FUNCTION public.b24_999_sync_hash(jsonb) IS 'rules:{rules_hash}'")
+                    cur.execute(
+                        f"""
+                        UPDATE {SENT_999_TABLE} s
+                        SET last_sync_raw_hash = CASE
+                                WHEN s.last_sync_raw_hash IN (s.sync_hash, md5(COALESCE(t.raw::text, '')))
+                                THEN public.b24_999_sync_hash(t.raw)
+                                ELSE s.last_sync_raw_hash
+                            END,
+                            sync_hash = public.b24_999_sync_hash(t.raw)
+                        FROM {DATA_TABLE_SP1114} t
+                        WHERE {SQL_ITEM_ID} = s.item_id
+                        """
+                    )
+                    changed = True
+                    print(f"SYNC_999: sync_hash по {len(keys)} полям raw, пересчитано строк: {cur.rowcount}", flush=True)
+            conn.commit()
+        _sync_hash_installed_keys = keys
+        return changed
+
+
+def _sync_candidates_query(sharded: bool = True) -> Tuple[str, tuple]:
+    """Изменившиеся (по sync_hash) объявления — через частичный индекс b24_999_sent_items_dirty_idx.
+    sharded — только шард этой реплики (проход по расписанию идёт на каждой реплике)."""
+    shard_sql, shard_params = _replica_shard_sql("s.item_id") if sharded else ("TRUE", ())
+    q = f"""
+        SELECT s.item_id, s.advert_id, s.sync_hash, t.raw
+        FROM {SENT_999_TABLE} s
+        INNER JOIN {DATA_TABLE_SP1114} t ON {SQL_ITEM_ID} = s.item_id
+        WHERE s.advert_id IS NOT NULL
+          AND s.last_sync_raw_hash IS DISTINCT FROM s.sync_hash
+          AND {shard_sql}
+        ORDER BY s.sent_at DESC NULLS LAST
+        LIMIT %s
+    """
+    return q, (*shard_params, max(1, SYNC_999_MAX_PER_RUN))
+
+
+_sync_999_thread: Optional[threading.Thread] = None
+_sync_999_lock = threading.Lock()
+_sync_999_status: Dict[str, Any] = {"state": "idle"}
+
+
+def _sync_999_one(item_id: int, advert_id: int, raw_hash: Optional[str], raw: Dict[str, Any], car: Dict[str, Any]) -> str:
+    """Одно объявление в пуле sync: PATCH (или пропуск, если features не изменились) и отметка в b24_999_sent_items.
+    busy — машину сейчас держит другая реплика/поток (останется «грязной» до следующего прохода)."""
+    if not _claim_item(item_id):
+        return "busy"
+    try:
+        if _claim_lost(item_id):
+            return "busy"
+        result = update_advert_from_item(
+            str(advert_id), int(item_id), car=car, raw=raw, update_photos=SYNC_999_UPDATE_PHOTOS, limiter=_upstream_limiter("999.sync")
+        )
+        if _claim_lost(item_id):
+            # PATCH ушёл, но машину уже держит другая реплика: не отмечаем — останется «грязной» до следующего прохода
+            return "busy"
+        with _pg_conn() as conn:
+            _mark_999_sync_state(conn, int(item_id), str(raw_hash) if raw_hash else None)
     finally:
-        if conn:
-            try:
-                conn.close()
-            except Exception:
-                pass
+        _release_item(item_id)
+    if isinstance(result, dict) and result.get("skipped"):
+        return "skipped"
+    print(f"AUTO_999: PATCH объявление 999 item_id={item_id} advert_id={advert_id}", flush=True)
+    return "patched"
+
+
+def _sync_999_count(outcome: str, last_error: Optional[str] = None) -> None:
+    with _sync_999_lock:
+        _sync_999_status[outcome] = _sync_999_status.get(outcome, 0) + 1
+        _sync_999_status["done"] = _sync_999_status.get("done", 0) + 1
+        if last_error is not None:
+            _sync_999_status["last_error"] = last_error
+
 
+def _sync_999_set(**fields: Any) -> None:
+    """Запись в _sync_999_status только под _sync_999_lock: пишут поток прохода и воркеры пула, читает API."""
+    with _sync_999_lock:
+        _sync_999_status.update(fields)
 
-def _sync_999_adverts_from_db() -> None:
-    """В фоне сверяем БД с 999: для каждой пары (item_id, advert_id) из b24_999_sent_items подтягиваем актуальные данные из БД и PATCH объявления (цена, описание, фото и т.д.). Ограничение: SYNC_999_MAX_PER_RUN за проход, пауза SYNC_999_DELAY_BETWEEN_SEC между запросами."""
+
+def _sync_999_adverts_from_db(sharded: bool = True) -> None:
+    """Проход sync: для изменившихся (sync_hash) пар (item_id, advert_id) из b24_999_sent_items подтягиваем данные из БД и PATCH
+    объявления (цена, описание, фото и т.д.). Не больше SYNC_999_MAX_PER_RUN за проход; SYNC_999_CONCURRENCY объявлений
+    параллельно, PATCH — через общий токен-бакет SYNC_999_RATE_PER_SEC. Выполняется в своём потоке (start_sync_999_run)."""
     if not _token():
         return
-    conn = None
+    with _sync_999_lock:
+        _sync_999_status.clear()
+        _sync_999_status.update({
+            "state": "running",
+            "started_at": time.time(),
+            "finished_at": None,
+            "total": 0,
+            "done": 0,
+            "patched": 0,
+            "skipped": 0,
+            "busy": 0,
+            "failed": 0,
+            "undecoded": 0,
+            "deferred": 0,
+            "shard": (
+                f"{_replica_state['shard_index'] + 1}/{_replica_state['shard_count']}"
+                if sharded and REPLICA_COORDINATION_ENABLED else "all"
+            ),
+            "last_error": None,
+        })
     try:
-        conn = _pg_conn()
-        _ensure_999_sent_table(conn)
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                SELECT s.item_id, s.advert_id, md5(COALESCE(t.raw::text, '')) AS raw_hash
-                FROM {SENT_999_TABLE} s
-                INNER JOIN {DATA_TABLE_SP1114} t ON (t.raw->>'id')::bigint = s.item_id
-                WHERE s.advert_id IS NOT NULL
-                  AND (s.last_sync_raw_hash IS NULL OR s.last_sync_raw_hash <> md5(COALESCE(t.raw::text, '')))
-                ORDER BY s.sent_at DESC NULLS LAST
-                LIMIT %s
-                """,
-                (max(1, SYNC_999_MAX_PER_RUN),),
-            )
-            rows = cur.fetchall()
-        updated = 0
-        for row in rows or []:
-            item_id, advert_id, raw_hash = row[0], row[1], row[2]
-            if item_id is None or advert_id is None:
-                continue
+        try:
+            _ensure_sync_hash_rules()
+        except Exception as e:
+            print(f"WARN SYNC_999 sync_hash: {e}", file=sys.stderr, flush=True)
+        with _pg_conn() as conn:
+            _ensure_schema(conn)
+            with conn.cursor() as cur:
+                cur.execute(*_sync_candidates_query(sharded))
+                rows = cur.fetchall()
+            conn.rollback()
+        rows = [r for r in rows or [] if r[0] is not None and r[1] is not None and isinstance(r[3], dict)]
+        _sync_999_set(total=len(rows))
+
+        def _run(row: tuple, car: Dict[str, Any]) -> None:
             try:
-                update_advert_from_item(str(advert_id), int(item_id), update_photos=False)
-                _mark_999_sync_state(conn, int(item_id), str(raw_hash) if raw_hash else None)
-                updated += 1
-                print(f"AUTO_999: PATCH объявление 999 item_id={item_id} advert_id={advert_id}", flush=True)
-                if SYNC_999_DELAY_BETWEEN_SEC > 0:
-                    time.sleep(SYNC_999_DELAY_BETWEEN_SEC)
+                _sync_999_count(_sync_999_one(row[0], row[1], row[2], row[3], car))
             except Exception as e:
-                print(f"WARN SYNC_999: item_id={item_id} advert_id={advert_id}: {e}", file=sys.stderr, flush=True)
-        if updated:
-            print(f"AUTO_999: синхронизировано с БД объявлений на 999: {updated}", flush=True)
+                _sync_999_count("failed", last_error=f"item_id={row[0]}: {e}")
+                print(f"WARN SYNC_999: item_id={row[0]} advert_id={row[1]}: {e}", file=sys.stderr, flush=True)
+
+        with ThreadPoolExecutor(max_workers=max(1, SYNC_999_CONCURRENCY), thread_name_prefix="sync999") as pool:
+            for i in range(0, len(rows), SYNC_999_DECODE_BATCH):
+                batch = rows[i:i + SYNC_999_DECODE_BATCH]
+                for row, car in zip(batch, cars_data_from_raws([r[3] for r in batch], iblock_wait_sec=IBLOCK_PUBLISH_WAIT_SEC)):
+                    if car is None:
+                        _sync_999_count("undecoded")
+                        continue
+                    if car.get("iblock_unresolved"):
+                        # Имя модели/кузова ещё не пришло: не PATCH-им чужими опциями, строка остаётся «грязной»
+                        _sync_999_count("deferred")
+                        continue
+                    pool.submit(_run, row, car)
+        with _sync_999_lock:
+            st = dict(_sync_999_status)
+        if st["patched"] or st["skipped"]:
+            print(
+                f"AUTO_999: синхронизировано с БД объявлений на 999: {st['patched']}, без изменений features (PATCH пропущен): {st['skipped']}"
+                f", ошибок: {st['failed']}, за {time.time() - st['started_at']:.0f} с",
+                flush=True,
+            )
+        if IMAGE_CACHE_ENABLED:
+            evicted = evict_image_cache()
+            if evicted:
+                print(f"AUTO_999: из кэша image_id удалено просроченных записей: {evicted}", flush=True)
+        _sync_999_set(state="done", finished_at=time.time())
     except Exception as e:
+        _sync_999_set(state="error", last_error=str(e), finished_at=time.time())
         print(f"WARN _sync_999_adverts_from_db: {e}", file=sys.stderr, flush=True)
-    finally:
-        if conn:
-            try:
-                conn.close()
-            except Exception:
-                pass
 
 
-def _maybe_sync_999_adverts_from_db() -> None:
-    """Запускать sync только по расписанию (11:00 и 18:00 локально), один раз на час-слот."""
+def start_sync_999_run(sharded: bool = True) -> Dict[str, Any]:
+    """Запустить проход sync в отдельном потоке; петля авто-публикации не ждёт его окончания.
+    sharded=False — все объявления, а не только шард этой реплики (ручной запуск)."""
+    global _sync_999_thread
+    with _sync_999_lock:
+        if _sync_999_thread and _sync_999_thread.is_alive():
+            return {"started": False, "message": "sync уже идёт"}
+        _sync_999_thread = threading.Thread(
+            target=_sync_999_adverts_from_db, args=(sharded,), name="sync999-run", daemon=True
+        )
+        _sync_999_thread.start()
+    return {"started": True}
+
+
+def get_sync_999_status() -> Dict[str, Any]:
+    with _sync_999_lock:
+        st = dict(_sync_999_status)
+    out: Dict[str, Any] = {
+        "concurrency": SYNC_999_CONCURRENCY,
+        "rate_per_sec": _upstream_limiter("999.sync").bucket.rate_per_sec,
+        "max_per_run": SYNC_999_MAX_PER_RUN,
+        "run_hours": list(SYNC_999_RUN_HOURS),
+        "last_slot": _sync_999_last_run_slot,
+        **st,
+    }
+    started = st.get("started_at")
+    if started:
+        elapsed = (st.get("finished_at") or time.time()) - started
+        done = int(st.get("done") or 0)
+        total = int(st.get("total") or 0)
+        out["elapsed_sec"] = round(elapsed, 1)
+        out["progress"] = round(done / total, 3) if total else None
+        out["throughput_per_min"] = round(done / elapsed * 60, 1) if elapsed > 0 else None
+        if st.get("state") == "running" and done and total > done:
+            out["eta_sec"] = round((total - done) * elapsed / done)
+        out["started_at"] = datetime.fromtimestamp(started).isoformat(timespec="seconds")
+        if st.get("finished_at"):
+            out["finished_at"] = datetime.fromtimestamp(st["finished_at"]).isoformat(timespec="seconds")
+    return out
+
+
+def _maybe_sync_999_adverts_from_db(has_token: bool = True) -> None:
+    """Запускать sync только по расписанию (11:00 и 18:00 локально), один раз на час-слот. Проход идёт в своём потоке.
+    Без токена слот тоже считается отработанным (пропущен) — иначе петля просыпалась бы к нему каждую секунду весь час."""
     global _sync_999_last_run_slot
     now_local = datetime.now()
     if now_local.hour not in SYNC_999_RUN_HOURS:
@@ -2265,8 +5115,24 @@ def _maybe_sync_999_adverts_from_db() -> None:
     if _sync_999_last_run_slot == slot:
         return
     _sync_999_last_run_slot = slot
-    print(f"AUTO_999: запуск SYNC_999 по расписанию (slot={slot}:00)", flush=True)
-    _sync_999_adverts_from_db()
+    if not has_token:
+        print(f"WARN AUTO_999: SYNC_999 по расписанию (slot={slot}:00) пропущен — нет токена 999", file=sys.stderr, flush=True)
+        return
+    started = start_sync_999_run()
+    print(f"AUTO_999: запуск SYNC_999 по расписанию (slot={slot}:00): {started}", flush=True)
+
+
+def _next_sync_999_slot_at() -> float:
+    """Unix-время начала ближайшего ещё не запущенного час-слота SYNC_999_RUN_HOURS (сейчас — если текущий слот не отработан)."""
+    now_local = datetime.now()
+    if now_local.hour in SYNC_999_RUN_HOURS and _sync_999_last_run_slot != now_local.strftime("%Y-%m-%d %H"):
+        return time.time()
+    hour_start = now_local.replace(minute=0, second=0, microsecond=0)
+    for ahead in range(1, 25):
+        candidate = hour_start + timedelta(hours=ahead)
+        if candidate.hour in SYNC_999_RUN_HOURS:
+            return candidate.timestamp()
+    return time.time() + 3600
 
 
 def send_telegram_notification_999(
@@ -2297,7 +5163,7 @@ def send_telegram_notification_999(
     text = "\n".join(lines)
     base_url = f"https://api.telegram.org/bot{TG_BOT_TOKEN_999}"
     try:
-        r = requests.post(
+        r = _limited_request("telegram", lambda: requests.post(
             f"{base_url}/sendMessage",
             json={
                 "chat_id": TG_CHAT_ID_999,
@@ -2306,21 +5172,21 @@ def send_telegram_notification_999(
                 "disable_web_page_preview": True,
             },
             timeout=10,
-        )
+        ))
         if not r.ok:
             print(f"WARN: Telegram уведомление 999: {r.status_code} {r.text[:200]}", file=sys.stderr, flush=True)
         elif photo_url and photo_url.strip().startswith("http"):
             try:
-                img_resp = requests.get(photo_url.strip(), timeout=15)
+                img_resp = _limited_request("bitrix.files", lambda: requests.get(photo_url.strip(), timeout=15))
                 if img_resp.ok and img_resp.content:
                     ct = img_resp.headers.get("Content-Type") or "image/jpeg"
                     ext = ".jpg" if "jpeg" in ct or "jpg" in ct else ".png" if "png" in ct else ".webp" if "webp" in ct else ".jpg"
-                    r2 = requests.post(
+                    r2 = _limited_request("telegram", lambda: requests.post(
                         f"{base_url}/sendPhoto",
                         data={"chat_id": TG_CHAT_ID_999},
                         files={"photo": (f"photo{ext}", img_resp.content, ct)},
                         timeout=20,
-                    )
+                    ))
                     if not r2.ok:
                         print(f"WARN: Telegram sendPhoto 999: {r2.status_code} {r2.text[:200]}", file=sys.stderr, flush=True)
                 else:
@@ -2346,6 +5212,631 @@ def get_advert_features(advert_id: str, lang: str = "ru") -> Dict[str, Any]:
     return _get(f"/adverts/{advert_id}/features", {"lang": lang})
 
 
+# -----------------------------
+# Миграции схемы (один раз на старте, версия — в SCHEMA_MIGRATIONS_TABLE)
+# -----------------------------
+SCHEMA_MIGRATIONS_TABLE = "public.b24_999_schema_migrations"
+SCHEMA_MIGRATIONS_LOCK_KEY = 999016          # pg_advisory_lock: несколько реплик не накатывают миграции одновременно
+SCHEMA_MIGRATIONS_RETRY_SEC = int(os.getenv("SCHEMA_MIGRATIONS_RETRY_SEC", "60"))  # если на старте БД недоступна — повтор из горячего пути не чаще
+SCHEMA_MIGRATIONS_LOCK_WAIT_SEC = float(os.getenv("SCHEMA_MIGRATIONS_LOCK_WAIT_SEC", "30"))  # сколько старт ждёт лок, пока миграции накатывает другая реплика
+
+
+
+def _sql_literal(value: Any) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+# (версия, имя, SQL). Только дописывать в конец: применённая версия больше не выполняется.
+SCHEMA_MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "sent_items", [
+        f"""CREATE TABLE IF NOT EXISTS {SENT_999_TABLE} (
+            item_id BIGINT PRIMARY KEY,
+            sent_at TIMESTAMPTZ DEFAULT now()
+        )""",
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS advert_id BIGINT",
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS last_sync_raw_hash TEXT",
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS last_sync_at TIMESTAMPTZ",
+    ]),
+    (2, "iblock_elements", [
+        f"""CREATE TABLE IF NOT EXISTS {IBLOCK_CACHE_TABLE} (
+            iblock_id INTEGER NOT NULL,
+            element_id INTEGER NOT NULL,
+            name TEXT,
+            raw JSONB,
+            updated_at TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (iblock_id, element_id)
+        )""",
+    ]),
+    (3, "iblock_types", [
+        f"""CREATE TABLE IF NOT EXISTS {IBLOCK_TYPE_TABLE} (
+            iblock_id INTEGER PRIMARY KEY,
+            iblock_type_id TEXT NOT NULL,
+            learned_at TIMESTAMPTZ DEFAULT now()
+        )""",
+    ]),
+    (4, "field_enum_cache", [
+        f"""CREATE TABLE IF NOT EXISTS {ENUM_CACHE_TABLE} (
+            entity_type_id INTEGER NOT NULL,
+            b24_field TEXT NOT NULL,
+            enum_map JSONB NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (entity_type_id, b24_field)
+        )""",
+    ]),
+    (5, "dependent_options_cache", [
+        f"""CREATE TABLE IF NOT EXISTS {DEPENDENT_OPTIONS_CACHE_TABLE} (
+            subcategory_id TEXT NOT NULL,
+            dependency_feature_id TEXT NOT NULL,
+            parent_option_id TEXT NOT NULL,
+            lang TEXT NOT NULL,
+            options JSONB NOT NULL,
+            fetched_at TIMESTAMPTZ DEFAULT now(),
+            PRIMARY KEY (subcategory_id, dependency_feature_id, parent_option_id, lang)
+        )""",
+    ]),
+    (6, "image_cache", [
+        f"""CREATE TABLE IF NOT EXISTS {IMAGE_CACHE_TABLE} (
+            content_hash TEXT PRIMARY KEY,
+            image_id TEXT NOT NULL,
+            file_id BIGINT,
+            uploaded_at TIMESTAMPTZ DEFAULT now(),
+            last_used_at TIMESTAMPTZ DEFAULT now()
+        )""",
+        f"CREATE INDEX IF NOT EXISTS b24_999_image_cache_file_id_idx ON {IMAGE_CACHE_TABLE} (file_id)",
+    ]),
+    # Функции не бросают ошибок на «кривом» raw: индексное выражение с ошибкой сломало бы INSERT в b24_sp_f_1114.
+    (7, "sp1114_hot_filter_indexes", [
+        """CREATE OR REPLACE FUNCTION public.b24_999_item_id(raw jsonb) RETURNS bigint
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE WHEN raw->>'id' ~ '^[0-9]{1,18}$' THEN (raw->>'id')::bigint END
+        $$""",
+        """CREATE OR REPLACE FUNCTION public.b24_999_stage(raw jsonb) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT COALESCE(TRIM(raw->>'stageId'), '')
+        $$""",
+        """CREATE OR REPLACE FUNCTION public.b24_999_photo_count(raw jsonb, photo_key text) RETURNS integer
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE WHEN jsonb_typeof(raw->photo_key) = 'array' THEN jsonb_array_length(raw->photo_key) ELSE 0 END
+        $$""",
+        # text -> timestamptz зависит от TimeZone сессии, поэтому IMMUTABLE только с фиксированным TimeZone.
+        """CREATE OR REPLACE FUNCTION public.b24_999_created_at(raw jsonb) RETURNS timestamptz
+        LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE SET TimeZone = 'UTC' AS $$
+        BEGIN
+            RETURN COALESCE(NULLIF(raw->>'createdTime', '')::timestamptz, NULLIF(raw->>'createdate', '')::timestamptz);
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END
+        $$""",
+        # Большая таблица под записью: CONCURRENTLY (вне транзакции, см. _apply_schema_migrations) не блокирует INSERT/UPDATE.
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS b24_sp_f_1114_item_id_idx ON {DATA_TABLE_SP1114} (public.b24_999_item_id(raw))",
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS b24_sp_f_1114_stage_idx ON {DATA_TABLE_SP1114} (public.b24_999_stage(raw))",
+        f"""CREATE INDEX CONCURRENTLY IF NOT EXISTS b24_sp_f_1114_999_queue_idx ON {DATA_TABLE_SP1114}
+            (public.b24_999_stage(raw), public.b24_999_created_at(raw) DESC NULLS LAST)
+            WHERE COALESCE(categoryid::text, raw->>'categoryId') = '{CATEGORY_ID_SP1114}'""",
+        f"ANALYZE {DATA_TABLE_SP1114}",
+    ]),
+    # Правила отбора (b24_999_candidate_reason) подставляются из кода в _sync_candidate_rules — здесь заглушка,
+    # чтобы триггер не падал в окне между миграцией и первой синхронизацией правил.
+    (8, "candidates_queue", [
+        f"""CREATE TABLE IF NOT EXISTS {CANDIDATES_999_TABLE} (
+            item_id BIGINT PRIMARY KEY,
+            created_at TIMESTAMPTZ,
+            reason TEXT,
+            sent BOOLEAN NOT NULL DEFAULT false,
+            updated_at TIMESTAMPTZ DEFAULT now()
+        )""",
+        f"""CREATE INDEX IF NOT EXISTS b24_999_candidates_ready_idx ON {CANDIDATES_999_TABLE}
+            (created_at DESC NULLS LAST) WHERE reason IS NULL AND NOT sent""",
+        """CREATE OR REPLACE FUNCTION public.b24_999_candidate_reason(raw jsonb, category text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$ SELECT 'rules_pending'::text $$""",
+        f"""CREATE OR REPLACE FUNCTION public.b24_999_candidates_from_sp1114() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            old_id bigint;
+            new_id bigint;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                old_id := public.b24_999_item_id(OLD.raw);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                new_id := public.b24_999_item_id(NEW.raw);
+            END IF;
+            IF TG_OP = 'UPDATE' AND OLD.raw IS NOT DISTINCT FROM NEW.raw
+               AND OLD.categoryid IS NOT DISTINCT FROM NEW.categoryid THEN
+                RETURN NULL;
+            END IF;
+            BEGIN
+                IF old_id IS NOT NULL AND old_id IS DISTINCT FROM new_id THEN
+                    DELETE FROM {CANDIDATES_999_TABLE} WHERE item_id = old_id;
+                END IF;
+                IF new_id IS NOT NULL THEN
+                    INSERT INTO {CANDIDATES_999_TABLE} (item_id, created_at, reason, sent, updated_at)
+                    VALUES (
+                        new_id,
+                        public.b24_999_created_at(NEW.raw),
+                        public.b24_999_candidate_reason(NEW.raw, NEW.categoryid::text),
+                        EXISTS (SELECT 1 FROM {SENT_999_TABLE} WHERE item_id = new_id),
+                        now()
+                    )
+                    ON CONFLICT (item_id) DO UPDATE
+                    SET created_at = EXCLUDED.created_at, reason = EXCLUDED.reason, updated_at = now();
+                END IF;
+            EXCEPTION WHEN others THEN
+                RAISE WARNING 'b24_999_candidates_from_sp1114: %', SQLERRM;
+            END;
+            RETURN NULL;
+        END
+        $$""",
+        f"""CREATE OR REPLACE FUNCTION public.b24_999_candidates_from_sent() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    UPDATE {CANDIDATES_999_TABLE} SET sent = true, updated_at = now() WHERE item_id = NEW.item_id;
+                ELSE
+                    UPDATE {CANDIDATES_999_TABLE} SET sent = false, updated_at = now() WHERE item_id = OLD.item_id;
+                END IF;
+            EXCEPTION WHEN others THEN
+                RAISE WARNING 'b24_999_candidates_from_sent: %', SQLERRM;
+            END;
+            RETURN NULL;
+        END
+        $$""",
+        f"DROP TRIGGER IF EXISTS b24_999_candidates_trg ON {DATA_TABLE_SP1114}",
+        f"""CREATE TRIGGER b24_999_candidates_trg AFTER INSERT OR UPDATE OR DELETE ON {DATA_TABLE_SP1114}
+            FOR EACH ROW EXECUTE FUNCTION public.b24_999_candidates_from_sp1114()""",
+        f"DROP TRIGGER IF EXISTS b24_999_candidates_sent_trg ON {SENT_999_TABLE}",
+        f"""CREATE TRIGGER b24_999_candidates_sent_trg AFTER INSERT OR DELETE ON {SENT_999_TABLE}
+            FOR EACH ROW EXECUTE FUNCTION public.b24_999_candidates_from_sent()""",
+    ]),
+    # NOTIFY с item_id, когда меняется то, от чего зависит публикация/скрытие: стадия или причина (не)годности
+    # (категория, фото, обязательные поля). Прочие правки raw (цена, описание) петлю не будят.
+    (9, "sp1114_notify", [
+        f"""CREATE OR REPLACE FUNCTION public.b24_999_notify_sp1114() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            new_id bigint;
+            new_stage text;
+            new_reason text;
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.raw IS NOT DISTINCT FROM NEW.raw
+               AND OLD.categoryid IS NOT DISTINCT FROM NEW.categoryid THEN
+                RETURN NULL;
+            END IF;
+            BEGIN
+                new_id := public.b24_999_item_id(NEW.raw);
+                IF new_id IS NULL THEN
+                    RETURN NULL;
+                END IF;
+                new_stage := public.b24_999_stage(NEW.raw);
+                new_reason := public.b24_999_candidate_reason(NEW.raw, NEW.categoryid::text);
+                IF TG_OP = 'INSERT' THEN
+                    IF new_reason IS NULL OR new_stage = {_sql_literal(STAGE_ID_SUCCESS)} THEN
+                        PERFORM pg_notify({_sql_literal(NOTIFY_999_CHANNEL)}, new_id::text);
+                    END IF;
+                ELSIF new_stage IS DISTINCT FROM public.b24_999_stage(OLD.raw)
+                   OR new_reason IS DISTINCT FROM public.b24_999_candidate_reason(OLD.raw, OLD.categoryid::text) THEN
+                    PERFORM pg_notify({_sql_literal(NOTIFY_999_CHANNEL)}, new_id::text);
+                END IF;
+            EXCEPTION WHEN others THEN
+                RAISE WARNING 'b24_999_notify_sp1114: %', SQLERRM;
+            END;
+            RETURN NULL;
+        END
+        $$""",
+        f"DROP TRIGGER IF EXISTS b24_999_notify_trg ON {DATA_TABLE_SP1114}",
+        f"""CREATE TRIGGER b24_999_notify_trg AFTER INSERT OR UPDATE ON {DATA_TABLE_SP1114}
+            FOR EACH ROW EXECUTE FUNCTION public.b24_999_notify_sp1114()""",
+    ]),
+    # sync_hash — хэш только тех полей raw, что идут в car_data_from_raw; набор ключей подставляет
+    # _ensure_sync_hash_rules (зависит от meta), здесь заглушка = прежний md5(raw::text).
+    (10, "sent_items_sync_hash", [
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS sync_hash TEXT",
+        """CREATE OR REPLACE FUNCTION public.b24_999_sync_hash(raw jsonb) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$ SELECT md5(COALESCE(raw::text, '')) $$""",
+        f"""CREATE OR REPLACE FUNCTION public.b24_999_sync_hash_sp1114() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            new_id bigint;
+            new_hash text;
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.raw IS NOT DISTINCT FROM NEW.raw THEN
+                RETURN NULL;
+            END IF;
+            BEGIN
+                new_id := public.b24_999_item_id(NEW.raw);
+                IF new_id IS NOT NULL THEN
+                    new_hash := public.b24_999_sync_hash(NEW.raw);
+                    UPDATE {SENT_999_TABLE} SET sync_hash = new_hash
+                    WHERE item_id = new_id AND sync_hash IS DISTINCT FROM new_hash;
+                END IF;
+            EXCEPTION WHEN others THEN
+                RAISE WARNING 'b24_999_sync_hash_sp1114: %', SQLERRM;
+            END;
+            RETURN NULL;
+        END
+        $$""",
+        f"DROP TRIGGER IF EXISTS b24_999_sync_hash_trg ON {DATA_TABLE_SP1114}",
+        f"""CREATE TRIGGER b24_999_sync_hash_trg AFTER INSERT OR UPDATE ON {DATA_TABLE_SP1114}
+            FOR EACH ROW EXECUTE FUNCTION public.b24_999_sync_hash_sp1114()""",
+        f"""UPDATE {SENT_999_TABLE} s SET sync_hash = public.b24_999_sync_hash(t.raw)
+            FROM {DATA_TABLE_SP1114} t WHERE public.b24_999_item_id(t.raw) = s.item_id""",
+        f"""CREATE INDEX IF NOT EXISTS b24_999_sent_items_dirty_idx ON {SENT_999_TABLE} (sent_at DESC NULLS LAST)
+            WHERE advert_id IS NOT NULL AND last_sync_raw_hash IS DISTINCT FROM sync_hash""",
+    ]),
+    (11, "sent_items_features_snapshot", [
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS features_hash TEXT",
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS features_snapshot JSONB",
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS last_patch_result TEXT",
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS last_patch_at TIMESTAMPTZ",
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS patch_count INTEGER NOT NULL DEFAULT 0",
+        f"ALTER TABLE {SENT_999_TABLE} ADD COLUMN IF NOT EXISTS patch_skips INTEGER NOT NULL DEFAULT 0",
+    ]),
+    # Очередь публикаций: state — последний завершённый шаг (PUBLISH_JOB_STATES), notified/failed — конечные.
+    # car — аргументы публикации на момент постановки; payload и image_ids фиксируются после загрузки фото.
+    (12, "publish_jobs", [
+        f"""CREATE TABLE IF NOT EXISTS {PUBLISH_JOBS_TABLE} (
+            id BIGSERIAL PRIMARY KEY,
+            item_id BIGINT NOT NULL,
+            source TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            car JSONB NOT NULL,
+            image_ids JSONB,
+            payload JSONB,
+            result JSONB,
+            advert_id BIGINT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            locked_by TEXT,
+            locked_until TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        )""",
+        f"""CREATE UNIQUE INDEX IF NOT EXISTS b24_999_publish_jobs_active_uidx ON {PUBLISH_JOBS_TABLE} (item_id)
+            WHERE {PUBLISH_JOB_ACTIVE_SQL}""",
+        f"""CREATE INDEX IF NOT EXISTS b24_999_publish_jobs_due_idx ON {PUBLISH_JOBS_TABLE} (next_attempt_at, id)
+            WHERE {PUBLISH_JOB_ACTIVE_SQL}""",
+        f"CREATE INDEX IF NOT EXISTS b24_999_publish_jobs_item_idx ON {PUBLISH_JOBS_TABLE} (item_id, updated_at DESC)",
+    ]),
+    (13, "replicas", [
+        f"""CREATE TABLE IF NOT EXISTS {REPLICAS_TABLE} (
+            replica_id TEXT PRIMARY KEY,
+            host TEXT,
+            pid INTEGER,
+            is_leader BOOLEAN NOT NULL DEFAULT false,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            seen_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )""",
+    ]),
+]
+
+
+def _candidate_reason_function_sql() -> str:
+    """Правила отбора из кода (стадии, категория, фото, обязательные поля) -> SQL-функция; NULL = кандидат."""
+    stages = ", ".join(_sql_literal(x) for x in STAGE_IDS_ALLOWED_999)
+    photo_key = _sql_literal(PHOTO_RAW_KEY)
+    whens = [
+        f"WHEN public.b24_999_stage(raw) NOT IN ({stages}) THEN 'stage'",
+        f"WHEN COALESCE(category, raw->>'categoryId') IS DISTINCT FROM {_sql_literal(CATEGORY_ID_SP1114)} THEN 'category'",
+        f"WHEN public.b24_999_photo_count(raw, {photo_key}) < {int(MIN_PHOTOS_999)} THEN 'photos'",
+    ]
+    whens += [
+        f"WHEN COALESCE(raw->>{_sql_literal(k)}, '') = '' THEN {_sql_literal('empty:' + k)}"
+        for k in REQUIRE_ALL_FILLED_SCALAR_FIELDS
+    ]
+    body = "\n                ".join(whens)
+    return f"""CREATE OR REPLACE FUNCTION public.b24_999_candidate_reason(raw jsonb, category text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE
+                {body}
+            END
+        $$"""
+
+
+_candidates_status: Dict[str, Any] = {"rules_hash": None, "rebuilt_at": None, "rebuilt_rows": None}
+
+
+def _rebuild_candidates(conn) -> int:
+    """Полный пересчёт очереди по b24_sp_f_1114 (после смены правил). Обычная работа — только триггеры."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            INSERT INTO {CANDIDATES_999_TABLE} (item_id, created_at, reason, sent, updated_at)
+            SELECT DISTINCT ON ({SQL_ITEM_ID})
+                   {SQL_ITEM_ID},
+                   {SQL_CREATED_AT},
+                   public.b24_999_candidate_reason(t.raw, t.categoryid::text),
+                   EXISTS (SELECT 1 FROM {SENT_999_TABLE} s WHERE s.item_id = {SQL_ITEM_ID}),
+                   now()
+            FROM {DATA_TABLE_SP1114} t
+            WHERE {SQL_ITEM_ID} IS NOT NULL
+            ORDER BY {SQL_ITEM_ID}
+            ON CONFLICT (item_id) DO UPDATE
+            SET created_at = EXCLUDED.created_at, reason = EXCLUDED.reason, sent = EXCLUDED.sent, updated_at = now()
+            """
+        )
+        n = cur.rowcount
+        cur.execute(
+            f"""DELETE FROM {CANDIDATES_999_TABLE} c
+                WHERE NOT EXISTS (SELECT 1 FROM {DATA_TABLE_SP1114} t WHERE {SQL_ITEM_ID} = c.item_id)"""
+        )
+    conn.commit()
+    _candidates_status["rebuilt_at"] = datetime.now().isoformat(timespec="seconds")
+    _candidates_status["rebuilt_rows"] = n
+    return n
+
+
+def _sync_candidate_rules(conn, force_rebuild: bool = False) -> bool:
+    """Под advisory-lock миграций: если правила в коде изменились (hash в COMMENT функции) — заменить функцию и пересчитать очередь."""
+    sql = _candidate_reason_function_sql()
+    rules_hash = hashlib.md5(sql.encode("utf-8")).hexdigest()
+    with conn.cursor() as cur:
+        cur.execute("SELECT obj_description('public.b24_999_candidate_reason(jsonb,text)'::regprocedure, 'pg_proc')")
+        row = cur.fetchone()
+    conn.commit()
+    _candidates_status["rules_hash"] = rules_hash
+    if row and row[0] == f"rules:{rules_hash}" and not force_rebuild:
+        return False
+    with conn.cursor() as cur:
+        cur.execute(sql)
+        cur.execute(f"COMMENT ON FUNCTION public.b24_999_candidate_reason(jsonb, text) IS 'rules:{rules_hash}'")
+    conn.commit()
+    n = _rebuild_candidates(conn)
+    print(f"SCHEMA candidates: правила {rules_hash[:8]}, пересчитано строк: {n}", flush=True)
+    return True
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+_schema_version = 0
+_schema_last_attempt = 0.0
+_schema_status: Dict[str, Any] = {"applied": [], "last_error": None, "finished_at": None}
+
+
+_CONCURRENT_INDEX_RE = re.compile(r"^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+
+def _run_concurrent_index(conn, sql: str, index_name: str) -> None:
+    """CREATE INDEX CONCURRENTLY нельзя в транзакции: выполняем в autocommit. Недостроенный (INVALID) индекс от прерванной
+    попытки IF NOT EXISTS пропустил бы — такой сначала удаляем."""
+    conn.commit()
+    conn.set_session(autocommit=True)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                   WHERE c.relname = %s AND NOT i.indisvalid""",
+                (index_name,),
+            )
+            if cur.fetchone():
+                print(f"SCHEMA: индекс {index_name} INVALID после прерванной сборки, пересоздаю", flush=True)
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+            cur.execute(sql)
+    finally:
+        conn.set_session(autocommit=False)
+
+
+def _try_schema_lock(conn, wait_sec: float, xact: bool = False) -> bool:
+    """Взять SCHEMA_MIGRATIONS_LOCK_KEY: try-lock раз в секунду, не дольше wait_sec (0 — одна попытка).
+    Не pg_advisory_lock: ждущий запрос держит снимок, и CREATE INDEX CONCURRENTLY у реплики-владельца лока ждал бы его вечно.
+    xact=True — pg_try_advisory_xact_lock: лок живёт до конца текущей транзакции conn (при успехе транзакция не завершается)."""
+    fn = "pg_try_advisory_xact_lock" if xact else "pg_try_advisory_lock"
+    deadline = time.time() + max(0.0, wait_sec)
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT {fn}(%s)", (SCHEMA_MIGRATIONS_LOCK_KEY,))
+            locked = bool(cur.fetchone()[0])
+        if locked:
+            if not xact:
+                conn.commit()
+            return True
+        conn.rollback()
+        if time.time() >= deadline:
+            return False
+        time.sleep(1.0)
+
+
+def _apply_schema_migrations(conn, lock_wait_sec: float = SCHEMA_MIGRATIONS_LOCK_WAIT_SEC) -> List[int]:
+    """Накатить недостающие версии на conn. Каждая версия — своя транзакция вместе с записью в SCHEMA_MIGRATIONS_TABLE;
+    CREATE INDEX CONCURRENTLY выполняется отдельным autocommit-шагом (поэтому такие шаги обязаны быть IF NOT EXISTS)."""
+    applied: List[int] = []
+    if not _try_schema_lock(conn, lock_wait_sec):
+        raise RuntimeError(f"лок миграций занят дольше {lock_wait_sec:.0f} с (миграции накатывает другая реплика), повтор позже")
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""CREATE TABLE IF NOT EXISTS {SCHEMA_MIGRATIONS_TABLE} (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ DEFAULT now()
+                )"""
+            )
+            cur.execute(f"SELECT version FROM {SCHEMA_MIGRATIONS_TABLE}")
+            done = {int(r[0]) for r in cur.fetchall()}
+        conn.commit()
+        for version, name, statements in SCHEMA_MIGRATIONS:
+            if version in done:
+                continue
+            try:
+                for sql in statements:
+                    concurrent = _CONCURRENT_INDEX_RE.match(sql)
+                    if concurrent:
+                        _run_concurrent_index(conn, sql, concurrent.group(1))
+                        continue
+                    with conn.cursor() as cur:
+                        cur.execute(sql)
+                with conn.cursor() as cur:
+                    cur.execute(
+                        f"INSERT INTO {SCHEMA_MIGRATIONS_TABLE} (version, name) VALUES (%s, %s)",
+                        (version, name),
+                    )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+            print(f"SCHEMA migration {version} ({name}) applied", flush=True)
+        _sync_candidate_rules(conn)
+    finally:
+        try:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_MIGRATIONS_LOCK_KEY,))
+            conn.commit()
+        except Exception:
+            pass
+    return applied
+
+
+def _run_schema_migrations_locked(lock_wait_sec: float) -> None:
+    """Под _schema_lock: миграции на собственном прямом соединении — CIC переключает его в autocommit,
+    и чужое (пуловое или вызывающего) соединение для этого не годится."""
+    global _schema_ready, _schema_version, _schema_last_attempt
+    _schema_last_attempt = time.time()
+    conn = None
+    try:
+        conn = _pg_connect_direct()
+        applied = _apply_schema_migrations(conn, lock_wait_sec)
+    except Exception as e:
+        _schema_status["last_error"] = str(e)
+        print(f"WARN schema migrations: {e}", file=sys.stderr, flush=True)
+        return
+    finally:
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    _schema_status["applied"] = applied
+    _schema_status["last_error"] = None
+    _schema_status["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    _schema_version = max(v for v, _, _ in SCHEMA_MIGRATIONS)
+    _schema_ready = True
+
+
+def run_schema_migrations() -> Dict[str, Any]:
+    """Вызывается из lifespan (в пуле потоков, не в event loop) до старта фоновых потоков. После успеха горячие пути не выполняют DDL.
+    Лок другой реплики ждём не дольше SCHEMA_MIGRATIONS_LOCK_WAIT_SEC — дальше старт идёт, повтор из горячего пути."""
+    with _schema_lock:
+        if not _schema_ready:
+            _run_schema_migrations_locked(SCHEMA_MIGRATIONS_LOCK_WAIT_SEC)
+    if _schema_ready:
+        try:
+            _ensure_sync_hash_rules()
+        except Exception as e:
+            print(f"WARN sync_hash rules: {e}", file=sys.stderr, flush=True)
+    return get_schema_status()
+
+
+def _ensure_schema(conn=None) -> None:
+    """Горячие пути: после миграций — только проверка флага. Если на старте не вышло — докатить не чаще SCHEMA_MIGRATIONS_RETRY_SEC
+    на своём соединении (conn вызывающего не трогаем: CIC перевёл бы его в autocommit посреди чужой транзакции).
+    Лок не ждём: занят — значит, миграции уже идут у другой реплики."""
+    if _schema_ready or time.time() - _schema_last_attempt < SCHEMA_MIGRATIONS_RETRY_SEC:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            _run_schema_migrations_locked(0)
+
+
+def _plan_nodes(plan: Dict[str, Any]):
+    yield plan
+    for child in plan.get("Plans") or []:
+        yield from _plan_nodes(child)
+
+
+def explain_hot_queries() -> Dict[str, Any]:
+    """EXPLAIN горячих запросов по b24_sp_f_1114: какие индексы выбрал планировщик и остался ли Seq Scan.
+    На маленькой таблице Seq Scan законен — поэтому рядом отдаём оценку числа строк."""
+    table = DATA_TABLE_SP1114.split(".")[-1]
+    checks: List[Tuple[str, Tuple[str, tuple], List[str]]] = [
+        ("fetch_next_raw_for_999", _next_raw_for_999_query(True), ["b24_999_candidates_ready_idx", "b24_sp_f_1114_999_queue_idx"]),
+        ("fetch_all_eligible_for_999", _eligible_for_999_query(500), ["b24_999_candidates_ready_idx", "b24_sp_f_1114_999_queue_idx"]),
+        ("hide_success_stage", _success_stage_adverts_query(), ["b24_sp_f_1114_stage_idx", "b24_sp_f_1114_item_id_idx"]),
+        ("sync_candidates", _sync_candidates_query(), ["b24_999_sent_items_dirty_idx", "b24_sp_f_1114_item_id_idx"]),
+        (
+            "fetch_raw_by_item_id",
+            (f"SELECT t.raw FROM {DATA_TABLE_SP1114} t WHERE {SQL_ITEM_ID} = %s LIMIT 1", (0,)),
+            ["b24_sp_f_1114_item_id_idx"],
+        ),
+    ]
+    out: Dict[str, Any] = {"schema": get_schema_status(), "queries": {}}
+    with _pg_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", (DATA_TABLE_SP1114,))
+            row = cur.fetchone()
+            out["table_rows_estimate"] = int(row[0]) if row and row[0] is not None else None
+            for name, (q, params), expected in checks:
+                cur.execute("EXPLAIN (FORMAT JSON) " + q, params)
+                doc = cur.fetchone()[0]
+                if isinstance(doc, str):
+                    doc = json.loads(doc)
+                plan = doc[0]["Plan"]
+                nodes = list(_plan_nodes(plan))
+                used = sorted({n["Index Name"] for n in nodes if n.get("Index Name")})
+                out["queries"][name] = {
+                    "uses_index": any(ix in used for ix in expected),
+                    "expected": expected,
+                    "indexes": used,
+                    "seq_scan": any(n.get("Node Type") == "Seq Scan" and n.get("Relation Name") == table for n in nodes),
+                    "total_cost": plan.get("Total Cost"),
+                }
+        conn.rollback()
+    out["ok"] = all(v["uses_index"] for v in out["queries"].values())
+    return out
+
+
+def rebuild_candidates() -> Dict[str, Any]:
+    """Принудительно обновить правила и пересчитать очередь (например, после ручной правки b24_sp_f_1114 с выключенными триггерами).
+    Лок миграций ждём не дольше SCHEMA_MIGRATIONS_LOCK_WAIT_SEC; занят — ok=False, busy=True, повторить позже."""
+    with _schema_lock:
+        with _pg_conn() as conn:
+            if not _try_schema_lock(conn, SCHEMA_MIGRATIONS_LOCK_WAIT_SEC):
+                return {
+                    "ok": False,
+                    "busy": True,
+                    "error": "лок миграций занят (миграции или пересчёт у другой реплики), повторите позже",
+                    **get_candidates_status(),
+                }
+            try:
+                _sync_candidate_rules(conn, force_rebuild=True)
+            finally:
+                conn.rollback()
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_MIGRATIONS_LOCK_KEY,))
+                conn.commit()
+    return get_candidates_status()
+
+
+def get_candidates_status() -> Dict[str, Any]:
+    out: Dict[str, Any] = {"table": CANDIDATES_999_TABLE, "in_use": _schema_ready, **_candidates_status}
+    if not _schema_ready:
+        return out
+    with _pg_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""SELECT COALESCE(reason, 'ready'), sent, count(*)
+                    FROM {CANDIDATES_999_TABLE} GROUP BY 1, 2 ORDER BY 3 DESC"""
+            )
+            rows = cur.fetchall()
+        conn.rollback()
+    out["ready"] = sum(int(n) for reason, sent, n in rows if reason == "ready" and not sent)
+    out["sent"] = sum(int(n) for _, sent, n in rows if sent)
+    out["by_reason"] = {reason: int(n) for reason, sent, n in rows if not sent}
+    return out
+
+
+def get_schema_status() -> Dict[str, Any]:
+    return {
+        "ready": _schema_ready,
+        "version": _schema_version,
+        "target_version": max(v for v, _, _ in SCHEMA_MIGRATIONS),
+        "table": SCHEMA_MIGRATIONS_TABLE,
+        **_schema_status,
+    }
+
+
 # --- FastAPI router ---
 router = APIRouter(prefix="/api/publish-999md", tags=["publish-999md"])
 
@@ -2519,9 +6010,10 @@ def api_save_features_from_999(lang: str = "ru") -> Dict[str, Any]:
         raise HTTPException(status_code=503, detail="999.md token not set")
     try:
         data = get_features_from_api(lang=lang)
-        p = Path(__file__).resolve().parent / "999md_features_cars_sell.json"
+        p = FEATURES_JSON_PATH
         with open(p, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        invalidate_feature_catalog()
         return {"ok": True, "path": str(p), "message": "Фичи 999 сохранены. Перезапустите публикацию."}
     except requests.HTTPError as e:
         raise HTTPException(status_code=502, detail=str(e))
@@ -2529,6 +6021,161 @@ def api_save_features_from_999(lang: str = "ru") -> Dict[str, Any]:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/dependent-options/cache")
+def api_dependent_options_cache_status() -> Dict[str, Any]:
+    """Состояние кэша GET /dependent_options (модели/поколения): размер LRU, попадания в LRU/PG, запросы к API."""
+    return get_dependent_options_cache_status()
+
+
+@router.post("/dependent-options/cache/invalidate")
+def api_dependent_options_cache_invalidate(
+    dependency_feature_id: Optional[str] = None,
+    parent_option_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Сбросить кэш dependent_options: весь или только по dependency_feature_id / parent_option_id (например марка 20 + id марки)."""
+    try:
+        return {"ok": True, **invalidate_dependent_options_cache(dependency_feature_id, parent_option_id)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/schema/status")
+def api_schema_status() -> Dict[str, Any]:
+    """Миграции схемы: применённая версия, что накатилось на этом старте, последняя ошибка."""
+    return get_schema_status()
+
+
+@router.post("/schema/migrate")
+def api_schema_migrate() -> Dict[str, Any]:
+    """Повторить миграции вручную (если на старте БД была недоступна)."""
+    return run_schema_migrations()
+
+
+@router.get("/schema/explain-check")
+def api_schema_explain_check() -> Dict[str, Any]:
+    """EXPLAIN горячих запросов по b24_sp_f_1114: используются ли индексы миграции 7."""
+    try:
+        return explain_hot_queries()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/candidates/status")
+def api_candidates_status() -> Dict[str, Any]:
+    """Очередь кандидатов на 999: сколько готово, сколько отправлено, почему остальные не подходят."""
+    try:
+        return get_candidates_status()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post("/candidates/rebuild")
+def api_candidates_rebuild() -> Dict[str, Any]:
+    """Пересчитать очередь кандидатов целиком по b24_sp_f_1114."""
+    try:
+        result = rebuild_candidates()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if result.get("busy"):
+        raise HTTPException(status_code=409, detail=result["error"])
+    return {"ok": True, **result}
+
+
+@router.get("/auto-publish/listener/status")
+def api_auto_publish_listener_status() -> Dict[str, Any]:
+    """LISTEN/NOTIFY авто-публикации: подключение, число уведомлений и пробуждений, последние item_id."""
+    return get_auto_publish_listener_status()
+
+
+@router.get("/sync/status")
+def api_sync_999_status() -> Dict[str, Any]:
+    """Проход синхронизации объявлений 999 с БД: прогресс, PATCH/пропущено/ошибки, скорость, ETA."""
+    return get_sync_999_status()
+
+
+@router.post("/sync/run")
+def api_sync_999_run() -> Dict[str, Any]:
+    """Запустить проход синхронизации сейчас (вне расписания SYNC_999_RUN_HOURS) — по всем объявлениям, не только шарду этой реплики."""
+    if not _token():
+        raise HTTPException(status_code=503, detail="999.md token not set")
+    return start_sync_999_run(sharded=False)
+
+
+@router.get("/publish-jobs/status")
+def api_publish_jobs_status() -> Dict[str, Any]:
+    """Очередь публикаций: задачи по состояниям, воркеры, задачи с ошибками."""
+    return get_publish_jobs_status()
+
+
+@router.post("/publish-jobs/{job_id}/retry")
+def api_publish_job_retry(job_id: int) -> Dict[str, Any]:
+    """Вернуть задачу из failed в очередь (с шага queued)."""
+    try:
+        row = retry_publish_job(job_id)
+    except psycopg2.IntegrityError:
+        raise HTTPException(status_code=409, detail="Для этой машины уже есть активная задача публикации")
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"Задача {job_id} не найдена или не в состоянии failed")
+    return {"ok": True, **row}
+
+
+@router.get("/replicas/status")
+def api_replicas_status() -> Dict[str, Any]:
+    """Эта реплика: лидер ли, шард hide/sync, живые реплики, захваченные машины."""
+    return get_replica_status()
+
+
+@router.get("/upstream-limits/status")
+def api_upstream_limits_status() -> Dict[str, Any]:
+    """Лимиты внешних API (999, Bitrix, Telegram): текущая/номинальная скорость, ожидания, 429/5xx, пауза по Retry-After."""
+    return get_upstream_limits_status()
+
+
+@router.get("/pg-pool/status")
+def api_pg_pool_status() -> Dict[str, Any]:
+    """Пул соединений PostgreSQL: размер, занято/свободно, ожидания, пересозданные и проверенные соединения."""
+    return _pg_pool().stats()
+
+
+@router.get("/meta-snapshot/status")
+def api_meta_snapshot_status() -> Dict[str, Any]:
+    """Снимок b24_meta_fields + enum-кэша в памяти: версия, возраст, число перечитываний и проверок."""
+    return get_meta_snapshot_status()
+
+
+@router.post("/meta-snapshot/invalidate")
+def api_meta_snapshot_invalidate() -> Dict[str, Any]:
+    """Сбросить снимок meta + enum: следующая расшифровка raw перечитает их из БД."""
+    invalidate_meta_snapshot()
+    return {"ok": True}
+
+
+@router.get("/iblock-dictionaries/status")
+def api_iblock_dictionaries_status() -> Dict[str, Any]:
+    """Справочники iblock в памяти: какие iblock синхронизированы, сколько элементов, попадания/промахи."""
+    return get_iblock_dictionaries_status()
+
+
+@router.post("/iblock-dictionaries/sync")
+def api_iblock_dictionaries_sync() -> Dict[str, Any]:
+    """Синхронизировать справочники iblock из Bitrix сейчас (в фоне). Прогресс: GET /iblock-dictionaries/status."""
+    return start_iblock_sync_thread(force=True)
+
+
+@router.get("/options-tree/status")
+def api_options_tree_status() -> Dict[str, Any]:
+    """Прогрев дерева марка -> модели -> поколения: состояние, прогресс, время, версия сохранённого дерева."""
+    return get_options_tree_status()
+
+
+@router.post("/options-tree/refresh")
+def api_options_tree_refresh() -> Dict[str, Any]:
+    """Запустить обход дерева моделей 999 сейчас (в фоне). Прогресс: GET /options-tree/status."""
+    if not _token():
+        raise HTTPException(status_code=503, detail="999.md token not set")
+    return {**start_options_tree_prewarm_thread(force=True), "status": get_options_tree_status()}
+
+
 @router.get("/adverts/{advert_id}")
 def api_get_advert(advert_id: str, lang: str = "ru") -> Dict[str, Any]:
     if not _token():
@@ -2565,7 +6212,9 @@ def api_publish_car_manual(body: PublishCarBody) -> Dict[str, Any]:
             status_code=400,
             detail="Машина не проходит фильтр (не все обязательные поля заполнены). На 999 не публикуем.",
         )
-    car = car_data_from_raw(raw)
+    car = car_data_from_raw(raw, iblock_wait_sec=IBLOCK_PUBLISH_WAIT_SEC)
+    if car.get("iblock_unresolved"):
+        raise HTTPException(status_code=503, detail=_iblock_unresolved_detail(car))
     if not car.get("image_urls"):
         raise HTTPException(
             status_code=400,
@@ -2575,47 +6224,25 @@ def api_publish_car_manual(body: PublishCarBody) -> Dict[str, Any]:
         raise HTTPException(status_code=400, detail="В raw нет марки или модели.")
     if not car.get("price") or car["price"] <= 0:
         raise HTTPException(status_code=400, detail="В raw нет цены или она 0.")
+    kwargs = _publish_kwargs(car, raw, body.item_id, phone=body.phone or "", region_option_id=body.region_option_id)
     try:
-        result = publish_car_manual(
-            marca=car["marca"],
-            model=car["model"],
-            year=car["year"],
-            price=car["price"],
-            price_unit=car.get("price_unit") or "eur",
-            mileage_km=car.get("mileage_km"),
-            description=car.get("description") or "",
-            numar_auto=car.get("numar_auto") or "",
-            phone=car.get("phone") or body.phone or "",
-            image_urls=car["image_urls"],
-            image_paths=None,
-            region_option_id=body.region_option_id,
-            listing_title=car.get("listing_title"),
-            template_listing_title=car.get("template_listing_title"),
-            description_ru=car.get("description_ru"),
-            description_ro=car.get("description_ro"),
-            category_id=raw.get("categoryId"),
-            body_type_option_id=car.get("body_type_option_id"),
-            fuel_option_id=car.get("fuel_option_id"),
-            engine_option_id=car.get("engine_option_id"),
-            drive_option_id=car.get("drive_option_id"),
-            transmission_option_id=car.get("transmission_option_id"),
-        )
-        advert_id = None
-        if result:
-            aid = (result.get("advert") or {}).get("id")
-            if aid is not None:
-                try:
-                    advert_id = int(aid)
-                except (TypeError, ValueError):
-                    pass
-        conn = _pg_conn()
+        worker = _publish_worker_name()
+        job_id, created = enqueue_publish_job(body.item_id, kwargs, "manual")
+        job = _claim_publish_job(worker, job_id) if created else None
+        if job is None:
+            # Чужая активная задача (авто/ретро) — со своими car, phone/region_option_id запроса в ней нет
+            raise HTTPException(status_code=409, detail=f"item_id={body.item_id} уже публикуется (задача {job_id})")
         try:
-            _mark_sent_to_999(conn, body.item_id, advert_id)
-        finally:
-            conn.close()
-        if advert_id is not None:
-            update_bitrix_999_publication_fields(body.item_id, advert_id)
-        return {"ok": True, "999md": result, "source": "db", "item_id": body.item_id}
+            result = _execute_publish_job(job, worker, retry=False)
+        except Exception as e:
+            if job.get("advert_id") is None:
+                raise
+            # Объявление на 999 уже есть: отметку в PG/Bitrix и уведомление доведёт воркер очереди
+            print(f"WARN publish_999md item_id={body.item_id}: после создания объявления: {e}", file=sys.stderr, flush=True)
+            result = {**(job.get("result") or {}), "pending_steps_error": str(e)}
+        return {"ok": True, "999md": result, "source": "db", "item_id": body.item_id, "job_id": job_id}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"ERROR publish_999md item_id={body.item_id}: {e}", file=sys.stderr, flush=True)
         raise
@@ -2634,7 +6261,9 @@ def api_update_advert(advert_id: str, body: UpdateAdvertBody) -> Dict[str, Any]:
     raw = fetch_raw_by_item_id(body.item_id)
     if not raw:
         raise HTTPException(status_code=404, detail=f"Item id={body.item_id} not found in {DATA_TABLE_SP1114}")
-    car = car_data_from_raw(raw)
+    car = car_data_from_raw(raw, iblock_wait_sec=IBLOCK_PUBLISH_WAIT_SEC)
+    if car.get("iblock_unresolved"):
+        raise HTTPException(status_code=503, detail=_iblock_unresolved_detail(car))
     if not car.get("image_urls"):
         raise HTTPException(
             status_code=400,
@@ -2645,68 +6274,48 @@ def api_update_advert(advert_id: str, body: UpdateAdvertBody) -> Dict[str, Any]:
     if not car.get("price") or car["price"] <= 0:
         raise HTTPException(status_code=400, detail="В raw нет цены или она 0.")
     try:
-        result = update_advert_from_item(advert_id, body.item_id, car=car, raw=raw)
+        result = update_advert_from_item(advert_id, body.item_id, car=car, raw=raw, force=True)
         return {"ok": True, "999md": result, "advert_id": advert_id, "item_id": body.item_id}
     except Exception as e:
         print(f"ERROR update_999 advert_id={advert_id} item_id={body.item_id}: {e}", file=sys.stderr, flush=True)
         raise
 
 
-def publish_car_manual(
-    marca: str,
-    model: str,
-    year: int,
-    price: float,
-    price_unit: str = "eur",
-    mileage_km: Optional[int] = None,
-    description: str = "",
-    numar_auto: str = "",
-    phone: str = "",
-    image_urls: Optional[List[str]] = None,
+def _publish_step_photos(
+    image_urls: Optional[List[str]],
     image_paths: Optional[List[str]] = None,
-    region_option_id: Optional[str] = None,
-    listing_title: Optional[str] = None,
-    **kwargs: Any,
-) -> Dict[str, Any]:
+    use_cache: bool = True,
+) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """Шаг публикации «фото»: загрузить на 999 -> (image_ids, тайминги). Строго как в TG: все фото должны загрузиться."""
     image_ids: List[str] = []
+    photo_timings: List[Dict[str, Any]] = []
     if image_paths:
         for path in image_paths:
             image_ids.append(upload_image(path))
     if image_urls:
-        for url in image_urls:
-            try:
-                image_ids.append(upload_image_from_url(url))
-            except Exception as e:
-                raise RuntimeError(f"Ошибка загрузки фото на 999: ...{url[-120:]} ; {e}") from e
+        photo_results = upload_photos_from_urls(image_urls, strict=True, use_cache=use_cache)
+        photo_timings = [r.timing() for r in photo_results]
+        for r in photo_results:
+            if r.error is not None:
+                raise RuntimeError(f"Ошибка загрузки фото на 999: ...{r.url[-120:]} ; {r.error}") from r.error
+        image_ids.extend(r.image_id for r in photo_results if r.image_id)
     # Строго как в TG: все фото должны загрузиться, частичная загрузка не допускается
     if image_urls and len(image_ids) < len(image_urls):
         msg = (
             "Не все фото загружены (401/403 от Bitrix или ошибка). Объявление не публикуется."
         )
-        raise RuntimeError(msg)
-    if image_urls and not image_ids:
-        raise RuntimeError(
-            "Не удалось загрузить ни одного фото. Объявление не публикуется."
-        )
-
-    payload = build_advert_payload(
-        marca=marca,
-        model=model,
-        year=year,
-        price=price,
-        price_unit=price_unit,
-        mileage_km=mileage_km,
-        description=description,
-        numar_auto=numar_auto,
-        phone=phone,
-        image_ids=image_ids if image_ids else None,
-        region_option_id=region_option_id,
-        listing_title=listing_title,
-        **kwargs,
-    )
+        raise RuntimeError(msg)
+    if image_urls and not image_ids:
+        raise RuntimeError(
+            "Не удалось загрузить ни одного фото. Объявление не публикуется."
+        )
+    return image_ids, photo_timings
+
 
+def _publish_step_post(payload: Dict[str, Any], phone: str, item_id: Optional[int] = None) -> Dict[str, Any]:
+    """Шаг «POST /adverts». Черновик вместо объявления (draft=True, advert=None): PUBLISH_999MD_DRAFT_ONLY или нет баланса."""
     if PUBLISH_999MD_DRAFT_ONLY:
-        draft_path = _save_draft_payload(payload, item_id=kwargs.get("item_id"))
+        draft_path = _save_draft_payload(payload, item_id=item_id)
         return {
             "ok": True,
             "draft": True,
@@ -2723,7 +6332,7 @@ def publish_car_manual(
         except RuntimeError as e:
             err_str = str(e)
             if "insufficient balance" in err_str.lower():
-                draft_path = _save_draft_payload(payload, item_id=kwargs.get("item_id"))
+                draft_path = _save_draft_payload(payload, item_id=item_id)
                 return {
                     "ok": True,
                     "draft": True,
@@ -2752,7 +6361,7 @@ def publish_car_manual(
             except RuntimeError as e:
                 err_str = str(e)
                 if "insufficient balance" in err_str.lower():
-                    draft_path = _save_draft_payload(payload, item_id=kwargs.get("item_id"))
+                    draft_path = _save_draft_payload(payload, item_id=item_id)
                     return {
                         "ok": True,
                         "draft": True,
@@ -2762,19 +6371,74 @@ def publish_car_manual(
                         "999_error": err_str,
                     }
                 raise
+    return result
 
-    # Объявление создано с access_policy "public" в payload — сразу в «Активные». Дополнительно выставляем public на случай, если API не учёл payload.
-    advert_id = (result.get("advert") or {}).get("id")
-    if advert_id:
-        if phone:
-            try:
-                ensure_advert_phone_contact(str(advert_id), phone)
-            except Exception as e:
-                print(f"WARN: ensure phone contact on POST advert {advert_id}: {e}", file=sys.stderr, flush=True)
+
+def _publish_step_contacts(advert_id: int, phone: str) -> None:
+    if phone:
         try:
-            set_advert_access_policy(str(advert_id), "public")
+            ensure_advert_phone_contact(str(advert_id), phone)
         except Exception as e:
-            print(f"WARN: access_policy=public для {advert_id}: {e}", file=sys.stderr, flush=True)
+            print(f"WARN: ensure phone contact on POST advert {advert_id}: {e}", file=sys.stderr, flush=True)
+
+
+def _publish_step_public(advert_id: int) -> None:
+    # Объявление создано с access_policy "public" в payload — сразу в «Активные». Дополнительно выставляем public на случай, если API не учёл payload.
+    try:
+        set_advert_access_policy(str(advert_id), "public")
+    except Exception as e:
+        print(f"WARN: access_policy=public для {advert_id}: {e}", file=sys.stderr, flush=True)
+
+
+def _advert_id_from_result(result: Optional[Dict[str, Any]]) -> Optional[int]:
+    aid = ((result or {}).get("advert") or {}).get("id")
+    try:
+        return int(aid) if aid is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def publish_car_manual(
+    marca: str,
+    model: str,
+    year: int,
+    price: float,
+    price_unit: str = "eur",
+    mileage_km: Optional[int] = None,
+    description: str = "",
+    numar_auto: str = "",
+    phone: str = "",
+    image_urls: Optional[List[str]] = None,
+    image_paths: Optional[List[str]] = None,
+    region_option_id: Optional[str] = None,
+    listing_title: Optional[str] = None,
+    **kwargs: Any,
+) -> Dict[str, Any]:
+    """Публикация одним вызовом, без очереди и без записи в PG/Bitrix: фото -> POST -> контакты -> public -> Telegram.
+    Фоновые петли и API публикуют через очередь задач (enqueue_publish_job) — те же шаги, но с возобновлением."""
+    image_ids, photo_timings = _publish_step_photos(image_urls, image_paths)
+
+    payload = build_advert_payload(
+        marca=marca,
+        model=model,
+        year=year,
+        price=price,
+        price_unit=price_unit,
+        mileage_km=mileage_km,
+        description=description,
+        numar_auto=numar_auto,
+        phone=phone,
+        image_ids=image_ids if image_ids else None,
+        region_option_id=region_option_id,
+        listing_title=listing_title,
+        **kwargs,
+    )
+    result = _publish_step_post(payload, phone, item_id=kwargs.get("item_id"))
+
+    advert_id = _advert_id_from_result(result)
+    if advert_id:
+        _publish_step_contacts(advert_id, phone)
+        _publish_step_public(advert_id)
         first_photo = image_urls[0] if image_urls else None
         send_telegram_notification_999(
             str(advert_id),
@@ -2784,9 +6448,417 @@ def publish_car_manual(
             category_id=kwargs.get("category_id"),
             photo_url=first_photo,
         )
+    if isinstance(result, dict) and photo_timings:
+        result["photo_timings"] = photo_timings
     return result
 
 
+# -----------------------------
+# Очередь публикаций (PUBLISH_JOBS_TABLE)
+# -----------------------------
+# Шаги по порядку; state задачи — последний завершённый. После падения процесса задача продолжается с него.
+PUBLISH_JOB_STATES = ("queued", "photos_uploaded", "posted", "contacts_set", "public", "linked", "notified")
+_PUBLISH_JOB_JSON_COLUMNS = ("car", "image_ids", "payload", "result")
+_publish_jobs_wakeup = threading.Event()
+_publish_job_threads: List[threading.Thread] = []
+_publish_jobs_lock = threading.Lock()
+_publish_jobs_stats: Dict[str, Any] = {
+    "claimed": 0,
+    "steps": 0,
+    "notified": 0,
+    "retries": 0,
+    "failed": 0,
+    "last_error": None,
+}
+
+
+def _publish_jobs_count(key: str, n: int = 1) -> None:
+    with _publish_jobs_lock:
+        _publish_jobs_stats[key] += n
+
+
+def _publish_worker_name() -> str:
+    return f"{REPLICA_ID}:{threading.current_thread().name}"
+
+
+def _jsonb(value: Any) -> psycopg2.extras.Json:
+    return psycopg2.extras.Json(value, dumps=lambda v: json.dumps(v, ensure_ascii=False, default=str))
+
+
+def _iblock_unresolved_detail(car: Dict[str, Any]) -> str:
+    return (
+        f"Имена iblock ещё не подтянуты из Bitrix {car['iblock_unresolved']} (новый элемент справочника), "
+        "повторите через несколько секунд"
+    )
+
+
+def _publish_kwargs(
+    car: Dict[str, Any],
+    raw: Dict[str, Any],
+    item_id: int,
+    phone: str = "",
+    region_option_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Аргументы публикации (как у publish_car_manual) из car_data_from_raw — хранятся в задаче как car."""
+    return {
+        "marca": car["marca"],
+        "model": car["model"],
+        "year": car["year"],
+        "price": car["price"],
+        "price_unit": car.get("price_unit") or "eur",
+        "mileage_km": car.get("mileage_km"),
+        "description": car.get("description") or "",
+        "numar_auto": car.get("numar_auto") or "",
+        "phone": car.get("phone") or phone or "",
+        "image_urls": car["image_urls"],
+        "region_option_id": region_option_id,
+        "listing_title": car.get("listing_title"),
+        "template_listing_title": car.get("template_listing_title"),
+        "description_ru": car.get("description_ru"),
+        "description_ro": car.get("description_ro"),
+        "item_id": item_id,
+        "category_id": raw.get("categoryId"),
+        "body_type_option_id": car.get("body_type_option_id"),
+        "fuel_option_id": car.get("fuel_option_id"),
+        "engine_option_id": car.get("engine_option_id"),
+        "drive_option_id": car.get("drive_option_id"),
+        "transmission_option_id": car.get("transmission_option_id"),
+    }
+
+
+def enqueue_publish_job(
+    item_id: int,
+    kwargs: Dict[str, Any],
+    source: str,
+    only_unsent: bool = False,
+) -> Tuple[Optional[int], bool]:
+    """Поставить публикацию item_id в очередь -> (id задачи, создана ли). Активная задача на машину одна (уникальный индекс):
+    если она уже есть — возвращается её id. only_unsent (авто/ретро): под захватом машины, проверка «ещё не на 999»
+    и вставка — один INSERT ... WHERE NOT EXISTS; (None, False) — машина уже на 999 или её держит другая реплика."""
+    if only_unsent and not _claim_item(item_id):
+        return None, False
+    unsent_sql = f"WHERE NOT EXISTS (SELECT 1 FROM {SENT_999_TABLE} WHERE item_id = %s)" if only_unsent else ""
+    try:
+        for _ in range(3):
+            with _pg_conn() as conn:
+                _ensure_schema(conn)
+                with conn.cursor() as cur:
+                    cur.execute(
+                        f"""
+                        INSERT INTO {PUBLISH_JOBS_TABLE} (item_id, source, car)
+                        SELECT %s, %s, %s
+                        {unsent_sql}
+                        ON CONFLICT (item_id) WHERE {PUBLISH_JOB_ACTIVE_SQL} DO NOTHING
+                        RETURNING id
+                        """,
+                        (int(item_id), source, _jsonb(kwargs), *((int(item_id),) if only_unsent else ())),
+                    )
+                    row = cur.fetchone()
+                    created = row is not None
+                    if row is None:
+                        cur.execute(
+                            f"SELECT id FROM {PUBLISH_JOBS_TABLE} WHERE item_id = %s AND {PUBLISH_JOB_ACTIVE_SQL}",
+                            (int(item_id),),
+                        )
+                        row = cur.fetchone()
+                    if only_unsent and _claim_lost(item_id):
+                        conn.rollback()
+                        return None, False
+                conn.commit()
+            if row is not None:
+                if created:
+                    _publish_jobs_wakeup.set()
+                return int(row[0]), created
+            if only_unsent:
+                return None, False
+    finally:
+        if only_unsent:
+            _release_item(item_id)
+    raise RuntimeError(f"Не удалось поставить item_id={item_id} в очередь публикаций")
+
+
+def _claim_publish_job(worker: str, job_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Взять задачу в работу (конкретную или ближайшую по next_attempt_at). FOR UPDATE SKIP LOCKED — параллельные воркеры
+    и реплики не берут одну строку; аренда locked_until продлевается на каждом шаге."""
+    where_sql = "id = %s" if job_id is not None else "next_attempt_at <= now()"
+    where_params: tuple = (int(job_id),) if job_id is not None else ()
+    with _pg_conn() as conn:
+        _ensure_schema(conn)
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                f"""
+                UPDATE {PUBLISH_JOBS_TABLE} j
+                SET locked_by = %s,
+                    locked_until = now() + make_interval(secs => %s),
+                    attempts = j.attempts + 1,
+                    updated_at = now()
+                WHERE j.id = (
+                    SELECT id FROM {PUBLISH_JOBS_TABLE}
+                    WHERE {PUBLISH_JOB_ACTIVE_SQL}
+                      AND {where_sql}
+                      AND (locked_until IS NULL OR locked_until < now())
+                    ORDER BY next_attempt_at, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING j.id, j.item_id, j.source, j.state, j.car, j.payload, j.result, j.advert_id, j.attempts
+                """,
+                (worker, PUBLISH_JOB_LEASE_SEC, *where_params),
+            )
+            row = cur.fetchone()
+        conn.commit()
+    if row is None:
+        return None
+    _publish_jobs_count("claimed")
+    return dict(row)
+
+
+def _save_publish_job_step(job_id: int, worker: str, fields: Dict[str, Any]) -> bool:
+    """Сохранить результат шага и продлить аренду. False — аренду уже забрал другой воркер."""
+    sets: List[str] = []
+    params: List[Any] = []
+    for col in ("state", "advert_id", *_PUBLISH_JOB_JSON_COLUMNS):
+        if col in fields:
+            sets.append(f"{col} = %s")
+            value = fields[col]
+            params.append(_jsonb(value) if col in _PUBLISH_JOB_JSON_COLUMNS and value is not None else value)
+    if fields.get("state") == "notified":
+        sets += ["finished_at = now()", "locked_by = NULL", "locked_until = NULL", "last_error = NULL"]
+    else:
+        sets.append("locked_until = now() + make_interval(secs => %s)")
+        params.append(PUBLISH_JOB_LEASE_SEC)
+    with _pg_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"UPDATE {PUBLISH_JOBS_TABLE} SET {', '.join(sets)}, updated_at = now() WHERE id = %s AND locked_by = %s",
+                (*params, int(job_id), worker),
+            )
+            ok = cur.rowcount == 1
+        conn.commit()
+    return ok
+
+
+def _fail_publish_job(job: Dict[str, Any], worker: str, error: Exception, retry: bool) -> bool:
+    """Ошибка шага -> True, если задача ушла в failed. Пока объявления на 999 нет — повтор с паузой (retry=False — сразу failed,
+    ошибку видит вызывающий). Если объявление уже создано, задача не сдаётся: иначе на 999 останется объявление без записи в PG/Bitrix."""
+    err = str(error)
+    advert_id = job.get("advert_id")
+    attempts = int(job.get("attempts") or 1)
+    give_up = advert_id is None and (not retry or attempts >= PUBLISH_JOB_MAX_ATTEMPTS)
+    if (
+        job.get("source") == "retro"
+        and advert_id is None
+        and "crm.controller.item.getFile" in err
+        and "400 Client Error" in err
+    ):
+        # Битое фото в Bitrix (как раньше в ретро-режиме): пометить машину пропущенной, чтобы не выбиралась снова
+        try:
+            with _pg_conn() as conn:
+                _mark_sent_to_999(conn, int(job["item_id"]), None)
+            give_up = True
+        except Exception as mark_err:
+            print(f"WARN PUBLISH_JOB {job['id']}: skip-mark item_id={job['item_id']}: {mark_err}", file=sys.stderr, flush=True)
+    delay = min(3600, PUBLISH_JOB_RETRY_BASE_SEC * 2 ** max(0, attempts - 1))
+    try:
+        with _pg_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    UPDATE {PUBLISH_JOBS_TABLE}
+                    SET state = CASE WHEN %s THEN 'failed' ELSE state END,
+                        finished_at = CASE WHEN %s THEN now() ELSE NULL END,
+                        last_error = %s,
+                        next_attempt_at = now() + make_interval(secs => %s),
+                        locked_by = NULL,
+                        locked_until = NULL,
+                        updated_at = now()
+                    WHERE id = %s AND locked_by = %s
+                    """,
+                    (give_up, give_up, err[:2000], delay, int(job["id"]), worker),
+                )
+            conn.commit()
+    except Exception as e:
+        print(f"WARN PUBLISH_JOB {job['id']}: не удалось сохранить ошибку: {e}", file=sys.stderr, flush=True)
+    _publish_jobs_count("failed" if give_up else "retries")
+    with _publish_jobs_lock:
+        _publish_jobs_stats["last_error"] = f"job {job['id']} item_id={job['item_id']}: {err[:500]}"
+    return give_up
+
+
+def _publish_job_step(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Выполнить следующий шаг после job['state'] -> поля для сохранения (новый state и результат шага)."""
+    kw = dict(job.get("car") or {})
+    image_urls = kw.pop("image_urls", None) or []
+    photos_no_cache = bool(kw.pop("photos_no_cache", False))
+    item_id = int(job["item_id"])
+    advert_id = job.get("advert_id")
+    phone = kw.get("phone") or ""
+    state = job["state"]
+    if state == "queued":
+        image_ids, photo_timings = _publish_step_photos(image_urls, use_cache=not photos_no_cache)
+        payload = build_advert_payload(image_ids=image_ids if image_ids else None, **kw)
+        return {"state": "photos_uploaded", "image_ids": image_ids, "payload": payload, "photo_timings": photo_timings}
+    if state == "photos_uploaded":
+        try:
+            result = _publish_step_post(job["payload"], phone, item_id=item_id)
+        except RuntimeError as e:
+            stale_ids = [str(i) for i in job.get("image_ids") or []]
+            if photos_no_cache or not stale_ids or not _is_image_rejected_error(e, stale_ids):
+                raise
+            # 999 не принял image_id (кэш устарел): выкидываем их из кэша и грузим фото заново, без кэша — один раз
+            print(f"WARN PUBLISH_JOB {job['id']}: 999 отверг фото: {e}; перезагружаем без кэша", file=sys.stderr, flush=True)
+            evict_image_cache(stale_ids)
+            return {"state": "queued", "image_ids": None, "payload": None, "car": {**job["car"], "photos_no_cache": True}}
+        return {"state": "posted", "result": result, "advert_id": _advert_id_from_result(result)}
+    if state == "posted":
+        if advert_id:
+            _publish_step_contacts(advert_id, phone)
+        return {"state": "contacts_set"}
+    if state == "contacts_set":
+        if advert_id:
+            _publish_step_public(advert_id)
+        return {"state": "public"}
+    if state == "public":
+        # Под захватом машины: постановка авто/ретро (enqueue_publish_job) не увидит её «ещё не на 999» посреди отметки
+        if not _claim_item(item_id, wait_sec=10):
+            raise RuntimeError(f"item_id={item_id} захвачен другой репликой, отметка — при следующей попытке")
+        try:
+            if _claim_lost(item_id):
+                raise RuntimeError(f"item_id={item_id}: захват потерян при переподключении, отметка — при следующей попытке")
+            with _pg_conn() as conn:
+                _mark_sent_to_999(conn, item_id, advert_id)
+        finally:
+            _release_item(item_id)
+        if advert_id:
+            update_bitrix_999_publication_fields(item_id, advert_id, strict=True)
+        return {"state": "linked"}
+    if state == "linked":
+        if advert_id:
+            send_telegram_notification_999(
+                str(advert_id),
+                marca=kw.get("marca"),
+                model=kw.get("model"),
+                numar_auto=kw.get("numar_auto"),
+                category_id=kw.get("category_id"),
+                photo_url=image_urls[0] if image_urls else None,
+            )
+        return {"state": "notified"}
+    raise RuntimeError(f"Задача {job['id']}: неизвестное состояние {state!r}")
+
+
+def _execute_publish_job(job: Dict[str, Any], worker: str, retry: bool = True) -> Dict[str, Any]:
+    """Довести взятую задачу до notified, сохраняя state после каждого шага. -> ответ POST /adverts (с photo_timings,
+    если фото грузились в этом запуске). При ошибке — _fail_publish_job и исключение наверх.
+    Не закрыто только окно между ответом POST и записью advert_id (один UPDATE): повтор после падения в нём создаст дубль."""
+    photo_timings = None
+    try:
+        while job["state"] != "notified":
+            fields = _publish_job_step(job)
+            photo_timings = fields.pop("photo_timings", photo_timings)
+            if not _save_publish_job_step(job["id"], worker, fields):
+                raise RuntimeError(f"Задача {job['id']}: аренда истекла, задачу взял другой воркер")
+            job.update(fields)
+            _publish_jobs_count("steps")
+    except Exception as e:
+        _fail_publish_job(job, worker, e, retry)
+        raise
+    _publish_jobs_count("notified")
+    result = job.get("result")
+    if isinstance(result, dict) and photo_timings:
+        result = {**result, "photo_timings": photo_timings}
+    return result or {}
+
+
+def _publish_job_worker_loop() -> None:
+    worker = _publish_worker_name()
+    while True:
+        try:
+            job = _claim_publish_job(worker) if _token() else None
+            if job is None:
+                _publish_jobs_wakeup.wait(PUBLISH_JOB_POLL_SEC)
+                _publish_jobs_wakeup.clear()
+                continue
+            print(
+                f"PUBLISH_JOB {job['id']}: item_id={job['item_id']} ({job['source']}) с шага {job['state']}, попытка {job['attempts']}",
+                flush=True,
+            )
+            try:
+                _execute_publish_job(job, worker)
+                print(
+                    f"PUBLISH_JOB {job['id']}: отправлено на 999 item_id={job['item_id']}"
+                    + (f" advert_id={job['advert_id']}" if job.get("advert_id") else ""),
+                    flush=True,
+                )
+            except Exception as e:
+                print(f"PUBLISH_JOB {job['id']}: ошибка после шага {job['state']}: {e}", file=sys.stderr, flush=True)
+        except Exception as e:
+            print(f"WARN PUBLISH_JOB worker: {e}", file=sys.stderr, flush=True)
+            time.sleep(PUBLISH_JOB_POLL_SEC)
+
+
+def start_publish_job_workers() -> None:
+    """PUBLISH_JOB_WORKERS потоков над очередью; при старте они же доводят задачи, прерванные падением процесса."""
+    with _publish_jobs_lock:
+        _publish_job_threads[:] = [t for t in _publish_job_threads if t.is_alive()]
+        for n in range(len(_publish_job_threads), max(0, PUBLISH_JOB_WORKERS)):
+            t = threading.Thread(target=_publish_job_worker_loop, name=f"publish-job-{n + 1}", daemon=True)
+            t.start()
+            _publish_job_threads.append(t)
+
+
+def retry_publish_job(job_id: int) -> Optional[Dict[str, Any]]:
+    """failed -> queued (с начала: image_id неизменных фото всё равно возьмутся из кэша)."""
+    with _pg_conn() as conn:
+        _ensure_schema(conn)
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute(
+                f"""
+                UPDATE {PUBLISH_JOBS_TABLE}
+                SET state = 'queued', attempts = 0, next_attempt_at = now(), finished_at = NULL, updated_at = now()
+                WHERE id = %s AND state = 'failed' AND advert_id IS NULL
+                RETURNING id, item_id, source
+                """,
+                (int(job_id),),
+            )
+            row = cur.fetchone()
+        conn.commit()
+    if row is not None:
+        _publish_jobs_wakeup.set()
+    return dict(row) if row else None
+
+
+def get_publish_jobs_status() -> Dict[str, Any]:
+    with _publish_jobs_lock:
+        out: Dict[str, Any] = {
+            "table": PUBLISH_JOBS_TABLE,
+            "workers": PUBLISH_JOB_WORKERS,
+            "workers_alive": sum(1 for t in _publish_job_threads if t.is_alive()),
+            "lease_sec": PUBLISH_JOB_LEASE_SEC,
+            "max_attempts": PUBLISH_JOB_MAX_ATTEMPTS,
+            **_publish_jobs_stats,
+        }
+    try:
+        with _pg_conn() as conn:
+            _ensure_schema(conn)
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(f"SELECT state, count(*) AS n FROM {PUBLISH_JOBS_TABLE} GROUP BY state")
+                out["by_state"] = {r["state"]: int(r["n"]) for r in cur.fetchall()}
+                cur.execute(
+                    f"""
+                    SELECT id, item_id, source, state, advert_id, attempts, last_error,
+                           next_attempt_at::text AS next_attempt_at, locked_by
+                    FROM {PUBLISH_JOBS_TABLE}
+                    WHERE last_error IS NOT NULL AND ({PUBLISH_JOB_ACTIVE_SQL} OR state = 'failed')
+                    ORDER BY updated_at DESC
+                    LIMIT 20
+                    """
+                )
+                out["with_errors"] = [dict(r) for r in cur.fetchall()]
+    except Exception as e:
+        out["db_error"] = str(e)
+    return out
+
+
 def publish_random_car_to_999() -> Optional[Dict[str, Any]]:
     max_attempts = 10
     tried_item_ids: Set[int] = set()
@@ -2798,13 +6870,12 @@ def publish_random_car_to_999() -> Optional[Dict[str, Any]]:
             return None
 
         item_id = get_item_id_from_raw(raw)
-        if item_id is not None and item_id in tried_item_ids:
+        if item_id is None or item_id in tried_item_ids:
             continue
-        if item_id is not None:
-            tried_item_ids.add(item_id)
+        tried_item_ids.add(item_id)
 
-        car = car_data_from_raw(raw)
-        if not car.get("image_urls"):
+        car = car_data_from_raw(raw, iblock_wait_sec=IBLOCK_PUBLISH_WAIT_SEC)
+        if car.get("iblock_unresolved") or not car.get("image_urls"):
             continue
         if not car.get("marca") or not car.get("model"):
             continue
@@ -2812,52 +6883,25 @@ def publish_random_car_to_999() -> Optional[Dict[str, Any]]:
             continue
 
         try:
-            result = publish_car_manual(
-                marca=car["marca"],
-                model=car["model"],
-                year=car["year"],
-                price=car["price"],
-                price_unit=car.get("price_unit") or "eur",
-                mileage_km=car.get("mileage_km"),
-                description=car.get("description") or "",
-                numar_auto=car.get("numar_auto") or "",
-                phone=car.get("phone") or "",
-                image_urls=car["image_urls"],
-                image_paths=None,
-                region_option_id=None,
-                listing_title=car.get("listing_title"),
-                template_listing_title=car.get("template_listing_title"),
-                description_ru=car.get("description_ru"),
-                description_ro=car.get("description_ro"),
-                item_id=item_id,
-                category_id=raw.get("categoryId"),
-                body_type_option_id=car.get("body_type_option_id"),
-                fuel_option_id=car.get("fuel_option_id"),
-                engine_option_id=car.get("engine_option_id"),
-                drive_option_id=car.get("drive_option_id"),
-                transmission_option_id=car.get("transmission_option_id"),
-            )
-            advert_id = None
-            if result:
-                aid = (result.get("advert") or {}).get("id")
-                if aid is not None:
-                    try:
-                        advert_id = int(aid)
-                    except (TypeError, ValueError):
-                        pass
-            conn = _pg_conn()
+            worker = _publish_worker_name()
+            job_id, created = enqueue_publish_job(item_id, _publish_kwargs(car, raw, item_id), "random")
+            job = _claim_publish_job(worker, job_id) if created else None
+            if job is None:
+                continue  # у этой машины уже есть своя задача
             try:
-                _mark_sent_to_999(conn, item_id, advert_id)
-            finally:
-                conn.close()
-            if advert_id is not None:
-                update_bitrix_999_publication_fields(item_id, advert_id)
+                result = _execute_publish_job(job, worker, retry=False)
+            except Exception as e:
+                if job.get("advert_id") is None:
+                    raise
+                print(f"WARN publish_random_car_to_999 item_id={item_id}: после создания объявления: {e}", file=sys.stderr, flush=True)
+                result = {**(job.get("result") or {}), "pending_steps_error": str(e)}
             return {
                 "ok": True,
                 "999md": result,
                 "source": "random",
                 "item_id": item_id,
                 "attempt": attempt,
+                "job_id": job_id,
             }
         except Exception as e:
             last_error = e
@@ -2879,17 +6923,158 @@ def publish_random_car_to_999() -> Optional[Dict[str, Any]]:
     return None
 
 
+def _publish_candidate_kwargs(raw: Dict[str, Any], tag: str) -> Optional[Dict[str, Any]]:
+    """Проверки авто- и ретро-петли перед постановкой в очередь: фильтр TG, фото, ещё не на 999, марка/модель/цена, стадия.
+    None — пропуск (причина в лог)."""
+    item_id = get_item_id_from_raw(raw)
+    if not should_send_like_tg(raw):
+        print(f"{tag}: SKIP item {item_id} does NOT pass Telegram filter", file=sys.stderr, flush=True)
+        return None
+    if not item_id:
+        return None
+    photo_urls = extract_photo_urls_from_raw(raw, _bitrix_webhook())
+    if not photo_urls:
+        print(f"{tag}: SKIP item {item_id} has NO valid photos (TG logic)", file=sys.stderr, flush=True)
+        return None
+    with _pg_conn() as conn:
+        if _was_sent_to_999(conn, item_id):
+            print(f"{tag}: item_id={item_id} уже на 999, пропуск", flush=True)
+            return None
+    car = car_data_from_raw(raw, iblock_wait_sec=IBLOCK_PUBLISH_WAIT_SEC)
+    if car.get("iblock_unresolved"):
+        # Не ставим в очередь с моделью «первой в марке»: машина остаётся в очереди кандидатов до добора имён
+        print(f"{tag}: item_id={item_id} имена iblock ещё не подтянуты {car['iblock_unresolved']}, отложено", flush=True)
+        return None
+    if not (car.get("image_urls") or []):
+        print(f"{tag}: SKIP item {item_id} has NO valid photos (TG logic)", file=sys.stderr, flush=True)
+        return None
+    if not car.get("marca") or not car.get("model"):
+        print(f"{tag}: item_id={item_id} без марки/модели, пропуск.", flush=True)
+        return None
+    if not car.get("price") or car["price"] <= 0:
+        print(f"{tag}: item_id={item_id} без цены, пропуск.", flush=True)
+        return None
+    if not _is_stage_allowed_for_999(raw):
+        print(f"{tag}: item_id={item_id} не в стадии Nobil 1/2/Arena, пропуск.", flush=True)
+        return None
+    return _publish_kwargs(car, raw, item_id)
+
+
+_auto_publish_wakeup = threading.Event()
+_auto_publish_listener_thread: Optional[threading.Thread] = None
+_auto_publish_listener_stats: Dict[str, Any] = {
+    "connected": False,
+    "notifications": 0,
+    "wakeups": 0,
+    "reconnects": 0,
+    "last_item_ids": [],
+    "last_notify_at": None,
+    "last_error": None,
+}
+
+
+def _auto_publish_listener_loop() -> None:
+    """Отдельное соединение (не из пула) с LISTEN NOTIFY_999_CHANNEL. Пачку уведомлений копим AUTO_PUBLISH_DEBOUNCE_SEC
+    от первого, затем будим _auto_publish_loop одним событием. При обрыве — переподключение с backoff."""
+    stats = _auto_publish_listener_stats
+    backoff = 1.0
+    while True:
+        conn = None
+        try:
+            conn = _pg_connect_direct()
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {NOTIFY_999_CHANNEL}")
+            stats["connected"] = True
+            stats["last_error"] = None
+            backoff = 1.0
+            _auto_publish_wakeup.set()  # пока не слушали, уведомления могли пропасть
+            pending_since: Optional[float] = None
+            pending_ids: List[int] = []
+            while True:
+                timeout = 60.0 if pending_since is None else max(0.0, pending_since + AUTO_PUBLISH_DEBOUNCE_SEC - time.time())
+                if select.select([conn], [], [], timeout) != ([], [], []):
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        stats["notifications"] += 1
+                        stats["last_notify_at"] = datetime.now().isoformat(timespec="seconds")
+                        if str(n.payload).isdigit():
+                            pending_ids.append(int(n.payload))
+                        if pending_since is None:
+                            pending_since = time.time()
+                elif pending_since is None:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")  # обрыв соединения заметим здесь, а не через час
+                if pending_since is not None and time.time() - pending_since >= AUTO_PUBLISH_DEBOUNCE_SEC:
+                    stats["last_item_ids"] = pending_ids[-20:]
+                    stats["wakeups"] += 1
+                    pending_since = None
+                    pending_ids = []
+                    _auto_publish_wakeup.set()
+        except Exception as e:
+            stats["last_error"] = str(e)
+            print(f"WARN AUTO_999 LISTEN: {e}", file=sys.stderr, flush=True)
+        finally:
+            stats["connected"] = False
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        stats["reconnects"] += 1
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 60.0)
+
+
+def get_auto_publish_listener_status() -> Dict[str, Any]:
+    return {
+        "enabled": AUTO_PUBLISH_LISTEN_ENABLED,
+        "channel": NOTIFY_999_CHANNEL,
+        "debounce_sec": AUTO_PUBLISH_DEBOUNCE_SEC,
+        "safety_poll_sec": AUTO_PUBLISH_SAFETY_POLL_SEC,
+        "min_publish_interval_sec": POLL_INTERVAL_999,
+        "running": bool(_auto_publish_listener_thread and _auto_publish_listener_thread.is_alive()),
+        **_auto_publish_listener_stats,
+    }
+
+
+def _auto_publish_wait(publish_due_at: Optional[float], hide_due_at: Optional[float] = None) -> None:
+    """Ждать NOTIFY (после debounce), наступления publish_due_at / hide_due_at, начала слота SYNC_999_RUN_HOURS или страховочного опроса."""
+    poll = AUTO_PUBLISH_SAFETY_POLL_SEC if _auto_publish_listener_stats["connected"] else POLL_INTERVAL_999
+    timeout = float(poll)
+    for due_at in (publish_due_at, hide_due_at):
+        if due_at is not None:
+            timeout = min(timeout, max(1.0, due_at - time.time()))
+    timeout = min(timeout, max(1.0, _next_sync_999_slot_at() - time.time()))
+    _auto_publish_wakeup.wait(timeout)
+    _auto_publish_wakeup.clear()
+
+
 def _auto_publish_loop() -> None:
-    """Фоновая петля авто-отправки на 999 (как в auto_send_tg): раз в POLL_INTERVAL_999, в окне SEND_WINDOW_*."""
+    """Фоновая петля авто-отправки на 999 (как в auto_send_tg): просыпается по NOTIFY или раз в страховочный интервал,
+    ставит в очередь публикаций не больше AUTO_PUBLISH_BATCH машин за POLL_INTERVAL_999, в окне SEND_WINDOW_*.
+    Сами публикации выполняют воркеры очереди (start_publish_job_workers). При нескольких репликах задачи ставит
+    только лидер, hide и sync — каждая реплика по своему шарду."""
+    last_publish_at = time.time()
+    publish_due_at: Optional[float] = last_publish_at + POLL_INTERVAL_999
+    hide_due_at = 0.0  # hide — полный проход по стадии успеха, не на каждый NOTIFY: не чаще POLL_INTERVAL_999
     while True:
         try:
-            time.sleep(POLL_INTERVAL_999)
-            if not _token():
+            _auto_publish_wait(publish_due_at, hide_due_at)
+            has_token = bool(_token())
+            _maybe_sync_999_adverts_from_db(has_token)  # до hide: долгий проход hide не должен съесть час-слот sync
+            if not has_token:
+                continue
+            if time.time() >= hide_due_at:
+                hide_due_at = time.time() + POLL_INTERVAL_999
+                _hide_999_adverts_for_success_stage()
+            if PUBLISH_999MD_DRAFT_ONLY or not _replica_is_leader():
                 continue
-            _hide_999_adverts_for_success_stage()
-            _maybe_sync_999_adverts_from_db()
-            if PUBLISH_999MD_DRAFT_ONLY:
+            if time.time() - last_publish_at < POLL_INTERVAL_999:
+                publish_due_at = last_publish_at + POLL_INTERVAL_999
                 continue
+            publish_due_at = None
             now_local = datetime.now()
             if not (SEND_WINDOW_START_HOUR <= now_local.hour < SEND_WINDOW_END_HOUR):
                 print("AUTO_999: вне окна отправки, жду...", flush=True)
@@ -2898,96 +7083,26 @@ def _auto_publish_loop() -> None:
             if not raw:
                 print("AUTO_999: нет машин под условия (стадия Nobil 1/2/Arena + не на 999 + category 111 + 5–10 фото + скаляры), жду...", flush=True)
                 continue
-            item_id = get_item_id_from_raw(raw)
-            print(f"AUTO_999: кандидат item_id={item_id}, проверки...", flush=True)
-            if not should_send_like_tg(raw):
+            last_publish_at = time.time()
+            publish_due_at = last_publish_at + POLL_INTERVAL_999  # в очереди может быть следующая машина
+            for n in range(max(1, AUTO_PUBLISH_BATCH)):
+                if n:
+                    raw = fetch_next_raw_for_999()
+                    if not raw:
+                        break
                 item_id = get_item_id_from_raw(raw)
+                print(f"AUTO_999: кандидат item_id={item_id}, проверки...", flush=True)
+                kwargs = _publish_candidate_kwargs(raw, "AUTO_999")
+                if kwargs is None:
+                    break
+                job_id, created = enqueue_publish_job(item_id, kwargs, "auto", only_unsent=True)
+                if job_id is None:
+                    print(f"AUTO_999: item_id={item_id} уже на 999 или в работе у другой реплики, пропуск", flush=True)
+                    break
                 print(
-                    f"SKIP 999.md: item {item_id} does NOT pass Telegram filter",
-                    file=sys.stderr,
-                    flush=True,
-                )
-                continue
-            if not item_id:
-                continue
-            photo_urls = extract_photo_urls_from_raw(raw, _bitrix_webhook())
-            if not photo_urls:
-                print(
-                    f"SKIP 999.md: item {item_id} has NO valid photos (TG logic)",
-                    file=sys.stderr,
-                    flush=True,
-                )
-                continue
-            conn = _pg_conn()
-            try:
-                if _was_sent_to_999(conn, item_id):
-                    print(f"AUTO_999: item_id={item_id} уже на 999, пропуск", flush=True)
-                    continue
-            finally:
-                conn.close()
-            car = car_data_from_raw(raw)
-            urls = car.get("image_urls") or []
-            if not urls:
-                print(
-                    f"SKIP 999.md: item {item_id} has NO valid photos (TG logic)",
-                    file=sys.stderr,
+                    f"AUTO_999: item_id={item_id} в очереди публикаций, задача {job_id}" + ("" if created else " (уже была)"),
                     flush=True,
                 )
-                continue
-            if not car.get("marca") or not car.get("model"):
-                print(f"AUTO_999: item_id={item_id} без марки/модели, пропуск.", flush=True)
-                continue
-            if not car.get("price") or car["price"] <= 0:
-                print(f"AUTO_999: item_id={item_id} без цены, пропуск.", flush=True)
-                continue
-            if not _is_stage_allowed_for_999(raw):
-                print(f"AUTO_999: item_id={item_id} не в стадии Nobil 1/2/Arena, пропуск.", flush=True)
-                continue
-            try:
-                print(f"AUTO_999: публикуем на 999 item_id={item_id} ...", flush=True)
-                result = publish_car_manual(
-                    marca=car["marca"],
-                    model=car["model"],
-                    year=car["year"],
-                    price=car["price"],
-                    price_unit=car.get("price_unit") or "eur",
-                    mileage_km=car.get("mileage_km"),
-                    description=car.get("description") or "",
-                    numar_auto=car.get("numar_auto") or "",
-                    phone=car.get("phone") or "",
-                    image_urls=car["image_urls"],
-                    image_paths=None,
-                    region_option_id=None,
-                    listing_title=car.get("listing_title"),
-                    template_listing_title=car.get("template_listing_title"),
-                    description_ru=car.get("description_ru"),
-                    description_ro=car.get("description_ro"),
-                    item_id=item_id,
-                    category_id=raw.get("categoryId"),
-                    body_type_option_id=car.get("body_type_option_id"),
-                    fuel_option_id=car.get("fuel_option_id"),
-                    engine_option_id=car.get("engine_option_id"),
-                    drive_option_id=car.get("drive_option_id"),
-                    transmission_option_id=car.get("transmission_option_id"),
-                )
-                advert_id = None
-                if result:
-                    aid = (result.get("advert") or {}).get("id")
-                    if aid is not None:
-                        try:
-                            advert_id = int(aid)
-                        except (TypeError, ValueError):
-                            pass
-                conn = _pg_conn()
-                try:
-                    _mark_sent_to_999(conn, item_id, advert_id)
-                finally:
-                    conn.close()
-                if advert_id is not None:
-                    update_bitrix_999_publication_fields(item_id, advert_id)
-                print(f"AUTO_999: отправлено на 999 item_id={item_id}" + (f" advert_id={advert_id}" if advert_id else ""), flush=True)
-            except Exception as e:
-                print(f"AUTO_999: ошибка публикации item_id={item_id}: {e}", file=sys.stderr, flush=True)
         except Exception as e:
             print(f"AUTO_999: ошибка цикла: {e}", file=sys.stderr, flush=True)
 
@@ -3032,90 +7147,27 @@ def _retro_auto_publish_loop() -> None:
             with _retro_auto_999_lock:
                 _retro_auto_999_last_item_id = item_id
 
-            if not should_send_like_tg(raw):
-                print(f"RETRO_999: SKIP item {item_id} does NOT pass Telegram filter", file=sys.stderr, flush=True)
-                time.sleep(1)
-                continue
-            if not item_id:
-                time.sleep(1)
-                continue
-
-            photo_urls = extract_photo_urls_from_raw(raw, _bitrix_webhook())
-            if not photo_urls:
-                print(f"RETRO_999: SKIP item {item_id} has NO valid photos (TG logic)", file=sys.stderr, flush=True)
+            kwargs = _publish_candidate_kwargs(raw, "RETRO_999")
+            if kwargs is None:
                 time.sleep(1)
                 continue
 
-            conn = _pg_conn()
             try:
-                if _was_sent_to_999(conn, item_id):
-                    print(f"RETRO_999: item_id={item_id} уже на 999, пропуск", flush=True)
+                print(f"RETRO_999: публикуем на 999 item_id={item_id} ...", flush=True)
+                # Через очередь, но в этом потоке: упадёт процесс — задачу доведут воркеры
+                worker = _publish_worker_name()
+                job_id, _ = enqueue_publish_job(item_id, kwargs, "retro", only_unsent=True)
+                if job_id is None:
+                    print(f"RETRO_999: item_id={item_id} уже на 999 или в работе у другой реплики, пропуск", flush=True)
                     time.sleep(1)
                     continue
-            finally:
-                conn.close()
-
-            car = car_data_from_raw(raw)
-            urls = car.get("image_urls") or []
-            if not urls:
-                print(f"RETRO_999: SKIP item {item_id} has NO valid photos (TG logic)", file=sys.stderr, flush=True)
-                time.sleep(1)
-                continue
-            if not car.get("marca") or not car.get("model"):
-                print(f"RETRO_999: item_id={item_id} без марки/модели, пропуск.", flush=True)
-                time.sleep(1)
-                continue
-            if not car.get("price") or car["price"] <= 0:
-                print(f"RETRO_999: item_id={item_id} без цены, пропуск.", flush=True)
-                time.sleep(1)
-                continue
-            if not _is_stage_allowed_for_999(raw):
-                print(f"RETRO_999: item_id={item_id} не в стадии Nobil 1/2/Arena, пропуск.", flush=True)
-                time.sleep(1)
-                continue
-
-            try:
-                print(f"RETRO_999: публикуем на 999 item_id={item_id} ...", flush=True)
-                result = publish_car_manual(
-                    marca=car["marca"],
-                    model=car["model"],
-                    year=car["year"],
-                    price=car["price"],
-                    price_unit=car.get("price_unit") or "eur",
-                    mileage_km=car.get("mileage_km"),
-                    description=car.get("description") or "",
-                    numar_auto=car.get("numar_auto") or "",
-                    phone=car.get("phone") or "",
-                    image_urls=car["image_urls"],
-                    image_paths=None,
-                    region_option_id=None,
-                    listing_title=car.get("listing_title"),
-                    template_listing_title=car.get("template_listing_title"),
-                    description_ru=car.get("description_ru"),
-                    description_ro=car.get("description_ro"),
-                    item_id=item_id,
-                    category_id=raw.get("categoryId"),
-                    body_type_option_id=car.get("body_type_option_id"),
-                    fuel_option_id=car.get("fuel_option_id"),
-                    engine_option_id=car.get("engine_option_id"),
-                    drive_option_id=car.get("drive_option_id"),
-                    transmission_option_id=car.get("transmission_option_id"),
-                )
-                advert_id = None
-                if result:
-                    aid = (result.get("advert") or {}).get("id")
-                    if aid is not None:
-                        try:
-                            advert_id = int(aid)
-                        except (TypeError, ValueError):
-                            pass
-                conn = _pg_conn()
-                try:
-                    _mark_sent_to_999(conn, item_id, advert_id)
-                finally:
-                    conn.close()
-                if advert_id is not None:
-                    update_bitrix_999_publication_fields(item_id, advert_id)
+                job = _claim_publish_job(worker, job_id)
+                if job is None:
+                    print(f"RETRO_999: item_id={item_id} уже публикуется (задача {job_id}), пропуск", flush=True)
+                    time.sleep(1)
+                    continue
+                _execute_publish_job(job, worker)
+                advert_id = job.get("advert_id")
                 with _retro_auto_999_lock:
                     _retro_auto_999_sent_times.append(time.time())
                     _retro_auto_999_total_sent += 1
@@ -3127,19 +7179,12 @@ def _retro_auto_publish_loop() -> None:
             except Exception as e:
                 err_text = str(e)
                 if "crm.controller.item.getFile" in err_text and "400 Client Error" in err_text:
-                    try:
-                        conn = _pg_conn()
-                        try:
-                            _mark_sent_to_999(conn, item_id, None)
-                        finally:
-                            conn.close()
-                        with _retro_auto_999_lock:
-                            _retro_auto_999_last_error = f"SKIP item_id={item_id}: broken Bitrix photo (getFile 400)"
-                        print(f"RETRO_999: SKIP item_id={item_id} (Bitrix getFile 400), помечено как пропущенное.", file=sys.stderr, flush=True)
-                        time.sleep(1)
-                        continue
-                    except Exception as skip_err:
-                        print(f"RETRO_999: WARN skip-mark item_id={item_id}: {skip_err}", file=sys.stderr, flush=True)
+                    # _fail_publish_job уже пометил машину пропущенной
+                    with _retro_auto_999_lock:
+                        _retro_auto_999_last_error = f"SKIP item_id={item_id}: broken Bitrix photo (getFile 400)"
+                    print(f"RETRO_999: SKIP item_id={item_id} (Bitrix getFile 400), помечено как пропущенное.", file=sys.stderr, flush=True)
+                    time.sleep(1)
+                    continue
                 with _retro_auto_999_lock:
                     _retro_auto_999_last_error = str(e)
                 print(f"RETRO_999: ошибка публикации item_id={item_id}: {e}", file=sys.stderr, flush=True)
@@ -3210,13 +7255,12 @@ def start_auto_publish_999_thread() -> None:
     if not AUTO_PUBLISH_999_ENABLED:
         return
     try:
-        conn = _pg_conn()
-        _ensure_999_sent_table(conn)
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT count(*) FROM {SENT_999_TABLE}")
-            row = cur.fetchone()
-            n_999 = row[0] if row else 0
-        conn.close()
+        with _pg_conn() as conn:
+            _ensure_schema(conn)
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT count(*) FROM {SENT_999_TABLE}")
+                row = cur.fetchone()
+                n_999 = row[0] if row else 0
         print(
             f"AUTO_999: БД host={PG_HOST} dbname={PG_DB} — на 999 уже отправлено: {n_999}. "
             "Фильтр: стадии Nobil 1/2/Arena, без привязки к tg_sent_items.",
@@ -3224,6 +7268,12 @@ def start_auto_publish_999_thread() -> None:
         )
     except Exception as e:
         print(f"AUTO_999: WARN при проверке БД: {e}", file=sys.stderr, flush=True)
+    global _auto_publish_listener_thread
+    if AUTO_PUBLISH_LISTEN_ENABLED and not (_auto_publish_listener_thread and _auto_publish_listener_thread.is_alive()):
+        _auto_publish_listener_thread = threading.Thread(target=_auto_publish_listener_loop, daemon=True)
+        _auto_publish_listener_thread.start()
+    start_replica_coordination()
+    start_publish_job_workers()
     t = threading.Thread(target=_auto_publish_loop, daemon=True)
     t.start()
     print("AUTO_999: фоновый поток авто-отправки на 999 запущен.", flush=True)
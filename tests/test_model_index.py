@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""ModelIndex против прежнего линейного обхода (bench_999md._legacy_resolve_model): правила обхода дают тот же выбор,
+нечёткий (trigram) выбор — только при сходстве от MODEL_MATCH_MIN_TRIGRAM. Запуск: python -m pytest -q tests"""
+import random
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bench_999md  # noqa: E402
+import publish_999md as p999  # noqa: E402
+
+
+def _opts(*titles):
+    return [{"id": str(100 + i), "title": t} for i, t in enumerate(titles)]
+
+
+def _match(options, model):
+    return p999.ModelIndex(options).match(model)
+
+
+def test_exact_later_does_not_beat_earlier_substring():
+    # Обход брал первую подходящую по списку: "A4" в "A4 Allroad" раньше точного "A4"
+    options = _opts("A4 Allroad", "A4")
+    found = _match(options, "A4")
+    assert found.option_id == bench_999md._legacy_resolve_model(options, "A4") == "100"
+    assert found.rule == "contains"
+
+
+def test_short_contained_option_is_skipped():
+    # "C" — подстрока "C Class", но слишком короткая (не берём); "C Class" — подстрока "C Class Coupe"
+    options = _opts("C", "CLA", "C Class Coupe")
+    found = _match(options, "C Class")
+    assert found.option_id == bench_999md._legacy_resolve_model(options, "C Class") == "102"
+
+
+def test_prefix_rules_match_legacy():
+    options = _opts("Golf", "Passat Variant", "Octavia")
+    for model in ("Passat", "Octavi", "Octavias", "Golfy"):
+        assert _match(options, model).option_id == bench_999md._legacy_resolve_model(options, model), model
+
+
+def test_no_rule_and_low_similarity_falls_back_to_first_option():
+    options = _opts("Corolla", "Camry", "Land Cruiser")
+    found = _match(options, "Supra")
+    assert (found.option_id, found.rule, found.score) == ("100", "fallback", 0.0)
+    assert found.option_id == bench_999md._legacy_resolve_model(options, "Supra")
+
+
+def test_trigram_only_above_threshold():
+    # Хвост "4x4" ломает правила обхода (он вернул бы первую модель); похожая модель берётся только выше порога
+    options = _opts("A3", "A4 Variant")
+    assert bench_999md._legacy_resolve_model(options, "A4 Variant 4x4") == "100"
+    found = _match(options, "A4 Variant 4x4")
+    assert (found.option_id, found.rule) == ("101", "trigram")
+    old = p999.MODEL_MATCH_MIN_TRIGRAM
+    p999.MODEL_MATCH_MIN_TRIGRAM = 0.99
+    try:
+        assert _match(options, "A4 Variant 4x4").rule == "fallback"
+    finally:
+        p999.MODEL_MATCH_MIN_TRIGRAM = old
+
+
+def test_random_models_match_legacy_except_trigram():
+    options = bench_999md._synthetic_models_tree(3)
+    rnd = random.Random(7)
+    for brand_options in options.values():
+        index = p999.ModelIndex(brand_options)
+        titles = [o["title"] for o in brand_options]
+        for title in rnd.sample(titles, 40):
+            for model in bench_999md._model_queries(title):
+                found = index.match(model)
+                if found.rule != "trigram":
+                    assert found.option_id == bench_999md._legacy_resolve_model(brand_options, model), model